@@ -21,11 +21,11 @@ endif
 syn match   yamlKey     '\(\w\|,\|-\)\+\(\s\+\(\w\|,\|-\)\+\)*\ze\s*:' contains=mlkKeyword,mlkKeyDelim
 
 syn match   mlkKeyDelim  contained ','
-syn keyword mlkKeyword   contained variables services actions
-syn keyword mlkKeyword   contained require before filter
+syn keyword mlkKeyword   contained variables services actions budget connections
+syn keyword mlkKeyword   contained require before filter pipeline
 syn keyword mlkKeyword   contained desc target mode cmd fanout timeout errors
-syn keyword mlkKeyword   contained delay retry
-syn keyword mlkKeyword   contained remote
+syn keyword mlkKeyword   contained delay retry deadline cacheable waves quorum
+syn keyword mlkKeyword   contained remote readonly
 syn keyword mlkKeyword   contained tags
 syn match   mlkVariable  '%\h\w*'
 syn match   mlkNodeGroup '@\w\+'
@@ -37,17 +37,24 @@ ActionEventHandler and ActionManager.
 """
 
 import time
+from collections import deque
 
 from ClusterShell.Worker.Popen import WorkerPopen
 from ClusterShell.Event import EventHandler
 from ClusterShell.NodeSet import NodeSet
 from ClusterShell.Task import task_self
 from ClusterShell.Worker.Exec import ExecWorker
+from ClusterShell.Engine.Engine import EngineTimer
 
 from MilkCheck.Callback import call_back_self
-from MilkCheck.Engine.BaseEntity import BaseEntity
+from MilkCheck.Engine.BaseEntity import BaseEntity, run_state
+from MilkCheck.Engine.ActionJob import ActionJob
+from MilkCheck.Engine.ResultCache import StoredWorker
+from MilkCheck.Engine.Dedup import DedupRun, DedupRegistry
+from MilkCheck.Engine.Simulator import SimulatedTimer
 from MilkCheck.Engine.BaseEntity import DONE, TIMEOUT, ERROR, WAITING_STATUS, \
-                                        NO_STATUS, DEP_ERROR, SKIPPED, WARNING
+                                        NO_STATUS, DEP_ERROR, SKIPPED, WARNING, \
+                                        CANCELLED, REQUIRE
 from MilkCheck.Callback import EV_COMPLETE, EV_STARTED, EV_TRIGGER_DEP, \
                                EV_STATUS_CHANGED, EV_DELAYED, EV_FINISHED
 
@@ -66,6 +73,8 @@ class ActionManager(object):
         self.entities = {}
         # Current fanout
         self.fanout = None
+        # Fanout of running actions limited by their group budget
+        self._shares = {}
         # ClusterShell default value
         self.default_fanout = 64
         # Count tasks which worked
@@ -77,11 +86,55 @@ class ActionManager(object):
 
         self.dryrun = False
 
+        # Run-wide deadline in seconds, None means no deadline
+        self.deadline = None
+        # Set as soon as the run-wide deadline is over
+        self.expired = False
+        # Cancel actions as soon as their result can no longer matter
+        self.failfast = False
+        # ClusterShell worker (or timer, if delayed) of each running action
+        self._workers = {}
+        # ResultCache of cacheable actions, None means no cache
+        self.cache = None
+        # DurationHistory of past actions, None means no history
+        self.history = None
+        # Actions waiting for room in the budget of their groups
+        self._blocked = []
+        # Share fanout between running actions, launching nodes by parts
+        self.fairshare = False
+        # ActionJob of each action running by parts
+        self._jobs = deque()
+        # Set when jobs will be dispatched as soon as the task loop runs
+        self._dispatch_armed = False
+        # Do not run actions on nodes found unreachable earlier in the run
+        self.skip_unreachable = False
+        # Nodes found unreachable during the run
+        self.unreachable = NodeSet()
+        # Fanout of the reachability probe
+        self.probe_fanout = 512
+        # SimulatedTask used instead of the master task, if any
+        self.simulation = None
+        # Pipelined jobs following the nodes of each upstream action
+        self._pipelines = {}
+        # Results of read-only actions run ahead of the graph
+        self._prefetched = {}
+        # Run identical commands only once per node
+        self.dedup = False
+        # Commands run during this run, shared between actions
+        self._dedup = DedupRegistry()
+
     def perform_action(self, action):
         """Perform an immediate action"""
         assert not action.to_skip(), "Action should be already SKIPPED"
 
         if not action.parent.simulate:
+            if not self._within_budget(action):
+                # Started as soon as another action of the group completes
+                self._blocked.append(action)
+                return
+            fanout = self._budget_fanout(action)
+            if fanout != (action.fanout or self.default_fanout):
+                self._shares[action] = fanout
             self.add_task(action)
         call_back_self().notify(action.parent, EV_STARTED)
 
@@ -93,17 +146,258 @@ class ActionManager(object):
         command = ':'
         if not self.dryrun:
             command = action.command
-
-        if action.mode == 'exec':
-            wkr = ExecWorker(nodes=nodes, handler=ActionEventHandler(action),
-                             timeout=action.timeout, command=command,
-                             remote=action.remote)
+            # Service state may change, forget what was known about it
+            if self.cache is not None and not action.cacheable:
+                self.cache.invalidate(action.parent)
+
+        upstreams = {}
+        if nodes is not None:
+            upstreams = action.parent.pipeline_upstreams(action.name)
+
+        if nodes is not None and (self.fairshare or action.waves or
+                                  action.quorum is not None or upstreams):
+            # Nodes are launched by parts, by waves, sharing fanout with
+            # other actions or as soon as their upstream nodes are ready
+            held = None
+            if upstreams:
+                held = self._pipeline_split(action, upstreams)
+            job = ActionJob(action, command, self._job_done, self._quorum_met,
+                            held)
+            self._workers[action] = job
+            self._jobs.append(job)
+            job.upstreams = upstreams
+            for upstream in upstreams:
+                self._pipelines.setdefault(upstream, []).append(job)
+            # Let the actions started at the same time join the share first
+            if not self._dispatch_armed:
+                self._dispatch_armed = True
+                self._master_task.timer(handler=DispatchEventHandler(),
+                                        fire=0)
+        elif nodes is not None and self.dedup and not self.dryrun and \
+             action.tries == 1:
+            # Retries really run the command again
+            self._dedup_run(action, command, nodes)
+        else:
+            self._workers[action] = self._start_worker(action, command, nodes,
+                                                   ActionEventHandler(action))
+
+    def _start_worker(self, action, command, nodes, handler):
+        """Start command of the action over the nodes, return the worker"""
+        if action.mode == 'exec' and self.simulation is None:
+            wkr = ExecWorker(nodes=nodes, handler=handler,
+                             timeout=self.command_timeout(action),
+                             command=command, remote=action.remote)
             self._master_task.schedule(wkr)
         else:
-            self._master_task.shell(command, nodes=nodes,
-                                    timeout=action.timeout,
-                                    handler=ActionEventHandler(action),
-                                    remote=action.remote)
+            wkr = self._master_task.shell(command, nodes=nodes,
+                                          timeout=self.command_timeout(action),
+                                          handler=handler,
+                                          remote=action.remote)
+        return wkr
+
+    def _dedup_run(self, action, command, nodes):
+        """
+        Run the action command only on the nodes where no other action of
+        the run did, and share the results of the others for the rest.
+        """
+        key = (command, action.mode, action.remote,
+               self.command_timeout(action))
+        run = DedupRun(action, command, key, self._dedup_done)
+        self._workers[action] = run
+        fresh = self._dedup.claim(run, nodes)
+        if fresh:
+            self._dedup_start(run, fresh)
+        else:
+            ActionEventHandler(action).ev_start(None)
+            if not run.waiting:
+                run.finish()
+
+    def _dedup_start(self, run, nodes):
+        """Run the command of a DedupRun by itself on the nodes"""
+        run.running.append(self._start_worker(run.action, run.command, nodes,
+                                              DedupEventHandler(run, nodes)))
+
+    def dedup_worker_done(self, run, worker, nodes):
+        """
+        A worker of a DedupRun is over: share its results with the runs
+        waiting for them, and complete those which have all their results.
+        """
+        run.running.remove(worker)
+        for other, lost in self._dedup.publish(run, worker, nodes):
+            if lost:
+                # Not run to completion by the worker, run them again
+                fresh = self._dedup.claim(other, lost)
+                if fresh:
+                    self._dedup_start(other, fresh)
+            if not other.waiting and not other.running:
+                other.finish()
+        if run.action.abort_status or not (run.waiting or run.running):
+            run.finish()
+
+    def _dedup_done(self, run):
+        """All nodes of the DedupRun have a result"""
+        self._dedup.release(run)
+        if not run.action.abort_status:
+            run.action.pending_target.clear()
+        ActionEventHandler(run.action).ev_close(run.worker)
+
+    def simulate(self, task):
+        """
+        Run actions against the provided SimulatedTask instead of executing
+        their commands. Nothing is read from, nor saved to, the result
+        cache and the history.
+
+        Return the previous state, to be given back to end_simulation().
+        """
+        state = (self._master_task, self.simulation, self.dryrun,
+                 self.default_fanout)
+        self._master_task = task
+        self.simulation = task
+        self.dryrun = True
+        return state
+
+    def end_simulation(self, state):
+        """Run actions as before simulate() returned this state."""
+        (self._master_task, self.simulation, self.dryrun,
+         self.default_fanout) = state
+
+    def _fair_quotas(self, window):
+        """
+        Split the fanout window between the running jobs. Jobs which need
+        less than their share leave the remaining to the others.
+        """
+        quotas = {}
+        left = window
+        jobs = sorted(self._jobs, key=lambda job: job.demand)
+        for idx, job in enumerate(jobs):
+            quotas[job] = min(job.demand, max(1, left // (len(jobs) - idx)))
+            left -= quotas[job]
+        return quotas
+
+    def dispatch_jobs(self):
+        """Launch nodes of running jobs, round-robin, within the fanout"""
+        self._dispatch_armed = False
+        # Pipelined jobs whose waiting nodes were all dropped
+        for job in [job for job in self._jobs if job.idle]:
+            job.finish()
+        window = self.fanout or self.default_fanout
+        free = window - sum(job.inflight for job in self._jobs)
+        if free <= 0 or not self._jobs:
+            return
+        quotas = self._fair_quotas(window)
+        for job in list(self._jobs):
+            deficit = quotas[job] - job.inflight
+            if free <= 0:
+                break
+            if not job.remaining or deficit <= 0:
+                continue
+            # Avoid starting tiny workers while the job has running nodes
+            if job.inflight and deficit < max(1, quotas[job] // 4):
+                continue
+            nodes = job.take(min(deficit, free))
+            job.add_worker(self._start_worker(job.action, job.command, nodes,
+                                              JobEventHandler(job)),
+                           nodes)
+            free -= len(nodes)
+        self._jobs.rotate(-1)
+
+    def _pipeline_split(self, action, upstreams):
+        """
+        Return nodes of a pipelined action which should wait for their
+        upstream nodes. Nodes which already failed upstream are removed
+        from its target.
+        """
+        held = NodeSet()
+        dropped = NodeSet()
+        for upstream in upstreams:
+            dropped.update(action.target & (upstream.failed_nodes |
+                                    upstream.parent.scope_failed_nodes()))
+            if upstream.status in (NO_STATUS, WAITING_STATUS):
+                held.update((action.target & upstream.target) -
+                            upstream.done_nodes)
+        action._own_target().difference_update(dropped)
+        action._target_changed()
+        action.pending_target.difference_update(dropped)
+        return held - dropped
+
+    @staticmethod
+    def _ready_nodes(job, nodes):
+        """Return nodes which succeeded on all running upstream actions."""
+        ready = NodeSet(nodes)
+        for upstream in job.upstreams:
+            if upstream.status in (NO_STATUS, WAITING_STATUS):
+                ready.difference_update((ready & upstream.target) -
+                                        upstream.done_nodes)
+        return ready
+
+    def node_succeeded(self, action, node):
+        """
+        The command of the action succeeded on the node: launch it for the
+        pipelined actions waiting for it.
+        """
+        action.done_nodes.add(node)
+        jobs = self._pipelines.get(action)
+        if jobs:
+            for job in jobs:
+                if not job.finished:
+                    job.feed(self._ready_nodes(job,
+                                               job.waiting & NodeSet(node)))
+            self.dispatch_jobs()
+
+    def upstream_done(self, upstream):
+        """
+        An action followed by pipelined actions is over: their nodes which
+        did not succeed upstream will never be ready, the others are.
+        """
+        jobs = self._pipelines.pop(upstream, None)
+        if not jobs:
+            return
+        failed = upstream.status in (ERROR, TIMEOUT, DEP_ERROR, CANCELLED)
+        for job in jobs:
+            if job.finished:
+                continue
+            action = job.action
+            if failed and job.upstreams[upstream] == REQUIRE:
+                # Nothing more is started, the action will end in DEP_ERROR
+                action.upstream_failed = True
+                dropped = NodeSet(job.waiting)
+            else:
+                dropped = job.waiting & (upstream.failed_nodes |
+                                    upstream.parent.scope_failed_nodes())
+            action._own_target().difference_update(dropped)
+            action._target_changed()
+            action.pending_target.difference_update(dropped)
+            job.drop(dropped)
+            job.feed(self._ready_nodes(job, job.waiting))
+        self.dispatch_jobs()
+
+    def _quorum_met(self, job):
+        """
+        Enough nodes of the job have completed: compute the action status
+        without waiting for the stragglers, unless the action will be
+        retried anyway.
+        """
+        action = job.action
+        if action.tries <= action.maxretry and \
+           (action.nb_errors() or action.nb_timeout()):
+            return
+        # Stragglers keep running, but the action is over
+        job.stragglers = True
+        action.straggler_nodes = action.pending_target.copy()
+        action.pending_target.clear()
+        ActionEventHandler(action).ev_close(job.worker)
+
+    def _job_done(self, job):
+        """All nodes of the job have completed"""
+        self._jobs.remove(job)
+        if job.stragglers:
+            # Action status was computed when its quorum was reached
+            return
+        if job.skipped:
+            # Stopped because of a wave with too many errors
+            job.action.pending_target.difference_update(job.skipped)
+            job.action.aborted_nodes.add(job.skipped)
+        ActionEventHandler(job.action).ev_close(job.worker)
 
     def perform_delayed_action(self, action):
         """Perform a delayed action and add it to the running tasks"""
@@ -112,8 +406,231 @@ class ActionManager(object):
         if not action.parent.simulate:
             self.add_task(action)
             call_back_self().notify(action, EV_DELAYED)
-        self._master_task.timer(handler=ActionEventHandler(action),
-                                fire=action.delay)
+        self._workers[action] = self._master_task.timer(
+                                        handler=ActionEventHandler(action),
+                                        fire=action.delay)
+
+    @staticmethod
+    def _connections(action, fanout):
+        """Number of connections the action would use with this fanout"""
+        if action.target is None or action.mode == 'delegate':
+            return 1
+        return max(1, min(len(action.target), fanout))
+
+    def _within_budget(self, action):
+        """
+        Tell if the action could start without exceeding the budget of its
+        enclosing service groups.
+        """
+        child = action.parent
+        group = child.parent
+        while group is not None:
+            max_cnx = group.connections_budget()
+            if group.max_services or max_cnx is not None:
+                services = set()
+                cnx = self._connections(action, self._budget_fanout(action))
+                for running in self.running_tasks:
+                    # Look for the subservice of group running this action
+                    svc = running.parent
+                    while svc is not None and svc.parent is not group:
+                        svc = svc.parent
+                    if svc is not None:
+                        services.add(svc)
+                        cnx += self._connections(running,
+                                                 self._task_fanout(running))
+                # Something must always be able to run in the group
+                if services:
+                    if group.max_services and child not in services and \
+                       len(services) >= group.max_services:
+                        return False
+                    if max_cnx is not None and cnx > max_cnx:
+                        return False
+            child = group
+            group = group.parent
+        return True
+
+    def _budget_fanout(self, action):
+        """Action fanout, limited to its share of its group connections"""
+        fanout = action.fanout or self.default_fanout
+        group = action.parent.parent
+        share = group.connections_share() if group is not None else None
+        if share is not None and share < fanout:
+            return share
+        return fanout
+
+    def _task_fanout(self, task):
+        """Fanout the task runs with: its budget share, or its own one"""
+        fanout = self._shares.get(task) or task.fanout
+        if not fanout or fanout < 1:
+            return self.default_fanout
+        return fanout
+
+    def _release_blocked(self):
+        """Start the blocked actions which are now within budget"""
+        for action in list(self._blocked):
+            if self._within_budget(action):
+                self._blocked.remove(action)
+                self.perform_action(action)
+
+    def record_unreachable(self, action):
+        """
+        Remember nodes of a completed action which timed out or could not
+        be connected (ssh returns 255).
+        """
+        if not self.skip_unreachable or action.worker is None or \
+           action.target is None or action.mode in ('delegate', 'exec'):
+            return
+        self.unreachable.add(action.nodes_timeout())
+        for retcode, nodes in action.worker.iter_retcodes():
+            if retcode == 255:
+                self.unreachable.add(nodes)
+
+    def unreachable_in(self, nodes):
+        """Return nodes known as unreachable among the provided ones"""
+        if not self.skip_unreachable:
+            return NodeSet()
+        return self.unreachable & nodes
+
+    def probe(self, nodes, timeout):
+        """
+        Run a trivial command on nodes, with a short connection timeout and
+        a large fanout. Return the nodes which did not answer.
+        """
+        task = self._master_task
+        previous = (task.info('fanout'), task.info('connect_timeout'))
+        task.set_info('fanout', max(self.probe_fanout, self.default_fanout))
+        task.set_info('connect_timeout', timeout)
+        try:
+            worker = task.shell(':', nodes=nodes, timeout=2 * timeout)
+            task.run()
+        finally:
+            task.set_info('fanout', previous[0])
+            task.set_info('connect_timeout', previous[1])
+        answered = NodeSet.fromlist(nds for rc, nds in worker.iter_retcodes()
+                                    if rc == 0)
+        return NodeSet(nodes) - answered
+
+    def prefetch(self, actions):
+        """
+        Run the commands of read-only actions all at once, without waiting
+        for their dependencies, within the lowest fanout of these actions.
+        Results are replayed when each action is scheduled by the graph.
+        """
+        self._prefetched = {}
+        if self.dryrun or not actions:
+            return
+        task = self._master_task
+        previous = task.info('fanout')
+        task.set_info('fanout', min(action.fanout or self.default_fanout
+                                    for action in actions))
+        try:
+            for action in actions:
+                self._start_worker(action, action.command, action.target,
+                                   PrefetchEventHandler(action,
+                                                        self._prefetched))
+            task.run()
+        finally:
+            task.set_info('fanout', previous)
+
+    def prefetched_result(self, action):
+        """Return the prefetched result of the action for its target."""
+        if action.tries or action not in self._prefetched:
+            return None
+        return self._prefetched.pop(action).restrict(action.target)
+
+    def replay_action(self, action, worker):
+        """Complete the action with the provided result, as if it ran."""
+        action.tries += 1
+        self.add_task(action)
+        call_back_self().notify(action.parent, EV_STARTED)
+        handler = ActionEventHandler(action)
+        handler.ev_start(worker)
+        action.pending_target.clear()
+        handler.ev_close(worker)
+
+    def arm_deadline(self, action):
+        """Abort the action if it is still running after its deadline"""
+        self._master_task.timer(handler=DeadlineEventHandler(action),
+                                fire=action.deadline, autoclose=True)
+
+    def abort_action(self, action, status):
+        """
+        Stop a running action right now and set it to the provided status.
+
+        Nodes where the command did not complete are kept in
+        action.aborted_nodes.
+        """
+        if action.abort_status or \
+           action.status not in (NO_STATUS, WAITING_STATUS):
+            return
+        action.abort_status = status
+        wkr = self._workers.get(action)
+        if action in self._blocked:
+            # Waiting for its group budget, nothing is running yet
+            self._blocked.remove(action)
+            ActionEventHandler(action).ev_close(None)
+        elif isinstance(wkr, (EngineTimer, SimulatedTimer)):
+            # Delayed action, nothing is running yet
+            wkr.invalidate()
+            ActionEventHandler(action).ev_close(None)
+        elif wkr is not None:
+            # This will raise ev_close()
+            wkr.abort()
+
+    def cancel_unneeded(self):
+        """
+        Cancel running actions whose result cannot change the final status
+        anymore, because everything waiting for them is doomed.
+        """
+        memo = {}
+        for action in list(self._workers) + self._blocked:
+            if not action.is_needed(memo):
+                self.abort_action(action, CANCELLED)
+
+    def expire(self):
+        """
+        Run-wide deadline is over: abort everything which is running and
+        do not start anything new.
+        """
+        self.expired = True
+        for action in list(self._workers) + self._blocked:
+            self.abort_action(action, TIMEOUT)
+        # Stop stragglers of actions which reached their quorum
+        for job in list(self._jobs):
+            if job.stragglers:
+                job.abort()
+
+    def stored_result(self, action):
+        """Return a fresh cached result of the action, if any."""
+        if self.cache is None or self.dryrun or action.tries:
+            return None
+        return self.cache.lookup(action)
+
+    def store_result(self, action):
+        """Keep the result of a successful action in cache."""
+        if self.cache is not None and not self.dryrun:
+            self.cache.store(action)
+
+    def command_timeout(self, action):
+        """
+        Return the timeout of the action command. Without explicit timeout,
+        it could be derived from the history of the action.
+        """
+        if action.timeout is None and self.history is not None:
+            return self.history.timeout(action)
+        return action.timeout
+
+    def expected_duration(self, action):
+        """Return the usual duration of the action, None if unknown."""
+        if self.history is None:
+            return None
+        return self.history.expected_duration(action)
+
+    def record_duration(self, action):
+        """Keep durations of a successful action in history."""
+        if self.history is not None and not self.dryrun and \
+           not isinstance(action.worker, StoredWorker):
+            self.history.record(action)
 
     def add_task(self, task):
         """
@@ -126,7 +643,7 @@ class ActionManager(object):
         # Task is not already running
         if not self._is_running_task(task):
             # No fanout or invalid value, fanout gets the default value
-            fnt = task.fanout or self.default_fanout
+            fnt = self._task_fanout(task)
             # Create the category if it does not exist
             if not fnt in self.entities:
                 self.entities[fnt] = set()
@@ -148,9 +665,10 @@ class ActionManager(object):
         # Task given as parameter is not already running
         if self._is_running_task(task):
             # Checkout the right value for the fanout
-            fnt = task.fanout or self.default_fanout
+            fnt = self._task_fanout(task)
             # Remove task
             self.entities[fnt].remove(task)
+            self._shares.pop(task, None)
             call_back_self().notify(task.parent, EV_COMPLETE)
 
             # Category is empty so we delete it and we update
@@ -164,6 +682,9 @@ class ActionManager(object):
                     self.fanout = None
             # Current number of task is decremented
             self._tasks_count -= 1
+        self._workers.pop(task, None)
+        self._release_blocked()
+        self.dispatch_jobs()
         if not self.tasks_count:
             call_back_self().notify(task.parent, EV_FINISHED)
 
@@ -172,14 +693,21 @@ class ActionManager(object):
         Allow us to determine whether a task is running or not
         """
         assert task, 'Task cannot be None'
-        if not task.fanout or task.fanout < 1:
-            return task in self.entities.get(self.default_fanout, [])
-        return task in self.entities.get(task.fanout, [])
+        return task in self.entities.get(self._task_fanout(task), [])
 
     def run(self):
         """ Run the action manager task"""
         if not self._master_task.running():
+            self.expired = False
+            if self.deadline:
+                self._master_task.timer(handler=DeadlineEventHandler(),
+                                        fire=self.deadline, autoclose=True)
             self._master_task.run()
+            if self.cache is not None:
+                self.cache.save()
+            if self.history is not None:
+                self.history.save()
+            self._dedup = DedupRegistry()
 
     @property
     def running_tasks(self):
@@ -225,12 +753,24 @@ class MilkCheckEventHandler(EventHandler):
         assert action, "should not be be None"
         # Current action hooked to the handler
         self._action = action
+        # Time when the command was started on each node
+        self._pickups = {}
 
     def ev_start(self, worker):
         '''Command has been started on a nodeset'''
         if not self._action.parent.simulate:
             call_back_self().notify(self._action, EV_STARTED)
 
+    def ev_pickup(self, worker):
+        '''Command has been started on a node'''
+        self._pickups[worker.current_node] = time.time()
+
+    def _node_duration(self, node):
+        '''Record how long the command ran on the node'''
+        if self._action.target and node in self._pickups:
+            self._action.node_durations[node] = \
+                                    time.time() - self._pickups.pop(node)
+
     def ev_timer(self, timer):
         '''
         A timer event is raised when an action was delayed. Now the timer is
@@ -239,8 +779,83 @@ class MilkCheckEventHandler(EventHandler):
         it does nothing
         '''
         self._action.schedule(allow_delay=False)
-       
-        
+
+
+class DeadlineEventHandler(EventHandler):
+    '''
+    Handler of deadline timers. Without action, the run-wide deadline is
+    over, otherwise only the action deadline is.
+    '''
+
+    def __init__(self, action=None):
+        EventHandler.__init__(self)
+        self._action = action
+
+    def ev_timer(self, timer):
+        '''Deadline is over, abort what is still running'''
+        if self._action is None:
+            action_manager_self().expire()
+        else:
+            action_manager_self().abort_action(self._action, TIMEOUT)
+
+
+class DispatchEventHandler(EventHandler):
+    '''
+    Handler of the timer dispatching the jobs started at the same time.
+    '''
+
+    def ev_timer(self, timer):
+        '''Launch nodes of the waiting jobs'''
+        action_manager_self().dispatch_jobs()
+
+
+class PrefetchEventHandler(EventHandler):
+    '''
+    Handler of the workers running a read-only action ahead of the graph.
+    '''
+
+    def __init__(self, action, results):
+        EventHandler.__init__(self)
+        self._action = action
+        self._results = results
+
+    def ev_close(self, worker):
+        '''Keep the results until the action is scheduled'''
+        self._results[self._action] = StoredWorker.fromworker(worker)
+
+
+class JobEventHandler(MilkCheckEventHandler):
+    '''
+    Handler of the workers running a part of an ActionJob.
+    '''
+
+    def __init__(self, job):
+        MilkCheckEventHandler.__init__(self, job.action)
+        self._job = job
+
+    def ev_start(self, worker):
+        '''Only the first worker of the job is notified'''
+        if not self._job.started:
+            self._job.started = True
+            MilkCheckEventHandler.ev_start(self, worker)
+
+    def ev_hup(self, worker):
+        '''Update remaining target and use the free slot'''
+        self._node_duration(worker.current_node)
+        self._action.pending_target.difference_update(worker.current_node)
+        self._job.node_done(worker, worker.current_node,
+                            worker.current_rc != 0)
+        if worker.current_rc == 0:
+            action_manager_self().node_succeeded(self._action,
+                                                 worker.current_node)
+        action_manager_self().dispatch_jobs()
+
+    def ev_close(self, worker):
+        '''This part of the job is over'''
+        self._job.worker_done(worker)
+        action_manager_self().dispatch_jobs()
+
+
 class ActionEventHandler(MilkCheckEventHandler):
     '''
     Inherit from our basic handler and specify others event raised to
@@ -249,7 +864,11 @@ class ActionEventHandler(MilkCheckEventHandler):
     
     def ev_hup(self, worker):
         '''Update remaining target'''
+        self._node_duration(worker.current_node)
         self._action.pending_target.remove(worker.current_node)
+        if self._action.target and worker.current_rc == 0:
+            action_manager_self().node_succeeded(self._action,
+                                                 worker.current_node)
 
     def ev_close(self, worker):
         '''
@@ -263,16 +882,32 @@ class ActionEventHandler(MilkCheckEventHandler):
         # a redefinition of the current fanout
         action_manager_self().remove_task(self._action)
 
-        # Get back the worker from ClusterShell
-        self._action.worker = worker
+        # Get back the worker from ClusterShell (None if it never started)
+        if worker is not None:
+            self._action.worker = worker
+
+        # Action was aborted by the engine, its status is already known
+        if self._action.abort_status:
+            self._action.abort(self._action.abort_status)
+            return
+
+        action_manager_self().record_unreachable(self._action)
+
+        # A required upstream action failed while nodes were pipelined
+        if self._action.upstream_failed:
+            self._action.filter_nodes(self._action.nodes_error() |
+                                      self._action.nodes_timeout())
+            self._action.update_status(DEP_ERROR)
+            return
 
         # Checkout actions issues
         errors = self._action.nb_errors()
         timeouts = self._action.nb_timeout()
-        failed = errors + timeouts
+        failed = errors + timeouts + len(self._action.aborted_nodes)
 
         # Classic Action was failed
         if failed and self._action.tries <= self._action.maxretry:
+            self._action.aborted_nodes = NodeSet()
             self._action.schedule()
             return
 
@@ -280,7 +915,8 @@ class ActionEventHandler(MilkCheckEventHandler):
         # propagation if required. Local action does not filter.
         if self._action.target is not None:
             nodes = self._action.nodes_error() | self._action.nodes_timeout()
-            self._action.filter_nodes(nodes)
+            self._action.filter_nodes(nodes | self._action.aborted_nodes |
+                                      self._action.straggler_nodes)
 
         # timeout when more timeouts than permited
         if timeouts > self._action.errors and errors == 0:
@@ -293,8 +929,25 @@ class ActionEventHandler(MilkCheckEventHandler):
         elif failed > self._action.warnings:
             self._action.update_status(WARNING)
         else:
+            action_manager_self().store_result(self._action)
+            action_manager_self().record_duration(self._action)
             self._action.update_status(DONE)
 
+class DedupEventHandler(ActionEventHandler):
+    '''
+    Handler of the workers running a part of a DedupRun.
+    '''
+
+    def __init__(self, run, nodes):
+        ActionEventHandler.__init__(self, run.action)
+        self._run = run
+        self._nodes = nodes
+
+    def ev_close(self, worker):
+        '''Share the results with the actions waiting for them'''
+        action_manager_self().dedup_worker_done(self._run, worker,
+                                                self._nodes)
+
 class Action(BaseEntity):
     """
     This class models an action. An action is generally hooked to a service
@@ -305,6 +958,18 @@ class Action(BaseEntity):
     LOCAL_VARIABLES = BaseEntity.LOCAL_VARIABLES.copy()
     LOCAL_VARIABLES['ACTION'] = 'name'
 
+    tries = run_state('tries')
+    worker = run_state('worker')
+    start_time = run_state('start_time')
+    stop_time = run_state('stop_time')
+    abort_status = run_state('abort_status')
+    aborted_nodes = run_state('aborted_nodes')
+    straggler_nodes = run_state('straggler_nodes')
+    unreachable_nodes = run_state('unreachable_nodes')
+    node_durations = run_state('node_durations')
+    done_nodes = run_state('done_nodes')
+    upstream_failed = run_state('upstream_failed')
+
     def __init__(self, name, target=None, command=None, timeout=None, delay=0):
         BaseEntity.__init__(self, name=name, target=target, delay=delay)
 
@@ -327,15 +992,56 @@ class Action(BaseEntity):
         # Store pending targets
         self.pending_target = NodeSet()
 
-    def reset(self):
+        # Status forced by the engine when it aborts the action
+        self.abort_status = None
+
+        # Nodes where the command was aborted or never started
+        self.aborted_nodes = NodeSet()
+
+        # Results could be reused from the result cache
+        self.cacheable = False
+
+        # Split target in waves, None means all nodes at once
+        self.waves = None
+
+        # Percentage of target nodes which should complete before computing
+        # the action status, None means all of them
+        self.quorum = None
+
+        # Nodes still running when the quorum was reached
+        self.straggler_nodes = NodeSet()
+
+        # Nodes removed from target as found unreachable earlier in the run
+        self.unreachable_nodes = NodeSet()
+
+        # Time the command ran on each node, in seconds
+        self.node_durations = {}
+
+        # Nodes where the command succeeded during this run
+        self.done_nodes = NodeSet()
+
+        # Command does not change anything, it could run ahead of the graph
+        self.readonly = False
+
+        # Set when a required upstream action failed while pipelined
+        self.upstream_failed = False
+
+    def _reset_run(self):
         '''
         Reset values of attributes in order to used the action multiple time.
         '''
-        BaseEntity.reset(self)
+        BaseEntity._reset_run(self)
         self.start_time = None
         self.stop_time = None
         self.worker = None
         self.tries = 0
+        self.abort_status = None
+        self.aborted_nodes = NodeSet()
+        self.straggler_nodes = NodeSet()
+        self.unreachable_nodes = NodeSet()
+        self.node_durations = {}
+        self.done_nodes = NodeSet()
+        self.upstream_failed = False
 
     def run(self):
         '''Prepare the current action and set up the master task'''
@@ -351,6 +1057,11 @@ class Action(BaseEntity):
         """Tell if action has an empty target list and should be skipped."""
         return (self.target != None and len(self.target) == 0)
 
+    def _target_changed(self):
+        '''An empty target skips the action, the service groups should know.'''
+        if self.parent is not None:
+            self.parent._actions_changed()
+
     def prepare(self):
         '''
         Prepare is a recursive method allowing the current action to prepare
@@ -362,9 +1073,21 @@ class Action(BaseEntity):
         # NO_STATUS and not any dep in progress for the current action
         if self.status is NO_STATUS and deps_status is not WAITING_STATUS:
 
-            # Remove nodes marked on error by our filter dependencies
+            # Remove nodes marked on error by our filter dependencies, or
+            # those of the groups enclosing our service
             if self.target:
-                self.target -= self.parent.failed_nodes
+                failed = self.parent.scope_failed_nodes()
+                if failed:
+                    self._own_target().difference_update(failed)
+                    self._target_changed()
+
+                # Do not wait for nodes already found unreachable
+                unreachable = action_manager_self().unreachable_in(self.target)
+                if unreachable:
+                    self._own_target().difference_update(unreachable)
+                    self._target_changed()
+                    self.unreachable_nodes.add(unreachable)
+                    self.filter_nodes(unreachable)
 
             if self.to_skip():
                 self.update_status(SKIPPED)
@@ -381,6 +1104,10 @@ class Action(BaseEntity):
                 for dep in deps:
                     dep.target.prepare()
 
+    def is_needed(self, memo=None):
+        '''Action result matters as long as its service result does.'''
+        return self.parent.is_needed(memo)
+
     def update_status(self, status):
         '''
         This method update the current status of an action. Whether the
@@ -390,6 +1117,7 @@ class Action(BaseEntity):
         self.status = status
         call_back_self().notify(self, EV_STATUS_CHANGED)
         if status not in (NO_STATUS, WAITING_STATUS):
+            action_manager_self().upstream_done(self)
             if not self.parent.simulate:
                 call_back_self().notify(self, EV_COMPLETE)
             if self.children:
@@ -405,6 +1133,31 @@ class Action(BaseEntity):
                 self.parent.filter_nodes(self.failed_nodes)
                 self.parent.update_status(self.status)
 
+    def abort(self, status):
+        '''
+        Terminate the action with the provided status, without waiting for
+        its command. Nodes which did not complete are considered as failed.
+        '''
+        self.stop_time = time.time()
+        self.abort_status = status
+        if self.target is not None:
+            self.aborted_nodes.add(self.pending_target)
+            self.pending_target.clear()
+            self.filter_nodes(self.nodes_error() | self.nodes_timeout() |
+                              self.aborted_nodes)
+        self.update_status(status)
+
+    def replay(self, worker):
+        '''Complete the action with results of a previous run.'''
+        self.worker = worker
+        self.stop_time = time.time()
+        self.pending_target.clear()
+        # Nodes which failed within the thresholds are filtered again,
+        # like those without result (aborted or stragglers)
+        self.filter_nodes(self.nodes_error() | self.nodes_timeout() |
+                          NodeSet(self.target).difference(worker.nodes()))
+        self.update_status(DONE)
+
     def nodes_timeout(self):
         """Get nodeset of timeout nodes for this action."""
         if self.worker:
@@ -455,9 +1208,33 @@ class Action(BaseEntity):
         '''
         if not self.start_time:
             self.start_time = time.time()
+            if self.deadline:
+                action_manager_self().arm_deadline(self)
 
         self.pending_target.add(self.target)
 
+        # Run-wide deadline is over, do not start anything new
+        if action_manager_self().expired:
+            self.abort(TIMEOUT)
+            return
+
+        # Do not start something whose result cannot matter
+        if action_manager_self().failfast and not self.is_needed():
+            self.abort(CANCELLED)
+            return
+
+        # A fresh enough result is already known
+        stored = action_manager_self().stored_result(self)
+        if stored is not None:
+            self.replay(stored)
+            return
+
+        # Read-only command which already ran ahead of the graph
+        prefetched = action_manager_self().prefetched_result(self)
+        if prefetched is not None:
+            action_manager_self().replay_action(self, prefetched)
+            return
+
         if self.delay > 0 and allow_delay:
             # Action will be started as soon as the timer is done
             action_manager_self().perform_delayed_action(self)
@@ -472,6 +1249,14 @@ class Action(BaseEntity):
 
         if 'cmd' in actdict:
             self.command = actdict['cmd']
+        if 'cacheable' in actdict:
+            self.cacheable = actdict['cacheable']
+        if 'waves' in actdict:
+            self.waves = actdict['waves']
+        if 'quorum' in actdict:
+            self.quorum = actdict['quorum']
+        if 'readonly' in actdict:
+            self.readonly = actdict['readonly']
 
     def resolve_all(self):
         """Resolve all properties from the entity"""
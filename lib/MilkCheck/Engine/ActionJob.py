@@ -0,0 +1,278 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""
+This module contains the ActionJob and MergedWorker classes definition.
+
+An ActionJob runs the command of an action over its target with several
+ClusterShell workers, each one on a part of the target, so the
+ActionManager could decide how many nodes of each action are running and
+the target could be run by waves.
+"""
+
+from ClusterShell.NodeSet import NodeSet
+
+
+class MergedWorker(object):
+    """
+    Gather the results of several ClusterShell workers, with the same
+    interface as a single distant worker.
+    """
+
+    def __init__(self, command, target):
+        self.command = command
+        self.workers = []
+        self._target = target
+
+    @property
+    def current_node(self):
+        """Last node which was processed"""
+        for worker in reversed(self.workers):
+            if worker.current_node is not None:
+                return worker.current_node
+        return self._target[-1]
+
+    def iter_buffers(self):
+        """Iterate over (output, nodes), for all workers."""
+        outputs = {}
+        for worker in self.workers:
+            for buf, keys in worker.iter_buffers():
+                outputs.setdefault(bytes(buf), NodeSet()).update(keys)
+        return iter(outputs.items())
+
+    def iter_retcodes(self):
+        """Iterate over (retcode, nodes), for all workers."""
+        retcodes = {}
+        for worker in self.workers:
+            for retcode, keys in worker.iter_retcodes():
+                retcodes.setdefault(retcode, NodeSet()).update(keys)
+        return iter(retcodes.items())
+
+    def iter_keys_timeout(self):
+        """Iterate over timed out nodes, for all workers."""
+        for worker in self.workers:
+            for key in worker.iter_keys_timeout():
+                yield key
+
+
+def split_waves(target, waves):
+    """
+    Split target into consecutive waves, according to the `waves' setting
+    of an action: either a wave 'size', a 'count' of waves or a 'percent'
+    of the target per wave.
+    """
+    if not waves:
+        return [target]
+    if 'size' in waves:
+        size = int(waves['size'])
+    elif 'count' in waves:
+        size = -(-len(target) // int(waves['count']))
+    elif 'percent' in waves:
+        size = int(len(target) * float(waves['percent']) / 100)
+    else:
+        return [target]
+    size = max(1, size)
+    return [target[idx:idx + size] for idx in range(0, len(target), size)]
+
+
+class ActionJob(object):
+    """
+    Track the execution of an action whose target is run in several parts.
+
+    The target is released by waves (only one wave without `waves'
+    setting). The next wave is released when the current one is drained
+    enough, and no more wave is released when one of them has too many
+    errors.
+
+    `done' is called with the job as soon as all nodes have completed or
+    the job is aborted. If the action has a quorum, `quorum' is called once
+    with the job when enough nodes have completed, while others are still
+    running.
+
+    `held' nodes are kept out of the waves, waiting for feed(), until their
+    upstream nodes are ready (pipeline).
+    """
+
+    def __init__(self, action, command, done, quorum=None, held=None):
+        self.action = action
+        self.command = command
+        self._done = done
+        self._quorum = quorum
+        # Count of completed nodes needed to reach the quorum
+        self._quorum_count = None
+        if action.quorum is not None:
+            self._quorum_count = -(-len(action.target) *
+                                   float(action.quorum) // 100)
+        target = NodeSet(action.target)
+        # Nodes waiting for feed()
+        self.waiting = NodeSet(held)
+        # Upstream actions of a pipelined job, with their dependency type
+        self.upstreams = {}
+        waves = action.waves or {}
+        # Waves not released yet
+        self._waves = split_waves(target - self.waiting, waves) or [NodeSet()]
+        # Percentage of a wave still running when the next one is released
+        self._overlap = float(waves.get('overlap', 0))
+        # Max failed nodes in a wave before stopping
+        self._max_errors = waves.get('errors')
+        # Completed and failed node counts, per wave
+        self._wave_of = {}
+        self._sizes = []
+        self._completed = []
+        self._failed = []
+        # Nodes not launched yet
+        self.remaining = NodeSet()
+        # Nodes never launched because of a wave with too many errors
+        self.skipped = NodeSet()
+        # Running workers and their running nodes
+        self._running = {}
+        self.worker = MergedWorker(command, target)
+        self.started = False
+        self.finished = False
+        # Set when the action completed with its quorum, before the job
+        self.stragglers = False
+        self._release()
+        self._release_next()
+
+    @property
+    def inflight(self):
+        """Count of nodes currently running"""
+        return sum(len(nodes) for nodes in self._running.values())
+
+    @property
+    def demand(self):
+        """Count of nodes running or waiting to be launched"""
+        return self.inflight + len(self.remaining)
+
+    def _release(self):
+        """Make the next wave available to launch."""
+        wave = self._waves.pop(0)
+        for node in wave:
+            self._wave_of[node] = len(self._sizes)
+        self._sizes.append(len(wave))
+        self._completed.append(0)
+        self._failed.append(0)
+        self.remaining.update(wave)
+
+    def _node_completed(self, node, failed):
+        """
+        Update wave progress and release or stop next waves. Check if the
+        quorum is reached.
+        """
+        wave = self._wave_of[node]
+        self._completed[wave] += 1
+        if failed:
+            self._failed[wave] += 1
+            if self._max_errors is not None and \
+               self._failed[wave] > self._max_errors:
+                # Something is broken, do not go further
+                for nodes in [self.remaining] + self._waves:
+                    self.skipped.update(nodes)
+                self.remaining.clear()
+                self._waves = []
+        self._release_next()
+        if self._quorum_count is not None and \
+           sum(self._completed) >= self._quorum_count and \
+           (self.inflight or self.remaining or self._waves or self.waiting):
+            # Only once
+            self._quorum_count = None
+            self._quorum(self)
+
+    def _release_next(self):
+        """Release next waves as long as the last one is drained enough."""
+        while self._waves:
+            last = len(self._sizes) - 1
+            running = self._sizes[last] - self._completed[last]
+            if running * 100 > self._sizes[last] * self._overlap:
+                break
+            self._release()
+
+    @property
+    def idle(self):
+        """Tell if the job has nothing left to run"""
+        return not (self._running or self.remaining or self._waves or
+                    self.waiting or self.finished)
+
+    def feed(self, nodes):
+        """Waiting nodes are ready, launch them with the current wave."""
+        nodes = self.waiting & nodes
+        if nodes:
+            self.waiting.difference_update(nodes)
+            wave = len(self._sizes) - 1
+            for node in nodes:
+                self._wave_of[node] = wave
+            self._sizes[wave] += len(nodes)
+            self.remaining.update(nodes)
+        return nodes
+
+    def drop(self, nodes):
+        """Waiting nodes will never be ready, forget them."""
+        self.waiting.difference_update(nodes)
+
+    def take(self, count):
+        """Remove and return the next `count' nodes to launch."""
+        nodes = self.remaining[0:count]
+        self.remaining.difference_update(nodes)
+        return nodes
+
+    def add_worker(self, worker, nodes):
+        """Register a worker just started on these nodes."""
+        self.worker.workers.append(worker)
+        self._running[worker] = NodeSet(nodes)
+
+    def node_done(self, worker, node, failed=False):
+        """One node of the worker has completed."""
+        self._running[worker].remove(node)
+        self._node_completed(node, failed)
+
+    def worker_done(self, worker):
+        """The worker has completed, finish the job if it was the last one."""
+        # Nodes without result timed out or were aborted
+        for node in self._running.pop(worker, NodeSet()):
+            self._node_completed(node, True)
+        if not self._running and not self.remaining and not self.waiting:
+            self.finish()
+
+    def finish(self):
+        """Tell the job is over (only once)."""
+        if not self.finished:
+            self.finished = True
+            self._done(self)
+
+    def abort(self):
+        """Stop launching nodes and abort the running workers."""
+        self.remaining.clear()
+        self.waiting.clear()
+        self._waves = []
+        for worker in list(self._running):
+            worker.abort()
+        if not self._running:
+            self.finish()
@@ -38,6 +38,7 @@ import re
 import logging
 from subprocess import Popen, PIPE
 from ClusterShell.NodeSet import NodeSet
+from MilkCheck.Engine.TargetTable import target_table_self, TEXT_TYPES
 
 # Status available for an entity
 
@@ -73,6 +74,9 @@ SKIPPED = 'SKIPPED'
 # Action is missing for this service and it was ignored
 MISSING = 'MISSING'
 
+# Action was cancelled because its result can no longer matter
+CANCELLED = 'CANCELLED'
+
 DEP_ORDER = {
      DEP_ERROR      : 10,
      WAITING_STATUS : 9,
@@ -145,12 +149,16 @@ class Dependency(object):
     two objects whithout considering their types.
     '''
 
-    def __init__(self, target, dtype=REQUIRE, intr=False):
+    def __init__(self, target, dtype=REQUIRE, intr=False, action=None):
 
         # Object pointed by the dependency
         assert target, "Dependency target shall not be None"
         self.target = target
 
+        # Action the target runs within another graph, which launches it.
+        # None means the target runs the action of the source.
+        self.action = action
+
         # Define the type of the dependency
         assert dtype in (CHECK, REQUIRE, REQUIRE_WEAK, FILTER), \
             "Invalid dependency identifier"
@@ -183,7 +191,7 @@ class Dependency(object):
 
     def status(self):
         """Give entity status from a dependency point of view."""
-        if self.target.status in (ERROR, TIMEOUT, DEP_ERROR):
+        if self.target.status in (ERROR, TIMEOUT, DEP_ERROR, CANCELLED):
             if self.is_strong():
                 return DEP_ERROR
             else:
@@ -191,15 +199,18 @@ class Dependency(object):
         else:
             return self.target.status
 
-    def graph(self, source):
-        """ Return DOT dependencies output for the given source"""
+    def graph(self, source, collapse=False):
+        """
+        Return DOT dependencies output for the given source. With collapse,
+        groups are single nodes instead of clusters.
+        """
         tgt = self.target
         src = source
 
-        dep_str = '"%s" -> "%s"' % (src.graph_info()[0],
-                                    tgt.graph_info()[0])
-        ginfo_target = tgt.graph_info()[1]
-        ginfo_source = src.graph_info()[1]
+        dep_str = '"%s" -> "%s"' % (src.graph_info(collapse)[0],
+                                    tgt.graph_info(collapse)[0])
+        ginfo_target = tgt.graph_info(collapse)[1]
+        ginfo_source = src.graph_info(collapse)[1]
         options = []
         if self.is_weak():
             options.append("style=dashed")
@@ -214,6 +225,26 @@ class Dependency(object):
 
         return dep_str
 
+def run_state(name):
+    '''
+    Return a property for the per-run attribute `name'. The entity resets
+    its run state (see BaseEntity._reset_run()) when such an attribute is
+    used for the first time during a new run.
+    '''
+    attr = '_run_%s' % name.lstrip('_')
+
+    def _get(self):
+        if self._run_generation != BaseEntity.run_generation:
+            self._new_run()
+        return self.__dict__[attr]
+
+    def _set(self, value):
+        if self._run_generation != BaseEntity.run_generation:
+            self._new_run()
+        self.__dict__[attr] = value
+
+    return property(_get, _set)
+
 class BaseEntity(object):
     '''
     This class is abstract and shall not be instanciated.
@@ -230,7 +261,17 @@ class BaseEntity(object):
         'TAGS':    'tags',
     }
 
+    # Current run, entities of an older run are reset when used
+    run_generation = 0
+
+    status = run_state('status')
+    failed_nodes = run_state('failed_nodes')
+    _tagged = run_state('_tagged')
+
     def __init__(self, name, target=None, delay=0):
+        # Run the per-run attributes belong to
+        self._run_generation = BaseEntity.run_generation
+
         # Entity name
         self.name = name
 
@@ -245,8 +286,13 @@ class BaseEntity(object):
         # ClusterShell 64
         self.fanout = None
 
-        # Nodes on which the entity is launched
+        # Parent of the current object. Must be a subclass of BaseEntity
+        self.parent = None
+
+        # Nodes on which the entity is launched, the nodeset could be
+        # shared with other entities (see _own_target())
         self._target = None
+        self._target_shared = False
         self.target = target
         self._target_backup = self.target
 
@@ -266,6 +312,10 @@ class BaseEntity(object):
         # Max time allowed to compute an entity, None means no timeout
         self.timeout = None
 
+        # Max time allowed for an action, including all its retries and
+        # delays. None means no deadline.
+        self.deadline = None
+
         # Delay to wait before launching an action
         self.delay = delay
 
@@ -273,15 +323,17 @@ class BaseEntity(object):
 
         self.failed_nodes = NodeSet()
 
-        # Parent of the current object. Must be a subclass of BaseEntity
-        self.parent = None
-
         # Parents dependencies (e.g A->B so B is the parent of A)
         self.parents = {}
 
         # Children dependencies (e.g A<-B) so A is a child of B)
         self.children = {}
 
+        # Dependencies and consumers in the normal then in the reverse
+        # direction, see deps() and consumers()
+        self._adjacency = ((self.parents, self.children),
+                           (self.children, self.parents))
+
         self.simulate = False
 
         # Agorithm's direction used
@@ -337,29 +389,81 @@ class BaseEntity(object):
         if not mode:
             self.target = NodeSet(nodeset)
         elif mode == 'DIF' and self.target:
-            self.target.difference_update(nodeset)
+            self._own_target().difference_update(nodeset)
+            self._target_changed()
         elif mode == 'INT' and self.target:
-            self.target.intersection_update(nodeset)
+            self._own_target().intersection_update(nodeset)
+            self._target_changed()
 
     def _get_target(self):
         '''Return self._target'''
+        if self._run_generation != BaseEntity.run_generation:
+            self._new_run()
         return self._target
 
     def _set_target(self, value):
         '''Assign nodeset to _target'''
+        if self._run_generation != BaseEntity.run_generation:
+            self._new_run()
         self._target = None
+        self._target_shared = False
         if value is not None:
-            self._target = NodeSet(self._resolve(value))
+            value = self._resolve(value)
+            table = target_table_self()
+            if isinstance(value, TEXT_TYPES) or table.is_shared(value):
+                self._target = table.nodeset(value)
+                self._target_shared = True
+            else:
+                self._target = NodeSet(value)
+        self._target_changed()
 
     target = property(fset=_set_target, fget=_get_target)
 
+    def _own_target(self):
+        '''
+        Return the target to be modified in place. It is copied first if
+        it is shared with other entities or with the backup used by reset().
+        '''
+        if self._target_shared or self._target is self._target_backup:
+            self._target = NodeSet(self._target)
+            self._target_shared = False
+        return self._target
+
+    def _target_changed(self):
+        '''The target was modified, in place or not.'''
+
+    def _actions_changed(self):
+        '''
+        Actions of the entity or of its subservices, or their targets,
+        changed: enclosing groups should update what they know about them.
+        '''
+        if self.parent is not None:
+            self.parent._actions_changed()
+
     def reset(self):
         '''Reset values of attributes in order to perform multiple exec.'''
+        self._reset_run()
+        self.algo_reversed = False
+
+    @staticmethod
+    def new_run():
+        '''
+        Start a new run: instead of being reset all at once, each entity
+        resets its run state when it is used for the first time.
+        '''
+        BaseEntity.run_generation += 1
+
+    def _new_run(self):
+        '''Join the current run, forgetting the state of the previous one'''
+        self._run_generation = BaseEntity.run_generation
+        self._reset_run()
+
+    def _reset_run(self):
+        '''Reset the attributes of the entity set during a run.'''
         self._tagged = False
         self.target = self._target_backup
         self.status = NO_STATUS
         self.failed_nodes = NodeSet()
-        self.algo_reversed = False
 
     def _get_root(self, reverse=False):
         """
@@ -477,10 +581,35 @@ class BaseEntity(object):
 
         Return children deps as parent if algo is reversed.
         """
-        if self._algo_reversed:
-            return self.children
-        else:
-            return self.parents
+        return self._adjacency[self._algo_reversed][0]
+
+    def consumers(self):
+        """
+        Return dependencies to the entities waiting for this one.
+
+        Return parents deps as consumers if algo is reversed.
+        """
+        return self._adjacency[self._algo_reversed][1]
+
+    def is_doomed(self, memo=None):
+        '''
+        Determine if the entity will end on error whatever happens next:
+        it already failed or one of its strong dependencies is doomed.
+        '''
+        if memo is None:
+            memo = {}
+        key = ('doomed', self)
+        if key not in memo:
+            # Protect against dependency loops
+            memo[key] = False
+            if self.status in (ERROR, TIMEOUT, DEP_ERROR, CANCELLED):
+                memo[key] = True
+            elif self.status in (NO_STATUS, WAITING_STATUS):
+                for dep in self.deps().values():
+                    if dep.is_strong() and dep.target.is_doomed(memo):
+                        memo[key] = True
+                        break
+        return memo[key]
 
     def is_ready(self):
         '''
@@ -518,41 +647,66 @@ class BaseEntity(object):
             dep_list = self.deps().values()
             return [dep for dep in dep_list if dep.target.status in symbols]
 
-    def graph_info(self):
+    def graph_info(self, collapse=False):
         """ Return a tuple to manage dependencies output """
         return (self.fullname(), None)
 
     def graph(self, excluded=None):
         """ Generate a graph of dependencies"""
-        grph = ""
+        return ''.join(self.iter_graph(excluded))
+
+    def iter_graph(self, excluded=None, memo=None, collapse=False):
+        """
+        Generate the DOT lines of the graph of dependencies. memo is shared
+        by the entities of the same graph output (see excluded()).
+        """
+        if memo is None:
+            memo = {}
         # If the entity has a no dependency we just return the entity fullname
-        if not self.deps().values():
-            grph += '"%s";\n' % self.fullname()
+        if not self.deps():
+            yield '"%s";\n' % self.fullname()
         else:
             for dep in self.deps().values():
-                if not dep.target.excluded(excluded):
+                if not dep.target.excluded(excluded, memo):
                     if not dep.target.simulate:
-                        grph += dep.graph(self)
+                        yield dep.graph(self, collapse)
                     else:
-                        grph += '"%s";\n' % self.fullname()
-        return grph
-
-    def excluded(self, excluded=None):
-        """Is the entity ecluded recusively"""
-        if not excluded:
-            return False
-        if not self.deps().values():
-            return self.fullname() in excluded
-
-        # FIXME: Better loop detection
-        if self.search(self.name):
-            return True
+                        yield '"%s";\n' % self.fullname()
 
+    def iter_edges(self, excluded=None, memo=None, collapse=False):
+        """
+        Generate (entity, None) for the entity, then (entity, dependency)
+        for each of its dependencies shown in the graph.
+        """
+        if memo is None:
+            memo = {}
+        yield self, None
         for dep in self.deps().values():
-            if dep.target.excluded(excluded):
-                return True
+            if not dep.target.excluded(excluded, memo) and \
+               not dep.target.simulate:
+                yield self, dep
 
-        return self.fullname() in excluded
+    def excluded(self, excluded=None, memo=None):
+        """
+        Is the entity excluded recursively: it is or one of its
+        dependencies is. Entities on a dependency loop are excluded too.
+        Results are kept in memo, which could be shared between calls.
+        """
+        if not excluded:
+            return False
+        if memo is None:
+            memo = {}
+        key = ('excluded', self)
+        if key not in memo:
+            # Reaching it again while walking its dependencies is a loop
+            memo[key] = True
+            result = self.fullname() in excluded
+            for dep in self.deps().values():
+                if result:
+                    break
+                result = dep.target.excluded(excluded, memo)
+            memo[key] = result
+        return memo[key]
 
     def eval_deps_status(self):
         '''
@@ -722,6 +876,8 @@ class BaseEntity(object):
         self.warnings = self.warnings or entity.warnings
         if self.timeout is None:
             self.timeout = entity.timeout
+        if self.deadline is None:
+            self.deadline = entity.deadline
         if self.target is None:
             self.target = entity.target
         self.mode = self.mode or entity.mode
@@ -746,6 +902,8 @@ class BaseEntity(object):
                 self.fanout = prop
             elif item == 'timeout':
                 self.timeout = prop
+            elif item == 'deadline':
+                self.deadline = prop
             elif item == 'delay':
                 self.delay = prop
             elif item == 'retry':
@@ -771,7 +929,8 @@ class BaseEntity(object):
 
         # Resolve properties
         properties = ['fanout', 'maxretry', 'errors', 'warnings', 'timeout',
-                      'delay', 'target', '_target_backup', 'mode', 'desc']
+                      'deadline', 'delay', 'target', '_target_backup', 'mode',
+                      'desc']
         for item in properties:
             setattr(self, item, self._resolve(getattr(self, item)))
             if item == 'target':
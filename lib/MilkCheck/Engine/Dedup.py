@@ -0,0 +1,155 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+"""
+This module contains the DedupRun and DedupRegistry classes definition.
+
+Several actions could run the same resolved command on the same nodes
+during a run, typically the same check reached through several groups.
+The registry runs each (command, node) pair only once and shares its
+result between all actions which asked for it.
+"""
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.ActionJob import MergedWorker
+from MilkCheck.Engine.ResultCache import StoredWorker
+
+
+class DedupRun(object):
+    """
+    Track an action whose nodes are run either by its own workers or by
+    other actions running the same command.
+
+    `done' is called with the run as soon as all its nodes have a result.
+    """
+
+    def __init__(self, action, command, key, done):
+        self.action = action
+        self.command = command
+        self.key = key
+        # Own results and results shared by the other actions
+        self.worker = MergedWorker(command, NodeSet(action.target))
+        # Nodes run by other actions, still running
+        self.waiting = NodeSet()
+        # Own workers still running
+        self.running = []
+        self._done = done
+        self.finished = False
+
+    def abort(self):
+        """Stop own workers, without waiting for the others."""
+        self.waiting.clear()
+        if self.running:
+            # This will raise ev_close()
+            for worker in list(self.running):
+                worker.abort()
+        else:
+            self.finish()
+
+    def finish(self):
+        """All nodes have a result (or the run was aborted)."""
+        if not self.finished:
+            self.finished = True
+            self._done(self)
+
+
+class DedupRegistry(object):
+    """
+    Results of the commands run during a run, and nodes where they are
+    still running, by command key.
+    """
+
+    def __init__(self):
+        # Completed results: key -> [StoredWorker, ...]
+        self._results = {}
+        # Running nodes: key -> [(DedupRun, nodes), ...]
+        self._running = {}
+        # Runs waiting for nodes of the others: key -> [DedupRun, ...]
+        self._waiters = {}
+
+    def claim(self, run, nodes):
+        """
+        Share known and running results of the run command with the run.
+        Return the nodes it should run by itself.
+        """
+        nodes = NodeSet(nodes)
+        for stored in self._results.get(run.key, []):
+            known = nodes & stored.nodes()
+            if known:
+                run.worker.workers.append(stored.restrict(known))
+                nodes.difference_update(known)
+        for _, running in self._running.get(run.key, []):
+            run.waiting.update(nodes & running)
+            nodes.difference_update(running)
+        waiters = self._waiters.setdefault(run.key, [])
+        if run.waiting and run not in waiters:
+            waiters.append(run)
+        if nodes:
+            self._running.setdefault(run.key, []).append((run, nodes))
+        return nodes
+
+    def publish(self, run, worker, nodes):
+        """
+        A worker of the run over `nodes' is over: share its results with
+        the waiting runs. Return [(run, nodes), ...] of the runs which got
+        results, with the nodes they should run by themselves as they did
+        not get a result for them.
+        """
+        stored = StoredWorker.fromworker(worker)
+        answered = stored.nodes()
+        run.worker.workers.append(worker)
+        if answered:
+            self._results.setdefault(run.key, []).append(stored)
+        running = self._running.get(run.key, [])
+        running.remove((run, nodes))
+
+        updated = []
+        waiters = self._waiters.get(run.key, [])
+        for other in list(waiters):
+            got = other.waiting & answered
+            lost = other.waiting & (nodes - answered)
+            if not got and not lost:
+                continue
+            if got:
+                other.worker.workers.append(stored.restrict(got))
+            other.waiting.difference_update(got | lost)
+            if not other.waiting:
+                waiters.remove(other)
+            updated.append((other, lost))
+        return updated
+
+    def release(self, run):
+        """The run is over, it is not waiting anymore."""
+        waiters = self._waiters.get(run.key, [])
+        if run in waiters:
+            waiters.remove(run)
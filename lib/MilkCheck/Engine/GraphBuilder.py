@@ -0,0 +1,199 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+"""
+This module contains the GraphBuilder class definition.
+
+ServiceGroup.fromdict() builds a group level by level: it looks for each
+dependency through the whole graph, walks all subservices to bind them to
+the group source and sink, and makes the whole subtree inherit from each
+group. The GraphBuilder builds the same graph from a whole configuration
+with a single pass over it, the results of graph searches being kept in
+an index shared by all groups.
+"""
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.BaseEntity import BaseEntity, UnknownDependencyError
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.ServiceGroup import ServiceGroup, DepWrapper
+
+
+class GraphBuilder(object):
+    """
+    Build the entity graph of a configuration dict into a root group.
+
+    The result is the same than ServiceGroup.fromdict() but the
+    configuration dict is read only once and left unchanged, dependency
+    names are resolved with the rules of BaseEntity.search() but each
+    entity is searched only once per name, and properties are inherited
+    once the graph is complete.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        # Number of services and groups built
+        self.count = 0
+        # Results of graph searches, by entity id and name
+        self._index = {}
+        # Ids of the groups whose subservices are not bound yet
+        self._pending = set()
+
+    def build(self, grpdict):
+        """Populate the root group from grpdict and return it."""
+        self._pending.add(id(self.root))
+        self._build_group(self.root, grpdict)
+        for subservice in self.root.iter_subservices():
+            subservice.inherits_from(self.root)
+        return self.root
+
+    def _search(self, entity, name):
+        """
+        Return the entity found by entity.search(name) for a name without
+        dot, and whether this result is final. A result is final, and
+        kept in the index, unless the search went through a group whose
+        subservices are not bound yet.
+        """
+        key = (id(entity), name)
+        if key in self._index:
+            return self._index[key], True
+        target, final = None, True
+        if isinstance(entity, ServiceGroup):
+            target, final = self._search_parents(entity._source, name)
+            final = final and id(entity) not in self._pending
+        if target is None:
+            target, parents_final = self._search_parents(entity, name)
+            final = final and parents_final
+        if final:
+            self._index[key] = target
+        return target, final
+
+    def _search_parents(self, entity, name):
+        """Search name in the dependencies of entity, see _search()."""
+        if name in entity.parents:
+            return entity.parents[name].target, True
+        final = True
+        for dep in entity.parents.values():
+            target, dep_final = self._search(dep.target, name)
+            final = final and dep_final
+            if target is not None:
+                return target, final
+        return None, final
+
+    def _find(self, entity, name):
+        """
+        Return the entity found by entity.search(name): a dotted name such
+        as 'grp.svc' is looked up from the root group.
+        """
+        if '.' in name and self.root.root:
+            grpname, subname = name.split('.', 1)
+            grp = self._search(self.root, grpname)[0]
+            if grp is not None:
+                return self._find(grp, subname)
+        return self._search(entity, name)[0]
+
+    def _lookup(self, group, name):
+        """
+        Return the dependency called name of a subservice of group, as
+        ServiceGroup.fromdict() does: the group subservices first, then
+        the entity found by searching the graph from the group.
+        """
+        if group.has_subservice(name):
+            return group._subservices[name]
+        target = self._find(group, name)
+        if target is None:
+            raise UnknownDependencyError(name)
+        return target
+
+    def _build_group(self, group, grpdict):
+        """Populate group from grpdict, without inheriting properties."""
+        BaseEntity.fromdict(group, grpdict)
+
+        group._budget_fromdict(grpdict)
+
+        if 'services' not in grpdict:
+            self._pending.discard(id(group))
+            return
+
+        # Build the subservices with their variables, needed to resolve
+        # their dependencies.
+        subservices = []
+        deps = {}
+        for names, props in grpdict['services'].items():
+            # Dependency aliases are renamed in this copy
+            props = dict(props)
+            for name in NodeSet(names):
+                wrap = DepWrapper()
+                wrap.fromdict(props)
+                deps[name] = wrap.deps
+                if 'services' in props:
+                    service = ServiceGroup(name)
+                    self._pending.add(id(service))
+                else:
+                    service = Service(name)
+                group._subservices[name] = service
+                service.parent = group
+                BaseEntity.fromdict(service,
+                                    {'variables': props.get('variables', {})})
+                subservices.append((name, props))
+                self.count += 1
+        group._actions_changed()
+
+        # Link subservices together
+        for name, svcdeps in deps.items():
+            service = group._subservices[name]
+            for dtype, depnames in svcdeps.items():
+                depnames = service._resolve(depnames)
+                # For simplicity, supports deps as a single service
+                if type(depnames) is str:
+                    depnames = [depnames]
+                for depname in depnames:
+                    service.add_dep(self._lookup(group, depname),
+                                    sgth=dtype.upper())
+
+        # Bind subgraph to the group
+        for service in group.iter_subservices():
+            if not service.children:
+                service.add_dep(group._source, parent=False)
+            if not service.parents:
+                service.add_dep(group._sink)
+        self._pending.discard(id(group))
+
+        # Then the subservices properties, variables are already set
+        for name, props in subservices:
+            props = dict((key, value) for key, value in props.items()
+                         if key != 'variables')
+            service = group._subservices[name]
+            if isinstance(service, ServiceGroup):
+                self._build_group(service, props)
+            else:
+                service.fromdict(props)
@@ -0,0 +1,212 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+"""
+This module contains the GroupCache class definition.
+
+Node groups (@group) are often resolved by slow external commands. The
+cache resolves each group once per run, the groups referenced by the
+configuration all at once and concurrently, and could keep them on disk
+for a limited time to share them with the next runs.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from ClusterShell.NodeUtils import GroupResolverError
+
+from MilkCheck.Engine.TargetTable import TEXT_TYPES
+
+# @group or @namespace:group, @* and @@namespace are not cached
+GROUP_RE = re.compile(r'@(?:(\w[\w.\-]*):)?(\w[\w.\-]*)')
+
+
+class GroupCache(object):
+    """
+    Group resolver answering from a table of resolved groups, filled
+    by prefetch() or on demand by the wrapped resolver. It is used as the
+    standard ClusterShell group resolver.
+    """
+
+    # Groups resolved at the same time by prefetch()
+    WORKERS = 8
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.path = None
+        self.ttl = 0
+        # 'namespace:group': {'time': resolution time, 'nodes': [...]}
+        self._groups = {}
+        self._dirty = False
+
+    @staticmethod
+    def key(group, namespace=None):
+        """Table key of the provided group."""
+        return '%s:%s' % (namespace or '', group)
+
+    @staticmethod
+    def config_groups(data):
+        """
+        Return (group, namespace) referenced by the targets and variables
+        of a configuration dict.
+        """
+        texts = []
+        stack = [data]
+        while stack:
+            elem = stack.pop()
+            for name, value in elem.items():
+                if name == 'variables' and isinstance(value, dict):
+                    texts.extend(value.values())
+                elif name == 'target':
+                    texts.append(value)
+                elif isinstance(value, dict):
+                    stack.append(value)
+        return GroupCache.text_groups(texts)
+
+    @staticmethod
+    def text_groups(texts):
+        """
+        Return (group, namespace) referenced by the strings of texts, such
+        as nodesets. Other values are ignored.
+        """
+        groups = set()
+        for text in texts:
+            if isinstance(text, TEXT_TYPES):
+                for namespace, group in GROUP_RE.findall(text):
+                    groups.add((group, namespace or None))
+        return groups
+
+    def load(self, path, ttl):
+        """Read the cache file, keeping groups resolved since `ttl' s."""
+        self.path = path
+        self.ttl = ttl
+        try:
+            with open(path) as cachefile:
+                entries = json.load(cachefile)
+        except (IOError, OSError, ValueError):
+            return
+        now = time.time()
+        for key, entry in entries.items():
+            if key not in self._groups and now - entry['time'] <= ttl:
+                self._groups[key] = entry
+
+    def save(self):
+        """Write the cache file if it is used and was modified."""
+        if self.path is None or not self._dirty:
+            return
+        tmpname = '%s.tmp' % self.path
+        try:
+            with open(tmpname, 'w') as cachefile:
+                json.dump(self._groups, cachefile)
+            os.rename(tmpname, self.path)
+            self._dirty = False
+        except (IOError, OSError) as exc:
+            logging.getLogger('milkcheck').warning(
+                            "Unable to save group cache: %s" % exc)
+
+    def _store(self, key, nodes):
+        """Keep the nodes of a resolved group."""
+        self._groups[key] = {'time': time.time(), 'nodes': list(nodes)}
+        self._dirty = True
+
+    def prefetch(self, groups):
+        """
+        Resolve the provided (group, namespace) which are not known yet,
+        concurrently. Groups which could not be resolved are left to be
+        resolved on demand, which reports the error.
+        """
+        todo = [(group, namespace) for group, namespace in set(groups)
+                if self.key(group, namespace) not in self._groups]
+        if not todo:
+            return
+        logger = logging.getLogger('milkcheck')
+        results = {}
+
+        def _resolve(pending):
+            '''Resolve pending groups until none is left.'''
+            while True:
+                try:
+                    group, namespace = pending.pop()
+                except IndexError:
+                    return
+                try:
+                    results[self.key(group, namespace)] = \
+                        self.resolver.group_nodes(group, namespace)
+                except GroupResolverError as exc:
+                    logger.debug("Unable to prefetch @%s: %s", group, exc)
+
+        start = time.time()
+        count = len(todo)
+        # The first resolution reads the group sources configuration
+        _resolve([todo.pop()])
+        threads = [threading.Thread(target=_resolve, args=(todo,))
+                   for _ in range(min(self.WORKERS, len(todo)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for key, nodes in results.items():
+            self._store(key, nodes)
+        logger.debug("%d node groups resolved in %.2fs", count,
+                     time.time() - start)
+
+    def group_nodes(self, group, namespace=None):
+        """Find nodes for specified group name and optional namespace."""
+        key = self.key(group, namespace)
+        if key not in self._groups:
+            self._store(key, self.resolver.group_nodes(group, namespace))
+        return list(self._groups[key]['nodes'])
+
+    def __deepcopy__(self, memo):
+        """Copies of the nodesets use the same resolver."""
+        return self
+
+    def grouplist(self, namespace=None):
+        """Return the groups of the namespace, not cached."""
+        return self.resolver.grouplist(namespace)
+
+    def all_nodes(self, namespace=None):
+        """Return all nodes of the namespace, not cached."""
+        return self.resolver.all_nodes(namespace)
+
+    def node_groups(self, node, namespace=None):
+        """Return the groups of a node, not cached."""
+        return self.resolver.node_groups(node, namespace)
+
+    def has_node_groups(self, namespace=None):
+        """Tell if the namespace could find the groups of a node."""
+        return self.resolver.has_node_groups(namespace)
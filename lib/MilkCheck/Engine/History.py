@@ -0,0 +1,159 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+"""
+This module contains the DurationHistory class definition.
+
+It keeps the durations of past actions in a local database. They give the
+expected duration of running actions and could set their timeout.
+"""
+
+import time
+import sqlite3
+import logging
+
+
+class DurationHistory(object):
+    """
+    Durations of past successful actions, per action and per node.
+
+    New durations are kept in memory and written by save(), once the run is
+    over. Only the `samples' last durations of an action are used.
+    """
+
+    # Durations older than this number of seconds are purged
+    RETENTION = 90 * 24 * 3600
+    # Minimum number of durations needed to compute a timeout
+    MIN_SAMPLES = 5
+
+    def __init__(self, path, timeout_factor=0, samples=100):
+        self.path = path
+        # Automatic timeout is this factor times the 99th percentile
+        self.timeout_factor = timeout_factor
+        self.samples = samples
+        self._pending = []
+        self._loaded = {}
+
+    def _connect(self):
+        """Open the database, creating the table if needed."""
+        dbase = sqlite3.connect(self.path, timeout=10)
+        dbase.execute("CREATE TABLE IF NOT EXISTS durations "
+                      "(service TEXT, action TEXT, node TEXT, "
+                      "duration REAL, time REAL)")
+        dbase.execute("CREATE INDEX IF NOT EXISTS durations_key "
+                      "ON durations (service, action)")
+        return dbase
+
+    @staticmethod
+    def _percentile(values, percent):
+        """Return the percentile of the values (nearest rank)."""
+        values = sorted(values)
+        rank = max(1, int(round(percent / 100.0 * len(values))))
+        return values[rank - 1]
+
+    def durations(self, action):
+        """
+        Return the last durations of the action, as a tuple of the whole
+        action durations and the per-node durations.
+        """
+        key = (action.parent.fullname(), action.name)
+        if key not in self._loaded:
+            whole, nodes = [], []
+            try:
+                dbase = self._connect()
+                try:
+                    for node, duration in dbase.execute(
+                            "SELECT node, duration FROM durations "
+                            "WHERE service = ? AND action = ? "
+                            "ORDER BY time DESC", key):
+                        if not node and len(whole) < self.samples:
+                            whole.append(duration)
+                        elif node and len(nodes) < self.samples:
+                            nodes.append(duration)
+                finally:
+                    dbase.close()
+            except sqlite3.Error as exc:
+                logging.getLogger('milkcheck').debug(
+                                "Unable to read durations: %s" % exc)
+            self._loaded[key] = (whole, nodes)
+        return self._loaded[key]
+
+    def expected_duration(self, action):
+        """Return the median duration of the action, None if unknown."""
+        whole = self.durations(action)[0]
+        if not whole:
+            return None
+        return self._percentile(whole, 50)
+
+    def timeout(self, action):
+        """
+        Return an automatic timeout for the action command, None if disabled
+        or there is not enough history.
+        """
+        if not self.timeout_factor:
+            return None
+        whole, nodes = self.durations(action)
+        # A local action command lasts as long as the action
+        samples = nodes or whole
+        if len(samples) < self.MIN_SAMPLES:
+            return None
+        return self.timeout_factor * self._percentile(samples, 99)
+
+    def record(self, action):
+        """Keep durations of the provided completed action for save()."""
+        duration = action.duration
+        if duration is None:
+            return
+        now = time.time()
+        service = action.parent.fullname()
+        self._pending.append((service, action.name, '', duration, now))
+        for node, elapsed in action.node_durations.items():
+            self._pending.append((service, action.name, node, elapsed, now))
+
+    def save(self):
+        """Write recorded durations and purge the oldest ones."""
+        if not self._pending:
+            return
+        try:
+            dbase = self._connect()
+            try:
+                with dbase:
+                    dbase.executemany("INSERT INTO durations "
+                                      "VALUES (?, ?, ?, ?, ?)", self._pending)
+                    dbase.execute("DELETE FROM durations WHERE time < ?",
+                                  (time.time() - self.RETENTION,))
+            finally:
+                dbase.close()
+            self._pending = []
+        except sqlite3.Error as exc:
+            logging.getLogger('milkcheck').warning(
+                            "Unable to save durations: %s" % exc)
@@ -0,0 +1,204 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""
+This module contains the ResultCache class definition.
+
+It keeps the results of cacheable actions on disk for a limited time, so
+they could be reused by the next runs instead of executing the command
+again.
+"""
+
+import os
+import json
+import time
+import logging
+
+from ClusterShell.NodeSet import NodeSet
+
+
+class StoredWorker(object):
+    """
+    Replay the results of a command which was already run, with the same
+    interface as the ClusterShell workers used by actions.
+    """
+
+    def __init__(self, command, buffers, retcodes, timeouts=''):
+        self.command = command
+        # [(output, nodeset), ...] and [(retcode, nodeset), ...]
+        self._buffers = buffers
+        self._retcodes = retcodes
+        # Nodes where the command timed out
+        self._timeouts = timeouts
+        # Like a distant worker, last node which was processed
+        self.current_node = None
+        for _, nodes in retcodes:
+            self.current_node = NodeSet(nodes)[-1]
+
+    @classmethod
+    def fromworker(cls, worker):
+        """Build a stored worker from a completed ClusterShell worker."""
+        buffers = [(bytes(buf), str(NodeSet.fromlist(keys)))
+                   for buf, keys in worker.iter_buffers()]
+        retcodes = [(retcode, str(NodeSet.fromlist(keys)))
+                    for retcode, keys in worker.iter_retcodes()]
+        timeouts = str(NodeSet.fromlist(list(worker.iter_keys_timeout())))
+        return cls(worker.command, buffers, retcodes, timeouts)
+
+    def restrict(self, nodes):
+        """Return a stored worker with the results of these nodes only."""
+        nodes = NodeSet(nodes)
+        def _keep(results):
+            return [(value, str(NodeSet(nds) & nodes))
+                    for value, nds in results if NodeSet(nds) & nodes]
+        return StoredWorker(self.command, _keep(self._buffers),
+                            _keep(self._retcodes),
+                            str(NodeSet(self._timeouts) & nodes))
+
+    def iter_buffers(self):
+        """Iterate over (output, nodes) of the command."""
+        for buf, nodes in self._buffers:
+            yield buf, NodeSet(nodes)
+
+    def iter_retcodes(self):
+        """Iterate over (retcode, nodes) of the command."""
+        for retcode, nodes in self._retcodes:
+            yield retcode, NodeSet(nodes)
+
+    def iter_keys_timeout(self):
+        """Iterate over nodes where the command timed out."""
+        return iter(NodeSet(self._timeouts))
+
+    def nodes(self):
+        """Return nodes with a result: a return code or a timeout."""
+        nodes = NodeSet(self._timeouts)
+        for _, nds in self._retcodes:
+            nodes.update(nds)
+        return nodes
+
+    def todict(self):
+        """Return a JSON-compatible representation."""
+        return {'command': self.command,
+                'buffers': [(buf.decode('utf-8', 'replace'), nodes)
+                            for buf, nodes in self._buffers],
+                'retcodes': self._retcodes,
+                'timeouts': self._timeouts}
+
+    @classmethod
+    def fromdict(cls, data):
+        """Build a stored worker from its JSON-compatible representation."""
+        return cls(data['command'],
+                   [(buf.encode('utf-8'), nodes)
+                    for buf, nodes in data['buffers']],
+                   [tuple(item) for item in data['retcodes']],
+                   data.get('timeouts', ''))
+
+
+class ResultCache(object):
+    """
+    On-disk cache of successful action results.
+
+    Results are keyed by service fullname, action name, resolved command and
+    target, and are valid for `ttl' seconds.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._entries = {}
+        self._dirty = False
+        self.load()
+
+    @staticmethod
+    def key(action):
+        """Cache key of the provided action."""
+        return json.dumps([action.parent.fullname(), action.name,
+                           action.command, str(action.target)])
+
+    @staticmethod
+    def usable(action):
+        """Tell if the action results could be cached."""
+        return bool(action.cacheable and action.target and
+                    action.mode != 'delegate')
+
+    def load(self):
+        """Read the cache file, dropping expired entries."""
+        self._entries = {}
+        try:
+            with open(self.path) as cachefile:
+                entries = json.load(cachefile)
+        except (IOError, OSError, ValueError):
+            return
+        now = time.time()
+        for key, entry in entries.items():
+            if now - entry['time'] <= self.ttl:
+                self._entries[key] = entry
+
+    def save(self):
+        """Write the cache file if it was modified."""
+        if not self._dirty:
+            return
+        tmpname = '%s.tmp' % self.path
+        try:
+            with open(tmpname, 'w') as cachefile:
+                json.dump(self._entries, cachefile)
+            os.rename(tmpname, self.path)
+            self._dirty = False
+        except (IOError, OSError) as exc:
+            logging.getLogger('milkcheck').warning(
+                            "Unable to save result cache: %s" % exc)
+
+    def lookup(self, action):
+        """Return a StoredWorker if a fresh result exists, None otherwise."""
+        if not self.usable(action):
+            return None
+        entry = self._entries.get(self.key(action))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return StoredWorker.fromdict(entry['result'])
+
+    def store(self, action):
+        """Save the results of the provided completed action."""
+        if not self.usable(action) or isinstance(action.worker, StoredWorker):
+            return
+        self._entries[self.key(action)] = {
+            'service': action.parent.fullname(),
+            'time': time.time(),
+            'result': StoredWorker.fromworker(action.worker).todict()}
+        self._dirty = True
+
+    def invalidate(self, service):
+        """Forget all results of the provided service."""
+        fullname = service.fullname()
+        for key in [key for key, entry in self._entries.items()
+                    if entry['service'] == fullname]:
+            del self._entries[key]
+            self._dirty = True
@@ -35,7 +35,7 @@ This module contains the Service class definition
 
 # Classes
 from ClusterShell.NodeSet import NodeSet
-from MilkCheck.Engine.BaseEntity import BaseEntity
+from MilkCheck.Engine.BaseEntity import BaseEntity, run_state
 from MilkCheck.Engine.Action import Action, action_manager_self
 from MilkCheck.Callback import call_back_self
 
@@ -43,8 +43,10 @@ from MilkCheck.Callback import call_back_self
 from MilkCheck.Engine.BaseEntity import MilkCheckEngineError
 
 # Symbols
-from MilkCheck.Engine.BaseEntity import NO_STATUS, MISSING, DEP_ERROR
-from MilkCheck.Engine.BaseEntity import WAITING_STATUS
+from MilkCheck.Engine.BaseEntity import NO_STATUS, MISSING, DEP_ERROR, \
+                                        DEP_ORDER, REQUIRE, FILTER
+from MilkCheck.Engine.BaseEntity import WAITING_STATUS, ERROR, TIMEOUT, \
+                                        CANCELLED
 from MilkCheck.Callback import EV_STATUS_CHANGED, EV_TRIGGER_DEP
 
 class ActionNotFoundError(MilkCheckEngineError):
@@ -77,6 +79,10 @@ class Service(BaseEntity):
     LOCAL_VARIABLES = BaseEntity.LOCAL_VARIABLES.copy()
     LOCAL_VARIABLES['SERVICE'] = 'name'
 
+    origin = run_state('origin')
+    _last_action = run_state('_last_action')
+    substitute = run_state('substitute')
+
     def __init__(self, name, target=None, root=False):
         BaseEntity.__init__(self, name, target)
 
@@ -91,9 +97,15 @@ class Service(BaseEntity):
         self._actions = {}
         self._last_action = None
 
+        # Action run instead of the requested one during the current run
+        self.substitute = None
+
         # Is this Service the root Service
         self.root = root
 
+        # Start nodes as soon as they succeeded on the services we depend on
+        self.pipeline = False
+
     def update_target(self, nodeset, mode=None):
         '''Update the attribute target of a service'''
         BaseEntity.update_target(self, nodeset, mode)
@@ -103,11 +115,16 @@ class Service(BaseEntity):
     def reset(self):
         '''Reset values of attributes in order to perform multiple exec'''
         BaseEntity.reset(self)
-        self.origin = False
-        self._last_action = None
         for action in self._actions.values():
             action.reset()
 
+    def _reset_run(self):
+        '''Reset the attributes of the service set during a run'''
+        BaseEntity._reset_run(self)
+        self.origin = False
+        self._last_action = None
+        self.substitute = None
+
     def add_action(self, action):
         '''Add a new action to the service'''
         if isinstance(action, Action):
@@ -116,6 +133,7 @@ class Service(BaseEntity):
             else:
                 action.parent = self
                 self._actions[action.name] = action
+                self._actions_changed()
         else:
             raise TypeError()
 
@@ -133,6 +151,7 @@ class Service(BaseEntity):
         '''Remove the specified action from those available in the service.'''
         if action_name in self._actions:
             del self._actions[action_name]
+            self._actions_changed()
         else:
             raise ActionNotFoundError(self.name, action_name)
 
@@ -149,6 +168,28 @@ class Service(BaseEntity):
         """Tell if service should be skipped for provided action name."""
         return self.has_action(action) and self._actions[action].to_skip()
 
+    def _skip_states(self):
+        '''
+        Return ({action name: to_skip(action)}, skip_all) for the actions
+        of the service. skip_all tells the service skips any action.
+        '''
+        return dict((name, action.to_skip())
+                    for name, action in self._actions.items()), False
+
+    def scope_failed_nodes(self):
+        '''
+        Return nodes failed for the service or for one of the groups
+        enclosing it. Groups keep their own failed nodes, they are only
+        inherited here, when they are needed.
+        '''
+        nodes = NodeSet(self.failed_nodes)
+        scope = self.parent
+        while scope is not None:
+            if scope.failed_nodes:
+                nodes.update(scope.failed_nodes)
+            scope = scope.parent
+        return nodes
+
     def update_status(self, status):
         '''
         Update the current service's status and whether all of his parents
@@ -159,32 +200,60 @@ class Service(BaseEntity):
         if not self.simulate:
             call_back_self().notify(self, EV_STATUS_CHANGED)
 
+        # In fail-fast mode, my failure might make running actions useless
+        if self.status in (ERROR, TIMEOUT, DEP_ERROR, CANCELLED) and \
+           action_manager_self().failfast:
+            action_manager_self().cancel_unneeded()
+
+        # Consumers following my nodes one by one could start now
+        if self.status is WAITING_STATUS:
+            for dep in self.consumers().values():
+                tgt = dep.target
+                if tgt.pipeline and tgt.status is NO_STATUS and tgt._tagged:
+                    tgt.prepare()
+
         # I got a status so I'm DONE or DEP_ERROR and I'm not the calling point
         if self.status not in (NO_STATUS, WAITING_STATUS) and not self.origin:
 
             # Trigger each service which depend on me as soon as it does not
             # have WAITING_STATUS parents
-            deps = self.children
-            if self._algo_reversed:
-                deps = self.parents
-
-            for dep in deps.values():
+            failed = self.scope_failed_nodes()
+            for dep in self.consumers().values():
                 tgt = dep.target
 
                 # Propagate this info, even if 'tgt' will not be run right now
-                dep.filter_nodes(self.failed_nodes)
+                dep.filter_nodes(failed)
 
                 if tgt.status is NO_STATUS and tgt.is_ready() and tgt._tagged:
                     if not self.simulate:
                         call_back_self().notify((self, tgt), EV_TRIGGER_DEP)
                     tgt.prepare()
 
+    def is_needed(self, memo=None):
+        '''
+        Determine if the service result still matters: it is not doomed and
+        it is the calling point or one of the entities waiting for it is
+        still needed.
+        '''
+        if memo is None:
+            memo = {}
+        key = ('needed', self)
+        if key not in memo:
+            # Protect against dependency loops
+            memo[key] = False
+            if not self.is_doomed(memo):
+                memo[key] = self.origin or \
+                    any(dep.target._tagged and dep.target.is_needed(memo)
+                        for dep in self.consumers().values())
+        return memo[key]
+
     def _launch_action(self, action, status):
         """
         Try to launch the action.
 
         Service status and deps should be already checked.
         """
+        action = self.substitute or action
         # Service with missing action is simply skipped
         if not self.has_action(action):
             self.update_status(MISSING)
@@ -198,6 +267,45 @@ class Service(BaseEntity):
             self.update_status(WAITING_STATUS)
             self._actions[action].prepare()
 
+    def pipeline_upstreams(self, action_name):
+        '''
+        Return the actions of the started services we depend on (require or
+        filter) which the action could follow node per node, with their
+        dependency type. Empty unless pipeline is set.
+        '''
+        upstreams = {}
+        action = self._actions.get(action_name)
+        if not self.pipeline or action is None or not action.target or \
+           action.mode == 'delegate':
+            return upstreams
+        for dep in self.deps().values():
+            tgt = dep.target
+            if dep.dep_type not in (REQUIRE, FILTER) or tgt.simulate or \
+               tgt.status is NO_STATUS:
+                continue
+            upstream = tgt._actions.get(dep.action or action_name)
+            if upstream is not None and upstream.target and \
+               upstream.mode != 'delegate':
+                upstreams[upstream] = dep.dep_type
+        return upstreams
+
+    def _pipeline_status(self):
+        '''
+        Return the status of the dependencies if the action could start while
+        the running ones are followed node per node, None otherwise.
+        '''
+        upstreams = self.pipeline_upstreams(self.substitute or
+                                            self._last_action)
+        followed = set(upstream.parent for upstream in upstreams)
+        status = MISSING
+        for dep in self.deps().values():
+            if dep.target.status in (NO_STATUS, WAITING_STATUS):
+                if dep.target not in followed:
+                    return None
+            elif DEP_ORDER[dep.status()] > DEP_ORDER[status]:
+                status = dep.status()
+        return status
+
     def prepare(self, action_name=None):
         """
         Recursive method allowing to prepare a service before its execution.
@@ -223,11 +331,17 @@ class Service(BaseEntity):
             for dep in deps:
                 if dep.is_check():
                     dep.target.prepare('status')
-                else:
+                # Others are launched from the graph running their action
+                elif dep.action is None:
                     dep.target.prepare(self._last_action)
         # No dep still running: Run me
         elif deps_status is not WAITING_STATUS:
             self._launch_action(self._last_action, deps_status)
+        # Running deps could be followed node per node
+        elif self.pipeline:
+            status = self._pipeline_status()
+            if status is not None:
+                self._launch_action(self._last_action, status)
 
     def run(self, action_name):
         """Run an action over a service"""
@@ -248,6 +362,9 @@ class Service(BaseEntity):
         """Populate service attributes from dict."""
         BaseEntity.fromdict(self, svcdict)
 
+        if 'pipeline' in svcdict:
+            self.pipeline = svcdict['pipeline']
+
         if 'actions' in svcdict:
             dependencies = {}
             for names, props in svcdict['actions'].items():
@@ -36,7 +36,7 @@ This module contains the ServiceGroup class definition
 # Classes
 from ClusterShell.NodeSet import NodeSet
 from MilkCheck.Engine.Service import Service
-from MilkCheck.Engine.BaseEntity import BaseEntity, DEP_ORDER
+from MilkCheck.Engine.BaseEntity import BaseEntity, Dependency, DEP_ORDER
 
 # Symbols
 from MilkCheck.Engine.BaseEntity import DONE, SKIPPED, REQUIRE, MISSING, \
@@ -79,8 +79,23 @@ class ServiceGroup(Service):
         del self.parents['source']
         self._sink = Service('sink')
         self._sink.simulate = True
+        # The group waits for its source in the normal direction and for
+        # its sink in the reverse one: the sink link is only in its view.
+        sink = self._sink
+        sink._adjacency = (sink._adjacency[0],
+                           (sink.children,
+                            {self.name: Dependency(self, REQUIRE, False)}))
+        source = self._source
+        source._adjacency = (source._adjacency[0], ({}, source.parents))
         # subservices
         self._subservices = {}
+        # Subservices having and skipping each action, see _get_skip_index()
+        self._skip_index = None
+        self._skip_generation = None
+        # Max number of subservices running at the same time (budget)
+        self.max_services = None
+        # Max number of connections of the whole group (budget)
+        self.max_connections = None
 
     def update_target(self, nodeset, mode=None):
         '''Update the attribute target of a ServiceGroup'''
@@ -88,16 +103,6 @@ class ServiceGroup(Service):
         for service in self._subservices.values():
             service.update_target(nodeset, mode)
 
-    def filter_nodes(self, nodes):
-        """
-        Add error nodes to skip list.
-
-        Nodes in this list will not be used when launching actions.
-        """
-        BaseEntity.filter_nodes(self, nodes)
-        for service in self._subservices.values():
-            service.filter_nodes(nodes)
-
     def iter_subservices(self):
         '''Return an iterator over the subservices'''
         for svc in self._subservices.values():
@@ -131,13 +136,10 @@ class ServiceGroup(Service):
 
     def has_action(self, action_name):
         """
-        A group consider to get an action only if both source and sink
-        own the action
+        A group consider to get an action only if one of its subservices
+        owns the action
         """
-        for svc in self.iter_subservices():
-            if svc.has_action(action_name):
-                return True
-        return False
+        return action_name in self._get_skip_index()[0]
 
     def skip(self):
         """Skip all services from this group"""
@@ -150,10 +152,48 @@ class ServiceGroup(Service):
 
         That means that all its subservices should be skipped.
         """
-        for svc in self._subservices.values():
-            if not svc.to_skip(action):
-                return False
-        return True
+        actions, skip_all = self._get_skip_index()
+        skipped = actions.get(action, (0, 0))[1] + skip_all
+        return skipped == len(self._subservices)
+
+    def _get_skip_index(self):
+        '''
+        Return ({action name: (subservices having it, subservices skipping
+        it)}, subservices skipping any action). It is computed from the
+        subservices indexes, until actions or targets change or a new run
+        resets the targets.
+        '''
+        if self._skip_index is None or \
+           self._skip_generation != BaseEntity.run_generation:
+            self._skip_generation = BaseEntity.run_generation
+            actions = {}
+            skip_all = 0
+            for svc in self._subservices.values():
+                states, svc_skip_all = svc._skip_states()
+                skip_all += svc_skip_all
+                for name, skipped in states.items():
+                    having, skipping = actions.get(name, (0, 0))
+                    actions[name] = (having + 1, skipping + skipped)
+            self._skip_index = (actions, skip_all)
+        return self._skip_index
+
+    def _skip_states(self):
+        '''
+        Return ({action name: to_skip(action)}, skip_all) for the actions
+        of the subservices. skip_all tells the group skips any action,
+        like an empty group.
+        '''
+        actions, skip_all = self._get_skip_index()
+        count = len(self._subservices)
+        return (dict((name, skipping + skip_all == count)
+                     for name, (_, skipping) in actions.items()),
+                skip_all == count)
+
+    def _actions_changed(self):
+        '''Forget the index, enclosing groups forgot theirs if it is None'''
+        if self._skip_index is not None:
+            self._skip_index = None
+            Service._actions_changed(self)
 
     def add_inter_dep(self, target, base=None, sgth=REQUIRE):
         """
@@ -176,6 +216,34 @@ class ServiceGroup(Service):
             self._source.add_dep(target=target, sgth=sgth)
         self._subservices[target.name] = target
         target.parent = self
+        self._actions_changed()
+        self.__update_edges()
+
+    def add_services(self, services, deps=()):
+        """
+        Add several subservices, then dependencies in the subgraph given as
+        (target, base) or (target, base, sgth) tuples, like add_inter_dep()
+        arguments. Edges to source and sink are updated only once, when
+        everything is added.
+        """
+        for service in services:
+            self._sink.add_dep(target=service, parent=False)
+            self._source.add_dep(target=service)
+            self._subservices[service.name] = service
+            service.parent = self
+        for dep in deps:
+            target, base = dep[:2]
+            sgth = dep[2] if len(dep) > 2 else REQUIRE
+            if not self.has_subservice(base.name):
+                raise ServiceNotFoundError()
+            if not target.has_parent_dep('sink'):
+                target.add_dep(target=self._sink)
+            if not target.children:
+                target.add_dep(target=self._source, parent=False)
+            base.add_dep(target=target, sgth=sgth)
+            self._subservices[target.name] = target
+            target.parent = self
+        self._actions_changed()
         self.__update_edges()
 
     def __update_edges(self, create_links=False):
@@ -216,36 +284,75 @@ class ServiceGroup(Service):
             for dep in list(self._subservices[dep_name].children.values()):
                 dep.target.remove_dep(dep_name)
             del self._subservices[dep_name]
+            self._actions_changed()
             self.__update_edges(True)
             
-    def graph_info(self):
+    def graph_info(self, collapse=False):
         """ Return a tuple to manage dependencies output """
+        if collapse:
+            return Service.graph_info(self, collapse)
         return ("%s.__hook" % self.fullname(), "cluster_%s" % self.fullname())
 
-    def graph(self, excluded=None):
-        """ Generate a subgraph of dependencies in the ServiceGroup"""
-        grph = ''
-        grph += 'subgraph "cluster_%s" {\nlabel="%s";\n' % (self.fullname(),
-                                                              self.fullname())
-        grph += 'style=rounded;\nnode [style=filled];\n'
+    def iter_graph(self, excluded=None, memo=None, collapse=False):
+        """
+        Generate a subgraph of dependencies in the ServiceGroup, or a single
+        node with collapse.
+        """
+        if memo is None:
+            memo = {}
+        if collapse:
+            for line in Service.iter_graph(self, excluded, memo, collapse):
+                yield line
+            return
+
+        yield 'subgraph "cluster_%s" {\nlabel="%s";\n' % (self.fullname(),
+                                                            self.fullname())
+        yield 'style=rounded;\nnode [style=filled];\n'
 
         # Create a default node to manage DOT output
         # __hook will be used to attach the nodes to the subgraph
-        grph += '"%s.__hook" [style=invis];\n' % self.fullname()
+        yield '"%s.__hook" [style=invis];\n' % self.fullname()
 
         # Graph content of the servicegroup
-        entities = self._subservices
-        for ent in entities.values():
-            if not ent.excluded(excluded):
-                grph += ent.graph(excluded=excluded)
-        grph += '}\n'
+        for ent in self._subservices.values():
+            if not ent.excluded(excluded, memo):
+                for line in ent.iter_graph(excluded, memo):
+                    yield line
+        yield '}\n'
 
         # Graph dependencies of the service group
         for dep in self.deps().values():
-            if not dep.target.excluded(excluded):
+            if not dep.target.excluded(excluded, memo):
                 if not dep.target.simulate:
-                    grph += dep.graph(self)
-        return grph
+                    yield dep.graph(self)
+
+    def iter_edges(self, excluded=None, memo=None, collapse=False):
+        """
+        Generate (entity, None) then (entity, dependency) for the group, and
+        unless collapse, for its subservices.
+        """
+        if memo is None:
+            memo = {}
+        for edge in Service.iter_edges(self, excluded, memo, collapse):
+            yield edge
+        if not collapse:
+            for ent in self._subservices.values():
+                if not ent.excluded(excluded, memo):
+                    for edge in ent.iter_edges(excluded, memo):
+                        yield edge
+
+    def is_doomed(self, memo=None):
+        """
+        A group is also doomed as soon as its internal dependencies are.
+        """
+        if memo is None:
+            memo = {}
+        if Service.is_doomed(self, memo):
+            return True
+        if self._algo_reversed:
+            return self._sink.is_doomed(memo)
+        else:
+            return self._source.is_doomed(memo)
 
     def eval_deps_status(self):
         """
@@ -296,6 +403,35 @@ class ServiceGroup(Service):
                 intd_status = self._source.eval_deps_status()
             self.update_status(intd_status)
 
+    def connections_budget(self):
+        '''
+        Max number of concurrent connections of the whole group, None if
+        unlimited. A nested group cannot use more than its share of the
+        enclosing group budget.
+        '''
+        budget = self.max_connections
+        if isinstance(self.parent, ServiceGroup):
+            share = self.parent.connections_share()
+            if budget is None or (share is not None and share < budget):
+                budget = share
+        return budget
+
+    def connections_share(self):
+        '''
+        Connections each running subservice could use: the group budget
+        split between the subservices allowed to run together.
+        '''
+        budget = self.connections_budget()
+        if budget is not None and self.max_services:
+            budget = max(1, budget // self.max_services)
+        return budget
+
+    def _budget_fromdict(self, grpdict):
+        '''Set the group budget from the budget section of grpdict'''
+        if 'budget' in grpdict:
+            self.max_services = grpdict['budget'].get('services')
+            self.max_connections = grpdict['budget'].get('connections')
+
     def inherits_from(self, entity):
         '''Inherit properties from entity'''
         BaseEntity.inherits_from(self, entity)
@@ -303,15 +439,17 @@ class ServiceGroup(Service):
             subservice.inherits_from(self)
 
     def set_algo_reversed(self, flag):
-        """Updates dependencies if reversed flag is specified"""
-        if self._algo_reversed and not flag:
-            del self._sink.parents[self.name]
-            self._source.add_dep(target=self, parent=False)
-            del self.parents['source']
-        elif not self._algo_reversed and flag:
-            del self._source.children[self.name]
-            self._sink.add_dep(target=self)
-            del self.children['sink']
+        """
+        Select the direction of the group and its subservices. Dependencies
+        are not modified, each entity has a view for each direction.
+
+        The flag is copied to each entity instead of being read from a
+        place shared by the graph: it is set once per run, which already
+        walks every entity with resolve_all(), whereas deps() and
+        consumers() are called again and again during the run. Some
+        entities also have their own direction: actions always use the
+        normal one, and the spots of select_services() are set alone.
+        """
         for service in self._subservices.values():
             service.algo_reversed = flag
         self._algo_reversed = flag
@@ -324,6 +462,8 @@ class ServiceGroup(Service):
         """Populate group attributes from dict."""
         BaseEntity.fromdict(self, grpdict)
 
+        self._budget_fromdict(grpdict)
+
         if 'services' in grpdict:
             dep_mapping = {}
 
@@ -333,17 +473,7 @@ class ServiceGroup(Service):
 
                     # Parsing dependencies
                     wrap = DepWrapper()
-                    for prop in ('require', 'require_weak', 'require_filter',
-                                 'filter', 'before', 'after', 'check'):
-                        if prop in props:
-                            if prop in ('before', 'after'):
-                                props['require_weak'] = props[prop]
-                                prop = 'require_weak'
-                            # Only for compat with v1.1beta versions
-                            if prop == 'require_filter':
-                                props['filter'] = props[prop]
-                                prop = 'filter'
-                            wrap.deps[prop] = props[prop]
+                    wrap.fromdict(props)
 
                     # Get subservices which might be Service or ServiceGroup
                     service = None
@@ -361,6 +491,7 @@ class ServiceGroup(Service):
 
                     wrap.source = service
                     dep_mapping[subservice] = wrap
+            self._actions_changed()
 
             # Generate dependency links of the service
             for wrap in dep_mapping.values():
@@ -400,6 +531,8 @@ class ServiceGroup(Service):
     def resolve_all(self):
         """Resolve all variables in ServiceGroup properties"""
         BaseEntity.resolve_all(self)
+        self.max_services = self._resolve(self.max_services)
+        self.max_connections = self._resolve(self.max_connections)
         for subser in self.iter_subservices():
             subser.resolve_all()
 
@@ -415,3 +548,20 @@ class DepWrapper(object):
         self.source = None
         self.deps = {'require': [], 'require_weak': [], 'check': [],
                      'filter': []}
+
+    def fromdict(self, props):
+        '''
+        Set the dependencies from the service properties. Dependency
+        aliases are renamed in props.
+        '''
+        for prop in ('require', 'require_weak', 'require_filter', 'filter',
+                     'before', 'after', 'check'):
+            if prop in props:
+                if prop in ('before', 'after'):
+                    props['require_weak'] = props[prop]
+                    prop = 'require_weak'
+                # Only for compat with v1.1beta versions
+                if prop == 'require_filter':
+                    props['filter'] = props[prop]
+                    prop = 'filter'
+                self.deps[prop] = props[prop]
@@ -0,0 +1,375 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+"""
+This module contains the SimulatedTask class definition.
+
+It replaces the ClusterShell task of the ActionManager to run the engine
+against a virtual clock: commands are not executed, each node takes the
+duration found in the history of the action.
+"""
+
+import heapq
+import itertools
+from collections import deque
+
+from ClusterShell.NodeSet import NodeSet
+
+
+class SimulatedTimer(object):
+    """Timer of a SimulatedTask, like ClusterShell EngineTimer."""
+
+    def __init__(self, handler, autoclose=False):
+        self.eh = handler
+        self.autoclose = autoclose
+        self.valid = True
+
+    def invalidate(self):
+        """Do not fire the timer."""
+        self.valid = False
+
+
+class SimulatedWorker(object):
+    """
+    Command started by a SimulatedTask, with the same interface as the
+    ClusterShell workers used by actions. All nodes succeed, unless their
+    duration exceeds the timeout.
+    """
+
+    def __init__(self, task, command, nodes, timeout, handler):
+        self.task = task
+        self.command = command
+        self.timeout = timeout
+        self.eh = handler
+        self.nodes = nodes
+        # Like local ClusterShell workers, current_node is None without nodes
+        self.current_node = None
+        self.current_rc = None
+        self._keys = list(NodeSet(nodes)) if nodes is not None else [None]
+        self._retcodes = {}
+        self._timeouts = []
+        self._running = set()
+        self._left = len(self._keys)
+        self.aborted = False
+        self.closed = False
+
+    @property
+    def action(self):
+        """Action running the command, if any."""
+        return getattr(self.eh, '_action', None)
+
+    @staticmethod
+    def _name(key):
+        """Node name of a key, localhost for local commands."""
+        if key is None:
+            return 'localhost'
+        return key
+
+    def iter_buffers(self):
+        """Command output is not simulated."""
+        return iter(())
+
+    def read(self):
+        """Command output is not simulated."""
+        return b''
+
+    def iter_retcodes(self):
+        """Iterate over (retcode, nodes) of the command."""
+        byrc = {}
+        for key, retcode in self._retcodes.items():
+            byrc.setdefault(retcode, []).append(self._name(key))
+        for retcode, keys in byrc.items():
+            yield retcode, NodeSet.fromlist(keys)
+
+    def iter_keys_timeout(self):
+        """Iterate over nodes which timed out."""
+        return iter([self._name(key) for key in self._timeouts])
+
+    def retcode(self):
+        """Return code of a local command, None if unknown."""
+        return self._retcodes.get(None)
+
+    def did_timeout(self):
+        """Tell if the command timed out."""
+        return bool(self._timeouts)
+
+    def abort(self):
+        """Stop the command and raise ev_close()."""
+        if self.closed:
+            return
+        self.aborted = True
+        self.task.release(len(self._running))
+        self._running.clear()
+        self._close()
+
+    def _start(self):
+        """Command is started, its nodes wait for a free slot."""
+        if self.aborted:
+            return
+        if self.eh is not None:
+            self.eh.ev_start(self)
+        for key in self._keys:
+            self.task.enqueue(self, key)
+
+    def _pickup(self, key):
+        """Command is started on the node."""
+        self._running.add(key)
+        self.current_node = key
+        if self.eh is not None:
+            self.eh.ev_pickup(self)
+
+    def _hup(self, key, timedout):
+        """Command is over on the node."""
+        self._running.discard(key)
+        self.task.release(1)
+        self.current_node = key
+        if timedout:
+            self._timeouts.append(key)
+            self.current_rc = None
+        else:
+            self._retcodes[key] = self.current_rc = 0
+            if self.eh is not None:
+                self.eh.ev_hup(self)
+        self._left -= 1
+        if not self._left:
+            self._close()
+
+    def _close(self):
+        """Command is over on all nodes."""
+        self.closed = True
+        self.task.worker_closed(self)
+        if self.eh is not None:
+            self.eh.ev_close(self)
+
+
+class SimulatedTask(object):
+    """
+    Replacement of the ClusterShell task of the ActionManager, with a
+    virtual clock.
+
+    Workers share the task fanout like in ClusterShell. While running, the
+    task records when each action started and completed and which action
+    completion started it, giving the critical path of the run.
+    """
+
+    # Duration, in seconds, of nodes of actions missing from the history
+    # and without timeout. A null duration would make the fanout useless.
+    DEFAULT_DURATION = 1.0
+
+    def __init__(self, history=None):
+        self.history = history
+        self.clock = 0.0
+        self._infos = {'fanout': 64}
+        self._events = []
+        self._seq = itertools.count()
+        # Number of events which keep the task running (not autoclose)
+        self._pending = 0
+        self._queue = deque()
+        self._busy = 0
+        self._running = False
+        # Action of the event being processed
+        self._current = None
+        self._durations = {}
+        # Slot.seconds used, and available, during the run
+        self.busy_time = 0.0
+        self.capacity_time = 0.0
+        # Start and stop times of each action, and what started it
+        self.spans = {}
+        self.causes = {}
+        # Actions without history, run with their timeout or DEFAULT_DURATION
+        self.unknown = set()
+
+    def info(self, key, default=None):
+        """Return a task info, like ClusterShell Task.info()."""
+        return self._infos.get(key, default)
+
+    def set_info(self, key, value):
+        """Set a task info, like ClusterShell Task.set_info()."""
+        self._infos[key] = value
+
+    def running(self):
+        """Tell if the task is running."""
+        return self._running
+
+    def _push(self, delay, callback, autoclose=False, context=None,
+              alive=None):
+        """
+        Call callback after delay seconds of the virtual clock, unless
+        alive() tells it was cancelled meanwhile.
+        """
+        if not autoclose:
+            self._pending += 1
+        heapq.heappush(self._events, (self.clock + delay, next(self._seq),
+                                      autoclose, callback, context, alive))
+
+    def _started_by(self, action):
+        """Remember the action whose completion started this one."""
+        if action is not None and action not in self.causes and \
+           self._current is not None and self._current is not action:
+            self.causes[action] = self._current
+
+    def timer(self, fire, handler, autoclose=False):
+        """Fire handler.ev_timer() after fire seconds."""
+        timer = SimulatedTimer(handler, autoclose)
+        action = getattr(handler, '_action', None)
+        self._started_by(action)
+
+        def _fire():
+            timer.valid = False
+            handler.ev_timer(timer)
+        # Timers without action run on behalf of their creator
+        self._push(fire, _fire, autoclose, action or self._current,
+                   lambda: timer.valid)
+        return timer
+
+    def shell(self, command, nodes=None, timeout=None, handler=None,
+              remote=True):
+        """Start the command over nodes, return a SimulatedWorker."""
+        worker = SimulatedWorker(self, command, nodes, timeout, handler)
+        action = worker.action
+        if action is not None:
+            self._started_by(action)
+            self.spans.setdefault(action, [self.clock, self.clock])
+        self._push(0, worker._start, context=action)
+        return worker
+
+    def duration(self, action, local=False):
+        """Usual duration of the command of the action on one node."""
+        if action not in self._durations:
+            duration = None
+            if action is not None and self.history is not None:
+                whole, nodes = self.history.durations(action)
+                samples = (whole or nodes) if local else (nodes or whole)
+                if samples:
+                    duration = sorted(samples)[len(samples) // 2]
+            if duration is None:
+                duration = self.DEFAULT_DURATION
+                if action is not None:
+                    self.unknown.add(action)
+                    # Nodes are assumed to last until the timeout
+                    if action.timeout:
+                        duration = action.timeout
+            self._durations[action] = duration
+        return self._durations[action]
+
+    def enqueue(self, worker, key):
+        """Node is waiting for a free slot."""
+        self._queue.append((worker, key))
+
+    def release(self, count):
+        """Slots were freed."""
+        self._busy -= count
+
+    def worker_closed(self, worker):
+        """Remember when the action completed."""
+        if worker.action in self.spans:
+            self.spans[worker.action][1] = self.clock
+
+    def _pickup(self):
+        """Start waiting nodes within the fanout."""
+        while self._queue and self._busy < self.info('fanout'):
+            worker, key = self._queue.popleft()
+            if worker.aborted:
+                continue
+            self._busy += 1
+            worker._pickup(key)
+            duration = self.duration(worker.action, worker.nodes is None)
+            timedout = worker.timeout and duration > worker.timeout
+            if timedout:
+                duration = worker.timeout
+            self._push(duration,
+                       lambda wkr=worker, key=key, tmo=timedout:
+                           wkr._hup(key, tmo),
+                       context=worker.action,
+                       alive=lambda wkr=worker: not wkr.aborted)
+
+    def run(self):
+        """Process events until nothing but autoclose timers remain."""
+        self._running = True
+        try:
+            while True:
+                self._pickup()
+                if not self._pending:
+                    break
+                when, _, autoclose, callback, context, alive = \
+                                                heapq.heappop(self._events)
+                if not autoclose:
+                    self._pending -= 1
+                # Cancelled events do not make time pass
+                if alive is not None and not alive():
+                    continue
+                elapsed = when - self.clock
+                self.busy_time += self._busy * elapsed
+                self.capacity_time += self.info('fanout') * elapsed
+                self.clock = when
+                self._current = context
+                callback()
+                self._current = None
+        finally:
+            self._events = []
+            self._pending = 0
+            self._running = False
+
+    @property
+    def utilization(self):
+        """Average ratio of the fanout used during the run."""
+        if not self.capacity_time:
+            return 0.0
+        return self.busy_time / self.capacity_time
+
+    def critical_path(self):
+        """
+        Return the chain of actions which ended last, from the first one,
+        as a list of (action, start, stop).
+        """
+        if not self.spans:
+            return []
+        action = max(self.spans, key=lambda act: self.spans[act][1])
+        path = []
+        seen = set()
+        while action is not None and action not in seen:
+            seen.add(action)
+            if action in self.spans and not action.parent.simulate:
+                path.append((action, ) + tuple(self.spans[action]))
+            action = self.causes.get(action)
+        path.reverse()
+        return path
+
+
+def recommend_fanout(results, tolerance=0.05):
+    """
+    Return the smallest fanout whose predicted duration is within tolerance
+    of the best one. results is a list of (fanout, duration).
+    """
+    best = min(duration for _, duration in results)
+    return min(fanout for fanout, duration in results
+               if duration <= best * (1 + tolerance))
@@ -0,0 +1,94 @@
+#
+# Copyright CEA (2011-2017)
+#
+# This file is part of MilkCheck project.
+#
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# In this respect, the user's attention is drawn to the risks associated
+# with loading,  using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean  that it is complicated to manipulate,  and  that  also
+# therefore means  that it is reserved for developers  and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and,  more generally, to use and operate it in the
+# same conditions as regards security.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+
+
+"""
+This module contains the TargetTable class definition.
+
+Many entities of a configuration use the same few targets, often inherited
+from their group. The table parses each target string once and shares the
+resulting NodeSet between all these entities. Shared nodesets must not be
+modified in place: an entity updating its target works on its own copy.
+"""
+
+from ClusterShell.NodeSet import NodeSet
+
+try:
+    # Strings loaded from YAML may be unicode with Python 2
+    TEXT_TYPES = (str, unicode)
+except NameError:
+    TEXT_TYPES = (str,)
+
+
+class TargetTable(object):
+    """Parsed targets of the run, shared between entities."""
+
+    _instance = None
+
+    def __init__(self):
+        # Target string: parsed nodeset
+        self._nodesets = {}
+        # id(nodeset): nodeset, for all nodesets of the table
+        self._shared = {}
+
+    def nodeset(self, target):
+        """
+        Return the shared nodeset for target, a string or a nodeset already
+        returned by the table.
+        """
+        if self.is_shared(target):
+            return target
+        nodeset = self._nodesets.get(target)
+        if nodeset is None:
+            nodeset = NodeSet(target)
+            self._nodesets[target] = nodeset
+            self._shared[id(nodeset)] = nodeset
+        return nodeset
+
+    def is_shared(self, nodeset):
+        """Tell if the nodeset comes from the table."""
+        return self._shared.get(id(nodeset)) is nodeset
+
+    def clear(self):
+        """
+        Forget parsed targets, nodes groups could have changed. Nodesets
+        already shared stay so for the entities using them.
+        """
+        self._nodesets.clear()
+        self._shared.clear()
+
+
+def target_table_self():
+    """Return a singleton instance of the TargetTable class"""
+    if not TargetTable._instance:
+        TargetTable._instance = TargetTable()
+    return TargetTable._instance
@@ -33,8 +33,58 @@
 This module contains the ServiceManager class definition.
 '''
 
-from MilkCheck.Engine.BaseEntity import LOCKED, WARNING, VariableAlreadyExistError
+import copy
+import json
+import logging
+import time
+
+from ClusterShell.NodeSet import NodeSet, std_group_resolver
+
+from MilkCheck.Engine.BaseEntity import BaseEntity, LOCKED, WARNING, \
+                                        REQUIRE, VariableAlreadyExistError, \
+                                        Dependency
+from MilkCheck.Engine.Service import Service
 from MilkCheck.Engine.ServiceGroup import ServiceGroup, ServiceNotFoundError
+from MilkCheck.Engine.GraphBuilder import GraphBuilder
+from MilkCheck.Engine.Action import action_manager_self
+from MilkCheck.Engine.TargetTable import target_table_self
+from MilkCheck.Engine.GroupCache import GroupCache
+
+
+class ExecutionView(object):
+    '''
+    Changes made on a graph for a single run: entry point of the selected
+    services, disabled dependencies and links between phases. They are
+    undone once the run is over, so the loaded graph could run again.
+    '''
+
+    def __init__(self):
+        # [(mapping or object, key or attribute, previous value), ...]
+        self._changes = []
+
+    def set_dep(self, deps, name, dep):
+        """Set deps[name] to dep, or remove it if dep is None."""
+        self._changes.append((deps, name, deps.get(name)))
+        if dep is None:
+            deps.pop(name, None)
+        else:
+            deps[name] = dep
+
+    def set_attr(self, obj, attr, value):
+        """Set an attribute of obj."""
+        self._changes.append((obj, attr, getattr(obj, attr)))
+        setattr(obj, attr, value)
+
+    def restore(self):
+        """Undo all changes, the last one first."""
+        while self._changes:
+            obj, key, value = self._changes.pop()
+            if not isinstance(obj, dict):
+                setattr(obj, key, value)
+            elif value is None:
+                obj.pop(key, None)
+            else:
+                obj[key] = value
 
 
 class ServiceManager(ServiceGroup):
@@ -46,6 +96,10 @@ class ServiceManager(ServiceGroup):
     def __init__(self, name="MAIN"):
         ServiceGroup.__init__(self, name, root=True)
         self.simulate = True
+        # Copies of the graph running the first actions of a compound action
+        self._leads = []
+        # Changes made for the current run
+        self._view = ExecutionView()
 
     def fullname(self):
         return ""
@@ -58,6 +112,9 @@ class ServiceManager(ServiceGroup):
         for ent in self.iter_subservices():
             if ent.status is WARNING:
                 return True
+        for lead in self._leads:
+            if lead.has_warnings():
+                return True
         return False
 
     #
@@ -114,46 +171,192 @@ class ServiceManager(ServiceGroup):
             self.update_target(conf['excluded_nodes'], 'DIF')
 
     def select_services(self, services):
-        """Disable all services except those from 'services'"""
+        """
+        Run only 'services' and their dependencies: the run starts from a
+        new entry point linked to them alone, until the view is restored.
+        """
         for svcname in services:
             if not self.has_subservice(svcname):
                 raise ServiceNotFoundError('Undefined service [%s]' % svcname)
 
-        parent = not self._algo_reversed
-        if parent:
-            spot = self._source
+        if self._algo_reversed:
+            spot = Service(self._sink.name)
+            spot.add_dep(target=self)
+            del self.children[spot.name]
+            self._view.set_attr(self, '_sink', spot)
         else:
-            spot = self._sink
+            spot = Service(self._source.name)
+            spot.add_dep(target=self, parent=False)
+            del self.parents[spot.name]
+            self._view.set_attr(self, '_source', spot)
+        spot.simulate = True
+        spot._algo_reversed = self._algo_reversed
 
-        # Remove unused services
-        for service in list(spot.deps().keys()):
-            if service not in services:
-                spot.remove_dep(service, parent=parent)
         # Add direct link to important services
         for service in services:
-            if service not in spot.deps():
-                svc = self._subservices[service]
-                spot.add_dep(svc, parent=parent)
+            svc = self._subservices[service]
+            spot.deps()[service] = Dependency(svc)
+            self._view.set_dep(svc.consumers(), spot.name, Dependency(spot))
 
     def _disable_deps(self):
-        """Clear internal dependencies from enabled services"""
+        """Hide internal dependencies of enabled services"""
         if self._algo_reversed:
-            for dep in self._sink.children.values():
-                dep.target.clear_child_deps()
+            spot = self._sink
         else:
-            for dep in self._source.parents.values():
-                dep.target.clear_parent_deps()
+            spot = self._source
+        for dep in list(spot.deps().values()):
+            svc = dep.target
+            for name, svcdep in list(svc.deps().items()):
+                self._view.set_dep(svcdep.target.consumers(), svc.name, None)
+                self._view.set_dep(svc.deps(), name, None)
+
+    def enabled_services(self):
+        '''
+        Return the services the run would reach: the enabled ones, their
+        dependencies and the services of the reached groups.
+        '''
+        if self._algo_reversed:
+            spot = self._sink
+        else:
+            spot = self._source
+        seen = set()
+        stack = [dep.target for dep in spot.deps().values()]
+        while stack:
+            svc = stack.pop()
+            if svc in seen or svc.status is LOCKED:
+                continue
+            seen.add(svc)
+            stack.extend(dep.target for dep in svc.deps().values()
+                         if not dep.target.simulate)
+            if isinstance(svc, ServiceGroup):
+                stack.extend(svc.iter_subservices())
+        return seen
+
+    def probe_targets(self, action):
+        '''
+        Return the nodes where the enabled services would run the action
+        remotely, including their dependencies.
+        '''
+        nodes = NodeSet()
+        for svc in self.enabled_services():
+            for act in svc.iter_actions():
+                if act.name == action and act.target and act.mode is None:
+                    nodes.add(act.target)
+        return nodes
+
+    def readonly_actions(self, action, readonly=()):
+        '''
+        Return the actions the enabled services would run which could run
+        ahead of the graph: read-only ones, or named in `readonly', run
+        remotely at once.
+        '''
+        actions = []
+        for svc in self.enabled_services():
+            for act in svc.iter_actions():
+                if act.name == (svc.substitute or action) and \
+                   (act.readonly or act.name in readonly) and \
+                   act.target and act.mode != 'delegate' and not act.waves:
+                    actions.append(act)
+        return actions
+
+    def _probe(self, action, timeout):
+        '''
+        Remove nodes which do not answer a trivial command from targets and
+        return them.
+        '''
+        unreachable = NodeSet()
+        nodes = self.probe_targets(action)
+        if nodes:
+            unreachable = action_manager_self().probe(nodes, timeout)
+            if unreachable:
+                logging.getLogger('milkcheck').warning(
+                            "Unreachable nodes removed: %s" % unreachable)
+                self.update_target(unreachable, 'DIF')
+        return unreachable
+
+    def _clone(self):
+        '''
+        Return an independent copy of the whole graph. Entities are copied
+        one at a time: a plain deepcopy() would recurse along dependencies.
+        '''
+        entities = []
+        stack = [self]
+        while stack:
+            ent = stack.pop()
+            entities.append(ent)
+            if isinstance(ent, Service):
+                stack.extend(ent.iter_actions())
+            if isinstance(ent, ServiceGroup):
+                stack.extend((ent._source, ent._sink))
+                stack.extend(ent.iter_subservices())
+        memo = {}
+        for ent in entities:
+            memo[id(ent)] = ent.__class__.__new__(ent.__class__)
+        for ent in entities:
+            memo[id(ent)].__dict__ = copy.deepcopy(ent.__dict__, memo)
+        return memo[id(self)]
+
+    def _compound_owners(self, compound):
+        '''
+        Services defining the compound action themselves run it instead
+        of the last phase, their copies skip the previous phases.
+        '''
+        stack = [(self, self._leads)]
+        while stack:
+            group, leads = stack.pop()
+            for name, svc in group._subservices.items():
+                copies = [lead._subservices[name] for lead in leads]
+                if isinstance(svc, ServiceGroup):
+                    stack.append((svc, copies))
+                elif svc.has_action(compound):
+                    svc.substitute = compound
+                    for other in copies:
+                        other.skip()
+
+    def _link_phase(self, lead, action):
+        '''
+        Make each service wait for its copy in `lead', the graph of the
+        previous phase running `action', if both are reached.
+        '''
+        enabled = self.enabled_services()
+        lead_enabled = lead.enabled_services()
+        stack = [(self, lead)]
+        while stack:
+            group, other = stack.pop()
+            for name, svc in group._subservices.items():
+                prev = other._subservices[name]
+                if isinstance(svc, ServiceGroup):
+                    stack.append((svc, prev))
+                    continue
+                if svc not in enabled or prev not in lead_enabled:
+                    continue
+                # Not a service name, so it cannot clash with real deps
+                key = (action, name)
+                self._view.set_dep(svc.deps(), key,
+                                   Dependency(prev, REQUIRE, action=action))
+                lead._view.set_dep(prev.consumers(), key,
+                                   Dependency(svc, REQUIRE))
 
     def call_services(self, services, action, conf=None):
         '''Allow the user to call one or multiple services.'''
 
-        # Make sure that the graph is usable
-        self.reset()
+        # Make sure that the graph is usable: entities forget the previous
+        # run when they are used again, the graph is not walked for that.
+        BaseEntity.new_run()
+        if self._algo_reversed:
+            self.algo_reversed = False
         self.variables.clear()
+        self._leads = []
 
+        # A compound action runs its actions one after the other, each
+        # service starting the next one as soon as it is done with the
+        # previous one. Each action runs on its own copy of the graph.
+        phases = [action]
         if conf:
             # Apply configuration over the graph
             self._apply_config(conf)
+            phases = (conf.get('compound_actions') or {}).get(action, phases)
+            compound, action = action, phases[-1]
             # Enable reverse mode if needed, based on config
             self.algo_reversed = action in conf.get('reverse_actions')
 
@@ -163,30 +366,132 @@ class ServiceManager(ServiceGroup):
         # Ensure all variables have been resolved
         self.resolve_all()
 
-        # Adapt the graph for required services
-        if services:
-            self.select_services(services)
+        for phase in phases[:-1]:
+            lead = self._clone()
+            lead.algo_reversed = phase in conf.get('reverse_actions')
+            self._leads.append(lead)
+        graphs = self._leads + [self]
+
+        try:
+            for graph in graphs:
+                # Adapt the graph for required services
+                if services:
+                    graph.select_services(services)
+
+                if conf and conf.get('nodeps'):
+                    graph._disable_deps()
+
+            if conf and conf.get('probe'):
+                unreachable = graphs[0]._probe(phases[0], conf['probe'])
+                for graph in graphs[1:]:
+                    if unreachable:
+                        graph.update_target(unreachable, 'DIF')
+
+            if self._leads:
+                self._compound_owners(compound)
 
-        if conf and conf.get('nodeps'):
-            self._disable_deps()
+            # Read-only commands do not need to wait for their dependencies
+            readonly = (conf and conf.get('readonly_actions')) or ()
+            prefetch = []
+            for graph, phase in zip(graphs, phases):
+                prefetch += graph.readonly_actions(phase, readonly)
+            action_manager_self().prefetch(prefetch)
 
-        self.run(action)
+            for idx in range(1, len(graphs)):
+                graphs[idx]._link_phase(graphs[idx - 1], phases[idx - 1])
 
-    def output_graph(self, services=None, excluded=None):
-        """Return service graph (DOT format)"""
-        grph = "digraph dependency {\n"
-        grph += "compound=true;\n"
-        #grph += "node [shape=circle];\n"
-        grph += "node [style=filled];\n"
-        for service in (services or sorted(self._subservices.keys())):
-            if not self._subservices[service].excluded(excluded):
-                grph += self._subservices[service].graph(excluded)
-        grph += '}\n'
-        return grph
+            # The last phase is prepared first: previous phases results are
+            # needed as long as the services waiting for them are.
+            self.origin = True
+            self.prepare(action)
+            # Previous phases are launched from their own graph
+            for lead, phase in zip(self._leads, phases):
+                lead.prepare(phase)
+            action_manager_self().run()
+        finally:
+            # Leave the loaded graph as it was
+            for graph in graphs:
+                graph._view.restore()
+
+    def output_graph(self, services=None, excluded=None, fmt='dot',
+                     collapse=False):
+        """Return service graph (DOT format by default)"""
+        return ''.join(self.iter_graph(services, excluded, fmt, collapse))
+
+    def iter_graph(self, services=None, excluded=None, fmt='dot',
+                   collapse=False):
+        """
+        Generate the service graph piece by piece, as 'dot', 'json' or
+        'edges' (one line per service, then one per dependency). With
+        collapse, groups are single nodes.
+        """
+        excluded = set(excluded or ())
+        memo = {}
+        roots = [self._subservices[name] for name in
+                 (services or sorted(self._subservices.keys()))]
+        roots = [svc for svc in roots if not svc.excluded(excluded, memo)]
+
+        if fmt == 'dot':
+            yield "digraph dependency {\n"
+            yield "compound=true;\n"
+            yield "node [style=filled];\n"
+            for svc in roots:
+                for line in svc.iter_graph(excluded, memo, collapse):
+                    yield line
+            yield '}\n'
+            return
+
+        def _edges():
+            """Iterate over (entity, dependency) of the graph output."""
+            for svc in roots:
+                for edge in svc.iter_edges(excluded, memo, collapse):
+                    yield edge
+
+        if fmt == 'json':
+            yield '{"services": ['
+            sep = '\n'
+            for entity, dep in _edges():
+                if dep is None:
+                    group = entity.parent and entity.parent.fullname()
+                    yield sep + json.dumps({'name': entity.fullname(),
+                                            'group': group or None})
+                    sep = ',\n'
+            yield '\n],\n"dependencies": ['
+            sep = '\n'
+            for entity, dep in _edges():
+                if dep is not None:
+                    yield sep + json.dumps({'source': entity.fullname(),
+                                            'target': dep.target.fullname(),
+                                            'type': dep.dep_type})
+                    sep = ',\n'
+            yield '\n]}\n'
+        elif fmt == 'edges':
+            for entity, dep in _edges():
+                if dep is None:
+                    yield '%s\n' % entity.fullname()
+                else:
+                    yield '%s\t%s\t%s\n' % (entity.fullname(),
+                                             dep.target.fullname(),
+                                             dep.dep_type)
+        else:
+            raise ValueError("Unknown graph format '%s'" % fmt)
 
     def load_config(self, conf):
         '''
         Load the configuration within the manager thanks to MilkCheckConfig
         '''
         from MilkCheck.config import load_from_dir
-        self.fromdict(load_from_dir(conf))
+        start = time.time()
+        # Targets are parsed again for each configuration
+        target_table_self().clear()
+        config = load_from_dir(conf)
+        # Resolve node groups of the configuration all at once
+        resolver = std_group_resolver()
+        if isinstance(resolver, GroupCache):
+            resolver.prefetch(GroupCache.config_groups(config))
+            resolver.save()
+        builder = GraphBuilder(self)
+        builder.build(config)
+        logging.getLogger('milkcheck').debug("%d services loaded in %.2fs",
+                                             builder.count,
+                                             time.time() - start)
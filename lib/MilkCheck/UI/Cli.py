@@ -39,12 +39,17 @@ specificities.
 
 # classes
 from __future__ import print_function
-import fcntl, termios, struct, os, sys, traceback, threading, select
+import fcntl, termios, struct, os, sys, traceback, threading, select, time
 from signal import SIGINT
-from ClusterShell.NodeSet import NodeSet
+from ClusterShell.NodeSet import NodeSet, std_group_resolver, \
+                                 set_std_group_resolver
 from MilkCheck.Callback import CoreEvent, call_back_self
 from MilkCheck.UI.OptionParser import McOptionParser
 from MilkCheck.Engine.Action import Action, action_manager_self
+from MilkCheck.Engine.ResultCache import ResultCache
+from MilkCheck.Engine.GroupCache import GroupCache
+from MilkCheck.Engine.History import DurationHistory
+from MilkCheck.Engine.Simulator import SimulatedTask, recommend_fanout
 from MilkCheck.Engine.Service import Service
 from MilkCheck.ServiceManager import ServiceManager
 from MilkCheck.config import ConfigParser, ConfigError
@@ -69,7 +74,7 @@ class UserError(Exception):
 # Symbols
 from MilkCheck.Engine.BaseEntity import WARNING, SKIPPED, LOCKED
 from MilkCheck.Engine.BaseEntity import TIMEOUT, ERROR, DEP_ERROR, DONE
-from MilkCheck.Engine.BaseEntity import NO_STATUS, WAITING_STATUS
+from MilkCheck.Engine.BaseEntity import NO_STATUS, WAITING_STATUS, CANCELLED
 
 # Definition of retcodes
 RC_OK = 0
@@ -150,7 +155,8 @@ class ConsoleDisplay(object):
                 'CYAN': '\033[0;36m%s\033[0m'
               }
     _LARGEST_STATUS = max([len(status) \
-         for status in (SKIPPED, WARNING, TIMEOUT, ERROR, DEP_ERROR, DONE)])
+         for status in (SKIPPED, WARNING, TIMEOUT, ERROR, DEP_ERROR, DONE,
+                        CANCELLED)])
 
     def __init__(self):
         width = Terminal.size()[0]
@@ -225,7 +231,7 @@ class ConsoleDisplay(object):
                 '[%s]' % \
                     self.string_color(
                     entity.status.center(self._LARGEST_STATUS), 'RED'))
-        elif entity.status in (WARNING, SKIPPED):
+        elif entity.status in (WARNING, SKIPPED, CANCELLED):
             line = line % (label,
                 '[%s]' % \
                 self.string_color(entity.status.center(self._LARGEST_STATUS),
@@ -248,6 +254,8 @@ class ConsoleDisplay(object):
         to_spell = 'action'
         error_nodes = NodeSet()
         all_error_nodes = NodeSet()
+        all_late_nodes = NodeSet()
+        all_unreachable_nodes = NodeSet()
         all_nodes = NodeSet()
 
         for ent in actions:
@@ -259,21 +267,39 @@ class ConsoleDisplay(object):
             if ent.status in (TIMEOUT, ERROR, DEP_ERROR):
                 error_nodes.add(errs)
                 error_nodes.add(timeouts)
+                error_nodes.add(ent.aborted_nodes)
                 lines.append(" + %s" % self.string_color(
                                                 ent.longname().strip(), 'RED'))
                 if report == 'full':
+                    command = ent.command
+                    if ent.worker is not None:
+                        command = ent.worker.command
                     msg = "    %s: %s\n" % (self.string_color("Target",
                                                               'YELLOW'),
                                           error_nodes)
                     msg += "    %s: %s" % (self.string_color("Command",
                                                              'YELLOW'),
-                                          ent.worker.command)
+                                          command)
                     lines.append(msg)
 
                 errors += 1
+            elif ent.status is CANCELLED:
+                lines.append(" + %s (%s)" % (
+                                 self.string_color(ent.longname().strip(),
+                                                   'YELLOW'),
+                                 CANCELLED.lower()))
+                others += 1
             elif ent.status not in (SKIPPED, LOCKED):
                 others += 1
+            # Completed without waiting for these nodes (quorum)
+            if ent.straggler_nodes:
+                lines.append(" + %s (stragglers: %s)" % (
+                                 self.string_color(ent.longname().strip(),
+                                                   'YELLOW'),
+                                 ent.straggler_nodes))
+                all_late_nodes.add(ent.straggler_nodes)
             all_error_nodes.add(error_nodes)
+            all_unreachable_nodes.add(ent.unreachable_nodes)
 
         # manage 'action(s)' spelling
         if (errors + others) > 1:
@@ -285,7 +311,12 @@ class ConsoleDisplay(object):
                        to_spell,
                        self.string_color(errors, (errors and 'RED' or 'GREEN')))
         lines.insert(0, header)
-        good_nodes = all_nodes - all_error_nodes
+        if all_unreachable_nodes:
+            lines.append(" + %s: %s" % (
+                             self.string_color('Unreachable nodes', 'RED'),
+                             all_unreachable_nodes))
+        good_nodes = all_nodes - all_error_nodes - all_late_nodes - \
+                     all_unreachable_nodes
         if report == 'full' and good_nodes:
             lines.append(" + %s" % self.string_color('Success on all services',
                                                      'GREEN'))
@@ -301,7 +332,8 @@ class ConsoleDisplay(object):
              self.string_color(action.command, 'CYAN'))
         self.output(line)
 
-    def __gen_action_output(self, iterbuf, iterrc, timeouts, error_only):
+    def __gen_action_output(self, iterbuf, iterrc, timeouts, error_only,
+                            aborted=None):
         '''Display command result from output and retcodes.'''
 
         # Build the list of non-zero rc nodes
@@ -330,6 +362,10 @@ class ConsoleDisplay(object):
             output.append(' > %s has %s' %
                           (self.string_color(timeouts, 'CYAN'),
                            self.string_color('timeout', 'RED')))
+        if aborted:
+            output.append(' > %s was %s' %
+                          (self.string_color(aborted, 'CYAN'),
+                           self.string_color('aborted', 'RED')))
         return output
 
     def print_action_results(self, action, error_only=False):
@@ -337,24 +373,34 @@ class ConsoleDisplay(object):
         line = ['%s %s ran in %.2f s' % \
             (self.string_color(action.name, 'MAGENTA'),
              action.parent.fullname(),
-             action.duration)]
+             action.duration or 0)]
         buffers = []
         retcodes = []
         timeout = NodeSet()
-        # Local action
-        if action.worker.current_node is None:
+        # Local action, no worker if aborted before its command was started
+        if action.worker is not None and action.worker.current_node is None:
             buffers = [(action.worker.read(), 'localhost')]
             if action.worker.did_timeout():
                 timeout.add('localhost')
             if action.worker.retcode() is not None:
                 retcodes.append((action.worker.retcode(),'localhost'))
         # Remote action
-        else:
+        elif action.worker is not None:
             buffers = action.worker.iter_buffers()
             retcodes = action.worker.iter_retcodes()
             timeout = NodeSet.fromlist(action.worker.iter_keys_timeout())
 
-        line += self.__gen_action_output(buffers, retcodes, timeout, error_only)
+        line += self.__gen_action_output(buffers, retcodes, timeout, error_only,
+                                         action.aborted_nodes)
+        if action.unreachable_nodes:
+            line.append(' > %s %s' % (
+                        self.string_color(action.unreachable_nodes, 'CYAN'),
+                        self.string_color('skipped as unreachable', 'RED')))
+        if action.straggler_nodes:
+            line.append(' > %s %s' % (
+                        self.string_color(action.straggler_nodes, 'CYAN'),
+                        self.string_color('still running at quorum',
+                                          'YELLOW')))
         self.output("\n".join(line))
 
     def print_delayed_action(self, action):
@@ -380,6 +426,14 @@ class ConsoleDisplay(object):
                 delayed = ''
                 if act.tries == 0 and act.delay:
                     delayed = " (delayed for %ss)" % act.delay
+                # Estimate remaining time from previous runs
+                expected = manager.expected_duration(act)
+                if expected is not None and act.start_time:
+                    remaining = expected - (time.time() - act.start_time)
+                    if remaining > 0:
+                        delayed += " (ETA %ds)" % remaining
+                    else:
+                        delayed += " (overdue)"
                 # Manage line length
                 label = act.fullname()
                 name_len = len(" > %s on " % label)
@@ -402,6 +456,30 @@ class ConsoleDisplay(object):
                                  self.string_color(target, 'CYAN'), nscount)
         self.output(msg)
 
+    def print_simulation(self, task, results=None):
+        '''Display predictions of a simulated run'''
+        lines = [self.string_color("\nSimulated run", 'MAGENTA')]
+        lines.append(" Predicted duration: %.2f s" % task.clock)
+        lines.append(" Fanout usage: %d%%" % round(task.utilization * 100))
+        lines.append(" Critical path:")
+        for act, start, stop in task.critical_path():
+            lines.append("  > %s %.2f s -> %.2f s" % (
+                         self.string_color(act.fullname(), 'YELLOW'),
+                         start, stop))
+        if task.unknown:
+            lines.append(" No history for %d action(s), assumed to take "
+                         "their timeout or %s s" % (len(task.unknown),
+                                                    task.DEFAULT_DURATION))
+        if results:
+            best = recommend_fanout([(fanout, duration)
+                                     for fanout, duration, _ in results])
+            lines.append(" %8s %12s %6s" % ('Fanout', 'Duration', 'Usage'))
+            for fanout, duration, usage in results:
+                lines.append(" %8d %10.2f s %5d%%%s" % (
+                             fanout, duration, round(usage * 100),
+                             ' (recommended)' if fanout == best else ''))
+        self.output('\n'.join(lines))
+
 class InteractiveThread(threading.Thread):
     '''
     Separated thread to manage user input
@@ -500,22 +578,56 @@ class CommandLine(CoreEvent):
         self._mop.configure_mop()
         retcode = RC_OK
 
+        # Node groups are resolved once for the whole run, including those
+        # of the command line nodesets
+        resolver = std_group_resolver()
+        if isinstance(resolver, GroupCache):
+            resolver = resolver.resolver
+        groups = GroupCache(resolver)
+        set_std_group_resolver(groups)
+
         try:
+            # Nodesets are parsed with the options, their groups are
+            # resolved all at once first
+            groups.prefetch(GroupCache.text_groups(
+                                self._mop.nodeset_values(command_line)))
             (self._options, self._args) = self._mop.parse_args(command_line)
 
             self._conf = ConfigParser(self._options)
+            if self._conf['group_cache_ttl'] > 0:
+                groups.load(self._conf['group_cache_file'],
+                            self._conf['group_cache_ttl'])
 
             # Configure ActionManager
             action_manager_self().default_fanout = self._conf['fanout']
             action_manager_self().dryrun = self._conf['dryrun']
+            action_manager_self().deadline = self._conf.get('deadline')
+            action_manager_self().failfast = self._conf.get('failfast')
+            action_manager_self().fairshare = self._conf.get('fairshare')
+            action_manager_self().skip_unreachable = \
+                                         self._conf.get('skip_unreachable')
+            action_manager_self().dedup = self._conf.get('dedup')
+            action_manager_self().unreachable = NodeSet()
+            action_manager_self().cache = None
+            if self._conf['cache_ttl'] > 0:
+                action_manager_self().cache = ResultCache(
+                              self._conf['cache_file'], self._conf['cache_ttl'])
+            action_manager_self().history = None
+            if self._conf['history_file']:
+                action_manager_self().history = DurationHistory(
+                        self._conf['history_file'], self._conf['auto_timeout'])
 
             self.manager = self.manager or ServiceManager()
             # Case 0: build the graph
             if self._conf.get('graph', False):
                 self.manager.load_config(self._conf['config_dir'])
-                # Deps graph generation
-                self._console.output(self.manager.output_graph(self._args,
-                                     self._conf.get('excluded_svc', [])))
+                # Deps graph generation, written as it is generated
+                for chunk in self.manager.iter_graph(self._args,
+                                    self._conf.get('excluded_svc', []),
+                                    self._conf.get('graph_format') or 'dot',
+                                    self._conf.get('collapse_groups')):
+                    sys.stdout.write(chunk)
+                sys.stdout.flush()
             # Case 1 : call services referenced in the manager with
             # the required action
             elif self._args:
@@ -535,7 +647,12 @@ class CommandLine(CoreEvent):
                     self.inter_thread.start()
 
                 # Run tasks
-                self.manager.call_services(services, action, conf=self._conf)
+                if self._conf.get('simulate_run') or \
+                   self._conf.get('simulate_fanout'):
+                    self._simulate(services, action)
+                else:
+                    self.manager.call_services(services, action,
+                                               conf=self._conf)
                 retcode = self.retcode()
 
                 if self._conf.get('report', 'no').lower() != 'no':
@@ -593,6 +710,38 @@ class CommandLine(CoreEvent):
 
         return retcode
 
+    def _simulate(self, services, action):
+        '''
+        Run services against a virtual clock, with each requested fanout,
+        then with the configured one, and display the predictions.
+        '''
+        history = action_manager_self().history
+        results = []
+        for fanout in self._conf.get('simulate_fanout') or []:
+            task = SimulatedTask(history)
+            state = action_manager_self().simulate(task)
+            action_manager_self().default_fanout = fanout
+            # Only the final run is displayed
+            call_back_self().detach(self)
+            try:
+                self.manager.call_services(services, action, conf=self._conf)
+            finally:
+                call_back_self().attach(self)
+                action_manager_self().end_simulation(state)
+            results.append((fanout, task.clock, task.utilization))
+        task = SimulatedTask(history)
+        state = action_manager_self().simulate(task)
+        action_manager_self().default_fanout = self._conf['fanout']
+        try:
+            self.manager.call_services(services, action, conf=self._conf)
+        finally:
+            action_manager_self().end_simulation(state)
+        if task.unknown:
+            self._logger.warning("No duration history for: %s" %
+                                 ', '.join(sorted(act.fullname() for act
+                                                  in task.unknown)))
+        self._console.print_simulation(task, results)
+
     def retcode(self):
         '''
         Determine a retcode from a the last point of the graph
@@ -649,7 +798,8 @@ class CommandLine(CoreEvent):
         if isinstance(obj, Service) and not (obj.status == SKIPPED and \
                                self._conf['verbosity'] < 3) and \
                                obj.status in (TIMEOUT, ERROR, DEP_ERROR, DONE,
-                               WARNING, SKIPPED) and not obj.simulate:
+                               WARNING, SKIPPED, CANCELLED) and \
+                               not obj.simulate:
 
             self._console.print_status(obj)
             self._console.print_running_tasks()
@@ -33,7 +33,7 @@
 This module contains the definition of the OptionParser for MilkCheck.
 '''
 
-from optparse import OptionParser, OptionGroup, Option
+from optparse import OptionParser, OptionGroup, Option, BadOptionError
 from copy import copy
 from os.path import isdir
 from ClusterShell.NodeSet import NodeSet, NodeSetException
@@ -90,6 +90,15 @@ class McOptionParser(OptionParser):
         self.add_option('-g', '--graph', action='store_true',
                         help='Output dependencies graph')
 
+        self.add_option('--graph-format', action='store', type='choice',
+                        dest='graph_format', choices=['dot', 'json', 'edges'],
+                        help='Format of the dependencies graph: dot '
+                             '(default), json or edges')
+
+        self.add_option('--collapse-groups', action='store_true',
+                        dest='collapse_groups',
+                        help='Show groups as single nodes in the graph')
+
         self.add_option('-s', '--summary', action='store_const',
                         dest='report', const='default',
                         help='--summary is an alias for --report=default')
@@ -137,6 +146,40 @@ class McOptionParser(OptionParser):
         eng.add_option('--nodeps', action='store_true', dest='nodeps',
                        default=False, help='Do not run dependencies')
 
+        eng.add_option('--deadline', action='store', type='float',
+                       dest='deadline',
+                       help='Abort everything still running after DEADLINE '
+                            'seconds')
+
+        eng.add_option('--fail-fast', action='store_true', dest='failfast',
+                       help='Cancel actions as soon as their result cannot '
+                            'change the final status')
+
+        eng.add_option('--fair-share', action='store_true', dest='fairshare',
+                       help='Share fanout fairly between running actions')
+
+        eng.add_option('--skip-unreachable', action='store_true',
+                       dest='skip_unreachable',
+                       help='Skip nodes found unreachable earlier in the run')
+
+        eng.add_option('--dedup', action='store_true', dest='dedup',
+                       help='Run identical commands only once per node')
+
+        eng.add_option('--probe', action='store', type='float', dest='probe',
+                       metavar='TIMEOUT',
+                       help='Remove nodes not reachable within TIMEOUT '
+                            'seconds before running')
+
+        eng.add_option('--simulate-run', action='store_true',
+                       dest='simulate_run',
+                       help='Predict the run from durations history, '
+                            'without running anything')
+
+        eng.add_option('--simulate-fanout', action='callback',
+                       dest='simulate_fanout', callback=self._check_fanouts,
+                       type='string', metavar='FANOUTS',
+                       help='Compare predicted runs with these fanouts')
+
         eng.add_option('-t', '--tags', action='callback', dest='tags',
                        callback=self._config_tags, type='string', default=set(),
                        help='Run services matching these tags')
@@ -170,8 +213,56 @@ class McOptionParser(OptionParser):
         else:
             getattr(self.values, _option.dest).update(tagslist)
 
+    def _check_fanouts(self, _option, _opt, _value, _parser):
+        '''Check the content of the option --simulate-fanout'''
+        try:
+            fanouts = sorted(set(int(value) for value in _value.split(',')))
+        except ValueError:
+            fanouts = []
+        if not fanouts or fanouts[0] < 1:
+            self.error('--simulate-fanout should be a list of positive '
+                       'integers')
+        setattr(self.values, _option.dest, fanouts)
+
     def _check_report(self, _option, _opt, _value, _parser):
         if _value in ('no', 'default', 'full'):
             setattr(self.values, _option.dest, _value)
         else:
             self.error('-r/--report should be "no", "default" or "full"')
+
+    def nodeset_values(self, args):
+        '''
+        Return the values given to the nodeset options in args, before
+        they are parsed, so that their node groups could be resolved
+        beforehand. Errors are left to parse_args().
+        '''
+        values = []
+        rargs = list(args)
+        while rargs:
+            arg = rargs.pop(0)
+            if arg == '--':
+                break
+            elif arg.startswith('--'):
+                opt, sep, value = arg.partition('=')
+                try:
+                    option = self._long_opt[self._match_long_opt(opt)]
+                except BadOptionError:
+                    continue
+                if option.takes_value() and not sep and rargs:
+                    value = rargs.pop(0)
+                if option.type == 'nodeset':
+                    values.append(value)
+            elif arg.startswith('-'):
+                # Short options could be grouped, as in -yn foo[1-5]
+                for idx, char in enumerate(arg[1:], 2):
+                    option = self._short_opt.get('-%s' % char)
+                    if option is None:
+                        break
+                    if option.takes_value():
+                        value = arg[idx:]
+                        if not value and rargs:
+                            value = rargs.pop(0)
+                        if option.type == 'nodeset':
+                            values.append(value)
+                        break
+        return values
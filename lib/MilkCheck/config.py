@@ -54,10 +54,20 @@ class ConfigParser(object):
          'config_dir':      { 'value': '/etc/milkcheck/conf', 'type': str },
          'fanout':          { 'value': 64, 'type': int },
          'reverse_actions': { 'value': ['stop'], 'type': list },
+         'compound_actions': { 'value': {}, 'type': dict },
          'summary':         { 'value': False, 'type': bool },
          'report':          { 'value': 'no', 'type': str,
                               'allowed_values': ('no', 'default', 'full') },
          'confirm_actions': { 'value': [], 'type': list },
+         'readonly_actions': { 'value': [], 'type': list },
+         'cache_ttl':       { 'value': 0, 'type': int },
+         'cache_file':      { 'value': '/var/cache/milkcheck/results.json',
+                              'type': str },
+         'group_cache_ttl': { 'value': 0, 'type': int },
+         'group_cache_file': { 'value': '/var/cache/milkcheck/groups.json',
+                               'type': str },
+         'history_file':    { 'value': '', 'type': str },
+         'auto_timeout':    { 'value': 0, 'type': int },
          }
 
     def __init__(self, options):
@@ -39,13 +39,17 @@ make PYTHON=%{__python_name}
 
 %install
 make install DESTDIR="%{buildroot}" PYTHON=%{__python_name} MANDIR=%{_mandir} \
-             SYSCONFIGDIR=%{_sysconfdir} VIMDATADIR=%{vimdatadir}
+             SYSCONFIGDIR=%{_sysconfdir} CACHEDIR=%{_localstatedir}/cache \
+             STATEDIR=%{_localstatedir}/lib \
+             VIMDATADIR=%{vimdatadir}
 
 %files
 %defattr(-,root,root,-)
 %config %{_sysconfdir}/%{name}/conf
 %config(noreplace) %{_sysconfdir}/%{name}/milkcheck.conf
 %{_bindir}/milkcheck
+%dir %{_localstatedir}/cache/%{name}
+%dir %{_localstatedir}/lib/%{name}
 %{_mandir}/man8/*
 %doc AUTHORS
 %doc README.md
@@ -0,0 +1,79 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the ActionJob
+"""
+
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.ActionJob import ActionJob, split_waves
+
+
+class SplitWavesTest(TestCase):
+    """Define the unit tests for split_waves()."""
+
+    def test_no_waves(self):
+        """Test target is a single wave without setting"""
+        self.assertEqual(split_waves(NodeSet('n[1-10]'), None),
+                         [NodeSet('n[1-10]')])
+
+    def test_size(self):
+        """Test waves of a given size"""
+        self.assertEqual(split_waves(NodeSet('n[1-10]'), {'size': 4}),
+                         [NodeSet('n[1-4]'), NodeSet('n[5-8]'),
+                          NodeSet('n[9-10]')])
+
+    def test_count(self):
+        """Test a given count of waves"""
+        self.assertEqual(split_waves(NodeSet('n[1-10]'), {'count': 2}),
+                         [NodeSet('n[1-5]'), NodeSet('n[6-10]')])
+        self.assertEqual(len(split_waves(NodeSet('n[1-10]'), {'count': 3})),
+                         3)
+
+    def test_percent(self):
+        """Test waves of a percentage of the target"""
+        self.assertEqual(split_waves(NodeSet('n[1-10]'), {'percent': 50}),
+                         [NodeSet('n[1-5]'), NodeSet('n[6-10]')])
+        self.assertEqual(len(split_waves(NodeSet('n[1-10]'), {'percent': 1})),
+                         10)
+
+
+class ActionJobTest(TestCase):
+    """Define the unit tests for the ActionJob."""
+
+    def setUp(self):
+        self.done = []
+        self.action = Action('start', target='n[1-4]', command='true')
+
+    def test_release_waves(self):
+        """Test next wave is released once the previous one completed"""
+        self.action.waves = {'size': 2}
+        job = ActionJob(self.action, 'true', self.done.append)
+        self.assertEqual(job.remaining, NodeSet('n[1-2]'))
+        nodes = job.take(10)
+        job.add_worker('wkr', nodes)
+        self.assertEqual(job.inflight, 2)
+        job.node_done('wkr', 'n1')
+        self.assertEqual(job.remaining, NodeSet())
+        job.node_done('wkr', 'n2')
+        self.assertEqual(job.remaining, NodeSet('n[3-4]'))
+        job.worker_done('wkr')
+        self.assertEqual(self.done, [])
+        job.add_worker('wkr2', job.take(10))
+        job.worker_done('wkr2')
+        self.assertEqual(self.done, [job])
+        self.assertEqual(job.skipped, NodeSet())
+
+    def test_stop_waves(self):
+        """Test waves are stopped when a wave has too many errors"""
+        self.action.waves = {'size': 1, 'errors': 0}
+        job = ActionJob(self.action, 'true', self.done.append)
+        job.add_worker('wkr', job.take(10))
+        job.worker_done('wkr')
+        self.assertEqual(self.done, [job])
+        self.assertEqual(job.skipped, NodeSet('n[2-4]'))
@@ -14,9 +14,12 @@ from ClusterShell.NodeSet import NodeSet
 from ClusterShell.Task import task_self
 
 from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, ERROR, TIMEOUT, \
-                                        DEP_ERROR, SKIPPED, WARNING
+                                        DEP_ERROR, SKIPPED, WARNING, FILTER
 from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
 from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.ServiceGroup import ServiceGroup
+from MilkCheck.Engine.ResultCache import ResultCache, StoredWorker
+from MilkCheck.Engine.History import DurationHistory
 from MilkCheckTests import setup_sshconfig, cleanup_sshconfig
 
 HOSTNAME = socket.gethostname().split('.')[0]
@@ -249,6 +252,229 @@ class ActionTest(TestCase):
         self.assertTrue(0.59 <= action.duration <= 0.8,
                         "%.3f is not between 0.59 and 0.8" % action.duration)
 
+    def test_deadline(self):
+        """Test action is aborted when its deadline is over"""
+        action = Action('start', command='/bin/sleep 3', target='node[1-3]')
+        action.mode = 'exec'
+        action.deadline = 0.3
+        service = Service('deadline')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, TIMEOUT)
+        self.assertEqual(action.aborted_nodes, NodeSet('node[1-3]'))
+        self.assertEqual(service.failed_nodes, NodeSet('node[1-3]'))
+        self.assertTrue(action.duration < 1,
+                        "%.3f is too long" % action.duration)
+
+    def test_deadline_retry(self):
+        """Test action deadline includes retries and delays"""
+        action = Action('start', command='/bin/false')
+        action.delay = 0.2
+        action.maxretry = 10
+        action.deadline = 0.5
+        service = Service('deadline')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, TIMEOUT)
+        self.assertTrue(action.tries < 4)
+        self.assertTrue(0.4 <= action.duration < 0.8,
+                        "%.3f is not between 0.4 and 0.8" % action.duration)
+
+    def test_cacheable(self):
+        """Test cacheable action reuses results of a previous run"""
+        cachefile = tempfile.NamedTemporaryFile(suffix='.json')
+        action = Action('status', command='echo %h', target='node[1-3]')
+        action.mode = 'exec'
+        action.cacheable = True
+        start = Action('start', command='/bin/true', target='node[1-3]')
+        start.mode = 'exec'
+        service = Service('cached')
+        service.add_actions(action, start)
+        action_manager_self().cache = ResultCache(cachefile.name, 60)
+        try:
+            service.run('status')
+            self.assertEqual(action.status, DONE)
+            self.assertFalse(isinstance(action.worker, StoredWorker))
+
+            # Second run uses the cache, even from another manager
+            action_manager_self().cache = ResultCache(cachefile.name, 60)
+            service.reset()
+            service.run('status')
+            self.assertEqual(action.status, DONE)
+            self.assertTrue(isinstance(action.worker, StoredWorker))
+            self.assertEqual(action.nodes_error(), NodeSet())
+            self.assertEqual(sorted((bytes(buf), NodeSet.fromlist(nodes))
+                                    for buf, nodes in
+                                    action.worker.iter_buffers()),
+                             [(b'node1', NodeSet('node1')),
+                              (b'node2', NodeSet('node2')),
+                              (b'node3', NodeSet('node3'))])
+
+            # Another action could change the service state
+            service.reset()
+            service.run('start')
+            service.reset()
+            service.run('status')
+            self.assertFalse(isinstance(action.worker, StoredWorker))
+        finally:
+            action_manager_self().cache = None
+
+    def test_cacheable_failure(self):
+        """Test failed results are not cached"""
+        cachefile = tempfile.NamedTemporaryFile(suffix='.json')
+        action = Action('status', command='/bin/false', target='node1')
+        action.mode = 'exec'
+        action.cacheable = True
+        service = Service('cached')
+        service.add_action(action)
+        action_manager_self().cache = ResultCache(cachefile.name, 60)
+        try:
+            service.run('status')
+            self.assertEqual(action.status, ERROR)
+            service.reset()
+            service.run('status')
+            self.assertEqual(action.status, ERROR)
+            self.assertFalse(isinstance(action.worker, StoredWorker))
+        finally:
+            action_manager_self().cache = None
+
+    def test_cacheable_failed_nodes(self):
+        """Test failed nodes of a cached result are filtered again"""
+        cachefile = tempfile.NamedTemporaryFile(suffix='.json')
+        action = Action('status', command='test %h != node2',
+                        target='node[1-3]')
+        action.mode = 'exec'
+        action.cacheable = True
+        action.errors = 1
+        action.warnings = 1
+        service = Service('cached')
+        service.add_action(action)
+        filtered = Action('status', command='/bin/true', target='node[1-3]')
+        filtered.mode = 'exec'
+        consumer = Service('consumer')
+        consumer.add_action(filtered)
+        consumer.add_dep(service, sgth=FILTER)
+        action_manager_self().cache = ResultCache(cachefile.name, 60)
+        try:
+            consumer.run('status')
+            self.assertEqual(action.status, DONE)
+            self.assertEqual(filtered.target, NodeSet('node[1,3]'))
+            service.reset()
+            consumer.reset()
+            consumer.run('status')
+            self.assertTrue(isinstance(action.worker, StoredWorker))
+            self.assertEqual(action.status, DONE)
+            self.assertEqual(filtered.target, NodeSet('node[1,3]'))
+        finally:
+            action_manager_self().cache = None
+
+    def test_history(self):
+        """Test durations are recorded and give an automatic timeout"""
+        dbfile = tempfile.NamedTemporaryFile(suffix='.db')
+        action = Action('start', command='sleep 0.1', target='node[1-2]')
+        action.mode = 'exec'
+        service = Service('history')
+        service.add_action(action)
+        action_manager_self().history = DurationHistory(dbfile.name, 2)
+        try:
+            for _ in range(DurationHistory.MIN_SAMPLES):
+                service.reset()
+                service.run('start')
+                self.assertEqual(action.status, DONE)
+            self.assertEqual(sorted(action.node_durations), ['node1', 'node2'])
+            self.assertTrue(0.1 <= action.node_durations['node1'] < 1)
+
+            # Now longer than usual
+            action_manager_self().history = DurationHistory(dbfile.name, 2)
+            self.assertTrue(action_manager_self().expected_duration(action)
+                            >= 0.1)
+            action.command = 'sleep 3'
+            service.reset()
+            service.run('start')
+            self.assertEqual(action.status, TIMEOUT)
+            self.assertTrue(action.duration < 2)
+        finally:
+            action_manager_self().history = None
+
+    def test_waves(self):
+        """Test action target is run by consecutive waves"""
+        action = Action('start', command='sleep 0.1', target='node[1-6]')
+        action.mode = 'exec'
+        action.waves = {'count': 3}
+        service = Service('waves')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, DONE)
+        self.assertEqual(NodeSet.fromlist(
+                          nodes for _, nodes in action.worker.iter_retcodes()),
+                         NodeSet('node[1-6]'))
+        self.assertTrue(action.duration >= 0.3,
+                        "%.3f is too short" % action.duration)
+
+    def test_waves_overlap(self):
+        """Test next wave could start while the previous one drains"""
+        action = Action('start', command='sleep 0.2', target='node[1-6]')
+        action.mode = 'exec'
+        action.waves = {'size': 2, 'overlap': 100}
+        service = Service('waves')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, DONE)
+        self.assertTrue(action.duration < 0.45,
+                        "%.3f is too long" % action.duration)
+
+    def test_waves_errors(self):
+        """Test waves stop when a wave has too many errors"""
+        action = Action('start', command='false', target='node[1-6]')
+        action.mode = 'exec'
+        action.waves = {'size': 2, 'errors': 1}
+        service = Service('waves')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.nodes_error(), NodeSet('node[1-2]'))
+        self.assertEqual(action.aborted_nodes, NodeSet('node[3-6]'))
+        self.assertEqual(service.failed_nodes, NodeSet('node[1-6]'))
+
+    def test_quorum(self):
+        """Test action completes when its quorum is reached"""
+        action = Action('start', target='node[1-4]',
+                        command='if [ %h = node4 ]; then sleep 1; fi')
+        action.mode = 'exec'
+        action.quorum = 75
+        service = Service('quorum')
+        service.add_action(action)
+        dep_action = Action('start', command='true', target='node[1-4]')
+        dep_action.mode = 'exec'
+        dep = Service('dep')
+        dep.add_action(dep_action)
+        dep.add_dep(service)
+        dep.run('start')
+        self.assertEqual(action.status, DONE)
+        self.assertEqual(action.straggler_nodes, NodeSet('node4'))
+        self.assertEqual(dep.status, DONE)
+        # Stragglers are filtered out of dependents
+        self.assertEqual(dep_action.target, NodeSet('node[1-3]'))
+        self.assertTrue(dep_action.start_time - action.start_time < 0.8)
+        # Stragglers ran until the end
+        self.assertEqual(NodeSet.fromlist(
+                          nodes for _, nodes in action.worker.iter_retcodes()),
+                         NodeSet('node[1-4]'))
+
+    def test_quorum_errors(self):
+        """Test quorum status only counts completed nodes"""
+        action = Action('start', target='node[1-4]',
+                        command='if [ %h = node4 ]; then sleep 1; fi; '
+                                '[ %h != node1 ]')
+        action.mode = 'exec'
+        action.quorum = 75
+        service = Service('quorum')
+        service.add_action(action)
+        service.run('start')
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.straggler_nodes, NodeSet('node4'))
+        self.assertEqual(service.failed_nodes, NodeSet('node[1,4]'))
+
     def test_schedule(self):
         """Test behaviour method schedule"""
         a1 = Action(name='start', command='/bin/true')
@@ -560,6 +786,155 @@ class ActionManagerTest(TestCase):
         self.assertTrue(action.duration < 0.5,
                         "Too long: %.2f > 0.5" % action.duration)
 
+    def test_run_deadline(self):
+        """Test run-wide deadline aborts actions and their dependents"""
+        action = Action('start', command='/bin/sleep 3')
+        svc = Service('slow')
+        svc.add_action(action)
+        dep_action = Action('start', command='/bin/true')
+        dep = Service('dependent')
+        dep.add_action(dep_action)
+        dep.add_dep(svc)
+        action_manager_self().deadline = 0.3
+        dep.run('start')
+        self.assertTrue(action_manager_self().expired)
+        self.assertEqual(action.status, TIMEOUT)
+        self.assertEqual(svc.status, TIMEOUT)
+        self.assertEqual(dep.status, DEP_ERROR)
+        self.assertEqual(dep_action.status, NO_STATUS)
+        self.assert_near(0.3, 0.2, action.duration)
+
+    def test_fair_share(self):
+        """Test fair-share lets small actions run beside large ones"""
+        grp = ServiceGroup('group')
+        big = Action('start', command='sleep 0.2', target='node[1-16]')
+        big.mode = 'exec'
+        small = Action('start', command='sleep 0.2', target='node[1-2]')
+        small.mode = 'exec'
+        for name, action in (('big', big), ('small', small)):
+            svc = Service(name)
+            svc.add_action(action)
+            grp.add_inter_dep(svc)
+        action_manager_self().default_fanout = 4
+        action_manager_self().fairshare = True
+        grp.run('start')
+        self.assertEqual(big.status, DONE)
+        self.assertEqual(small.status, DONE)
+        self.assertTrue(small.duration < 0.45,
+                        "%.3f is too long" % small.duration)
+        self.assertTrue(big.duration >= 0.6,
+                        "%.3f is too short" % big.duration)
+        self.assertEqual(NodeSet.fromlist(
+                             nodes for _, nodes in big.worker.iter_retcodes()),
+                         NodeSet('node[1-16]'))
+        self.assertEqual(big.pending_target, NodeSet())
+
+    def test_fair_share_errors(self):
+        """Test fair-share merges errors of all parts"""
+        action = Action('start', command='false', target='node[1-6]')
+        action.mode = 'exec'
+        svc = Service('svc')
+        svc.add_action(action)
+        action_manager_self().default_fanout = 2
+        action_manager_self().fairshare = True
+        svc.run('start')
+        self.assertEqual(action.status, ERROR)
+        self.assertEqual(action.nodes_error(), NodeSet('node[1-6]'))
+        self.assertEqual(svc.failed_nodes, NodeSet('node[1-6]'))
+
+    def test_fair_share_deadline(self):
+        """Test fair-share actions could be aborted"""
+        action = Action('start', command='sleep 3', target='node[1-8]')
+        action.mode = 'exec'
+        svc = Service('svc')
+        svc.add_action(action)
+        action_manager_self().default_fanout = 2
+        action_manager_self().fairshare = True
+        action_manager_self().deadline = 0.3
+        svc.run('start')
+        self.assertEqual(action.status, TIMEOUT)
+        self.assertEqual(action.aborted_nodes, NodeSet('node[1-8]'))
+        self.assert_near(0.3, 0.2, action.duration)
+
+    def test_dedup(self):
+        """Test identical commands run only once per node"""
+        log = tempfile.NamedTemporaryFile('r')
+        grp = ServiceGroup('group')
+        actions = []
+        for name, target in (('S1', 'node[1-3]'), ('S2', 'node[2-4]'),
+                             ('S3', 'node[1-2]')):
+            action = Action('start', target=target,
+                            command='echo %%h >> %s; sleep 0.2; '
+                                    'test %%h != node4' % log.name)
+            action.mode = 'exec'
+            svc = Service(name)
+            svc.add_action(action)
+            grp.add_inter_dep(svc)
+            actions.append(action)
+        action_manager_self().dedup = True
+        grp.run('start')
+        self.assertEqual(sorted(log.read().split()),
+                         ['node1', 'node2', 'node3', 'node4'])
+        self.assertEqual([action.status for action in actions],
+                         [DONE, ERROR, DONE])
+        self.assertEqual(actions[1].nodes_error(), NodeSet('node4'))
+        self.assertEqual(NodeSet.fromlist(
+                             nodes for _, nodes in
+                             actions[1].worker.iter_retcodes()),
+                         NodeSet('node[2-4]'))
+
+    def test_dedup_aborted(self):
+        """Test nodes aborted by another action are run again"""
+        grp = ServiceGroup('group')
+        actions = []
+        for name in ('S1', 'S2'):
+            action = Action('start', command='sleep 0.5',
+                            target='node[1-2]')
+            action.mode = 'exec'
+            svc = Service(name)
+            svc.add_action(action)
+            grp.add_inter_dep(svc)
+            actions.append(action)
+        actions[0].deadline = 0.2
+        action_manager_self().dedup = True
+        grp.run('start')
+        self.assertEqual(actions[0].status, TIMEOUT)
+        self.assertEqual(actions[0].aborted_nodes, NodeSet('node[1-2]'))
+        self.assertEqual(actions[1].status, DONE)
+
+    def test_skip_unreachable(self):
+        """Test nodes known as unreachable are removed from targets"""
+        action = Action('start', command='true', target='node[1-3]')
+        action.mode = 'exec'
+        svc = Service('svc')
+        svc.add_action(action)
+        action_manager_self().skip_unreachable = True
+        action_manager_self().unreachable = NodeSet('node2')
+        svc.run('start')
+        self.assertEqual(action.status, DONE)
+        self.assertEqual(action.target, NodeSet('node[1,3]'))
+        self.assertEqual(action.unreachable_nodes, NodeSet('node2'))
+        self.assertEqual(svc.failed_nodes, NodeSet('node2'))
+
+    def test_record_unreachable(self):
+        """Test unreachable nodes are recorded from action results"""
+        action = Action('start', command='true', target='node[1-3]')
+        action.worker = StoredWorker('true', [], [(0, 'node1'),
+                                                  (255, 'node2'),
+                                                  (1, 'node3')])
+        manager = action_manager_self()
+        manager.record_unreachable(action)
+        self.assertEqual(manager.unreachable, NodeSet())
+        manager.skip_unreachable = True
+        action.mode = 'exec'
+        manager.record_unreachable(action)
+        self.assertEqual(manager.unreachable, NodeSet())
+        action.mode = None
+        manager.record_unreachable(action)
+        self.assertEqual(manager.unreachable, NodeSet('node2'))
+        self.assertEqual(manager.unreachable_in(NodeSet('node[2-3]')),
+                         NodeSet('node2'))
+
     def test_perform_action_bad_service(self):
         '''test perform action with a simulate service hooked to the action'''
         action = Action(name='start', command=':')
@@ -55,6 +55,28 @@ class BaseEntityTest(unittest.TestCase):
         ent.update_target('fortoy8', mode='INT')
         self.assertTrue(ent.target == NodeSet('fortoy8'))
 
+    def test_shared_target(self):
+        '''Test entities share parsed targets until one updates it'''
+        ent1 = BaseEntity(name='foo', target='fortoy[5-10]')
+        ent2 = BaseEntity(name='bar', target='fortoy[5-10]')
+        ent3 = BaseEntity(name='baz')
+        ent3.inherits_from(ent1)
+        self.assertTrue(ent1.target is ent2.target)
+        self.assertTrue(ent3.target is ent1.target)
+        ent2.update_target('fortoy[4-6]', mode='DIF')
+        self.assertEqual(ent2.target, NodeSet('fortoy[7-10]'))
+        self.assertEqual(ent1.target, NodeSet('fortoy[5-10]'))
+        self.assertEqual(ent3.target, NodeSet('fortoy[5-10]'))
+        ent2.reset()
+        self.assertEqual(ent2.target, NodeSet('fortoy[5-10]'))
+
+    def test_shared_text_target(self):
+        '''Test text targets, unicode with Python 2, are shared'''
+        ent1 = BaseEntity(name='foo', target=u'fortoy[5-10]')
+        ent2 = BaseEntity(name='bar', target='fortoy[5-10]')
+        self.assertTrue(ent1.target is ent2.target)
+        self.assertEqual(ent1.target, NodeSet('fortoy[5-10]'))
+
     def test_reset_entity(self):
         '''Test reset entity'''
         ent = BaseEntity(name='foo', target='fortoy5')
@@ -64,6 +86,21 @@ class BaseEntityTest(unittest.TestCase):
         self.assertEqual(ent._algo_reversed, False)
         self.assertEqual(ent.status, NO_STATUS)
 
+    def test_new_run(self):
+        '''Test entity state is reset when first used by a new run'''
+        ent = BaseEntity(name='foo', target='fortoy[5-10]')
+        ent.status = DONE
+        ent.failed_nodes.add('fortoy5')
+        ent.update_target('fortoy[4-6]', mode='DIF')
+        ent.algo_reversed = True
+        BaseEntity.new_run()
+        self.assertEqual(ent.status, NO_STATUS)
+        self.assertEqual(ent.failed_nodes, NodeSet())
+        self.assertEqual(ent.target, NodeSet('fortoy[5-10]'))
+        self.assertEqual(ent._algo_reversed, True)
+        ent.status = DONE
+        self.assertEqual(ent.status, DONE)
+
     def test_add_dep_parents(self):
         """Test method add dependency for parents"""
         ent = BaseEntity('foo')
@@ -0,0 +1,106 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the DedupRegistry
+"""
+
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Dedup import DedupRun, DedupRegistry
+from MilkCheck.Engine.ResultCache import StoredWorker
+
+
+class DedupRegistryTest(TestCase):
+    """Define the unit tests for DedupRegistry."""
+
+    def setUp(self):
+        self.registry = DedupRegistry()
+        self.done = []
+
+    def _run(self, target, key='true'):
+        """Build a run of `true' over target."""
+        action = Action('status', command='true', target=target)
+        return DedupRun(action, 'true', key, self.done.append)
+
+    def test_claim_fresh(self):
+        """Test nodes nobody ran are left to the run"""
+        run = self._run('n[1-3]')
+        self.assertEqual(self.registry.claim(run, run.action.target),
+                         NodeSet('n[1-3]'))
+        self.assertEqual(run.waiting, NodeSet())
+
+    def test_claim_running(self):
+        """Test nodes running for another run are waited for"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        second = self._run('n[2-4]')
+        self.assertEqual(self.registry.claim(second, second.action.target),
+                         NodeSet('n4'))
+        self.assertEqual(second.waiting, NodeSet('n[2-3]'))
+
+    def test_claim_other_key(self):
+        """Test runs of different commands are not shared"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        second = self._run('n[2-4]', key='false')
+        self.assertEqual(self.registry.claim(second, second.action.target),
+                         NodeSet('n[2-4]'))
+        self.assertEqual(second.waiting, NodeSet())
+
+    def test_publish(self):
+        """Test results are shared with waiting runs"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        second = self._run('n[2-4]')
+        self.registry.claim(second, second.action.target)
+        worker = StoredWorker('true', [(b'ok', 'n[1-3]')], [(0, 'n[1-3]')])
+        self.assertEqual(self.registry.publish(first, worker,
+                                               NodeSet('n[1-3]')),
+                         [(second, NodeSet())])
+        self.assertEqual(second.waiting, NodeSet())
+        retcodes = [(rc, str(nodes)) for wrk in second.worker.workers
+                    for rc, nodes in wrk.iter_retcodes()]
+        self.assertEqual(retcodes, [(0, 'n[2-3]')])
+
+    def test_publish_lost(self):
+        """Test nodes without result are given back to waiting runs"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        second = self._run('n[2-4]')
+        self.registry.claim(second, second.action.target)
+        # The first run was aborted before n3 completed
+        worker = StoredWorker('true', [], [(0, 'n[1-2]')])
+        self.assertEqual(self.registry.publish(first, worker,
+                                               NodeSet('n[1-3]')),
+                         [(second, NodeSet('n3'))])
+        self.assertEqual(second.waiting, NodeSet())
+
+    def test_claim_known(self):
+        """Test results of completed runs are reused"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        worker = StoredWorker('true', [], [(1, 'n[1-3]')])
+        self.registry.publish(first, worker, NodeSet('n[1-3]'))
+        second = self._run('n[2-4]')
+        self.assertEqual(self.registry.claim(second, second.action.target),
+                         NodeSet('n4'))
+        self.assertEqual(second.waiting, NodeSet())
+        retcodes = [(rc, str(nodes)) for wrk in second.worker.workers
+                    for rc, nodes in wrk.iter_retcodes()]
+        self.assertEqual(retcodes, [(1, 'n[2-3]')])
+
+    def test_abort_without_worker(self):
+        """Test aborting a run waiting for others finishes it"""
+        first = self._run('n[1-3]')
+        self.registry.claim(first, first.action.target)
+        second = self._run('n[2-3]')
+        self.registry.claim(second, second.action.target)
+        second.abort()
+        self.assertEqual(self.done, [second])
+        self.assertTrue(second.finished)
+        self.assertEqual(second.waiting, NodeSet())
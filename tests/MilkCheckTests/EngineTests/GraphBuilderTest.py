@@ -0,0 +1,235 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the GraphBuilder
+"""
+
+import copy
+import logging
+import time
+from unittest import TestCase
+
+from MilkCheck.Engine.BaseEntity import BaseEntity, UnknownDependencyError
+from MilkCheck.Engine.ServiceGroup import ServiceGroup
+from MilkCheck.Engine.GraphBuilder import GraphBuilder
+
+PROPERTIES = ('target', 'mode', 'remote', 'fanout', 'timeout', 'deadline',
+              'delay', 'maxretry', 'errors', 'warnings', 'desc', 'tags',
+              'variables')
+
+CONFIG = {
+    'variables': {'NODES': 'node[1-4]'},
+    'fanout': 8,
+    'services': {
+        'grpA': {
+            'target': '%NODES',
+            'timeout': 10,
+            'budget': {'services': 2},
+            'services': {
+                'svc[1-3]': {
+                    'variables': {'DEP': 'svc4'},
+                    'require_weak': '%DEP',
+                    'actions': {'start,stop': {'cmd': 'true', 'retry': 2}},
+                },
+                'svc4': {
+                    'desc': 'Last one',
+                    'actions': {
+                        'start': {'cmd': 'true', 'check': ['status']},
+                        'status': {'cmd': 'true'},
+                    },
+                },
+                'sub': {
+                    'mode': 'exec',
+                    'after': ['svc1'],
+                    'services': {
+                        'leaf': {'tags': ['a'],
+                                 'actions': {'start': {'cmd': 'true'}}},
+                    },
+                },
+            },
+        },
+        'grpB': {
+            'require': ['grpA'],
+            'services': {
+                'svc1': {
+                    'require': ['grpA.svc4'],
+                    'require_filter': ['svc2'],
+                    'actions': {'start': {'cmd': 'true'}},
+                },
+                'svc2': {
+                    'remote': False,
+                    'actions': {'start': {'cmd': 'true'}},
+                },
+                'svc3': {
+                    'require': ['sub.leaf'],
+                    'check': ['svc2'],
+                    'actions': {'start': {'cmd': 'true'}},
+                },
+            },
+        },
+        'alone': {
+            'before': 'grpB',
+            'actions': {'start': {'cmd': 'true'}},
+        },
+    },
+}
+
+
+def signature(entity):
+    """Return a comparable description of entity and its subgraph."""
+    def _deps(deps):
+        return sorted((name, dep.dep_type, dep.target.fullname())
+                      for name, dep in deps.items())
+
+    sign = {'class': type(entity).__name__,
+            'fullname': entity.fullname(),
+            'parents': _deps(entity.parents),
+            'children': _deps(entity.children)}
+    for prop in PROPERTIES:
+        sign[prop] = getattr(entity, prop)
+    if hasattr(entity, '_subservices'):
+        sign['budget'] = (entity.max_services, entity.max_connections)
+        sign['source'] = _deps(entity._source.parents)
+        sign['sink'] = _deps(entity._sink.children)
+        sign['services'] = dict((name, signature(svc)) for name, svc
+                                in entity._subservices.items())
+    if hasattr(entity, 'command'):
+        sign['command'] = entity.command
+    if hasattr(entity, '_actions'):
+        sign['actions'] = dict((name, signature(action)) for name, action
+                               in entity._actions.items())
+    return sign
+
+
+class GraphBuilderTest(TestCase):
+    """Define the unit tests for GraphBuilder."""
+
+    def assert_same_graph(self, config):
+        """Build config with both ways and compare the graphs"""
+        expected = ServiceGroup('MAIN', root=True)
+        expected.fromdict(copy.deepcopy(config))
+        builder = GraphBuilder(ServiceGroup('MAIN', root=True))
+        built = builder.build(copy.deepcopy(config))
+        self.assertEqual(signature(built), signature(expected))
+        return builder
+
+    def test_same_graph(self):
+        """Test the builder builds the same graph than fromdict()"""
+        builder = self.assert_same_graph(CONFIG)
+        self.assertEqual(builder.count, 12)
+
+        # The same name in two groups: C.x requires the svc of B, found
+        # through the C dependencies, even if the one of A is built first.
+        start = {'start': {'cmd': 'true'}}
+        config = {'services': {
+            'A': {'services': {'svc': {'actions': start}}},
+            'B': {'services': {'svc': {'actions': start}}},
+            'C': {'require': ['B'],
+                  'services': {'x': {'require': ['svc'],
+                                     'actions': start}}}}}
+        built = self.assert_same_graph(config).root
+        svc = built._subservices['C']._subservices['x'].parents['svc']
+        self.assertTrue(svc.target is
+                        built._subservices['B']._subservices['svc'])
+
+        # Neither finds a service of an enclosing group
+        config = {'services': {
+            'svc1': {'actions': start},
+            'grp': {'services': {'svc2': {'require': ['svc1'],
+                                          'actions': start}}}}}
+        self.assertRaises(UnknownDependencyError,
+                          ServiceGroup('MAIN', root=True).fromdict,
+                          copy.deepcopy(config))
+        self.assertRaises(UnknownDependencyError,
+                          GraphBuilder(ServiceGroup('MAIN', root=True)).build,
+                          copy.deepcopy(config))
+
+    def test_config_unchanged(self):
+        """Test the configuration dict is not modified"""
+        config = copy.deepcopy(CONFIG)
+        GraphBuilder(ServiceGroup('MAIN', root=True)).build(config)
+        self.assertEqual(config, CONFIG)
+
+    def test_unknown_dependency(self):
+        """Test an unknown dependency raises UnknownDependencyError"""
+        builder = GraphBuilder(ServiceGroup('MAIN', root=True))
+        self.assertRaises(UnknownDependencyError, builder.build,
+                          {'services': {'svc': {'require': ['other']}}})
+
+    def test_local_dependencies(self):
+        """Test dependencies on subservices do not search the graph"""
+        config = {'services': {}}
+        for grp in range(3):
+            services = {}
+            for idx in range(20):
+                props = {'actions': {'start': {'cmd': 'true'}}}
+                if idx:
+                    props['require'] = ['svc%d' % (idx - 1)]
+                services['svc%d' % idx] = props
+            config['services']['grp%d' % grp] = {'services': services}
+            if grp:
+                config['services']['grp%d' % grp]['require'] = \
+                    ['grp%d' % (grp - 1)]
+
+        searched = []
+        search = ServiceGroup.search
+        def _search(group, name, reverse=False):
+            searched.append(name)
+            return search(group, name, reverse)
+        ServiceGroup.search = _search
+        try:
+            builder = GraphBuilder(ServiceGroup('MAIN', root=True))
+            builder.build(config)
+        finally:
+            ServiceGroup.search = search
+        self.assertEqual(searched, [])
+        self.assertEqual(builder.count, 63)
+
+    def test_indexed_dependencies(self):
+        """Test dependencies outside the group do not search the graph"""
+        searched = []
+        search = BaseEntity.search
+        def _search(entity, name, reverse=False):
+            searched.append(name)
+            return search(entity, name, reverse)
+        BaseEntity.search = _search
+        try:
+            builder = GraphBuilder(ServiceGroup('MAIN', root=True))
+            built = builder.build(copy.deepcopy(CONFIG))
+        finally:
+            BaseEntity.search = search
+        self.assertEqual(searched, [])
+        grpb = built._subservices['grpB']
+        self.assertTrue('svc4' in grpb._subservices['svc1'].parents)
+        self.assertTrue('leaf' in grpb._subservices['svc3'].parents)
+
+    def test_large_config(self):
+        """Test and report the load time of a large configuration"""
+        # 50 groups of 100 services, each group requires the previous one
+        # and its first service the last one of the previous group.
+        config = {'services': {}}
+        for grp in range(50):
+            services = {}
+            for idx in range(100):
+                props = {'actions': {'start': {'cmd': 'true'}}}
+                if idx:
+                    props['require'] = ['svc%d' % (idx - 1)]
+                services['svc%d' % idx] = props
+            config['services']['grp%d' % grp] = {'services': services}
+            if grp:
+                config['services']['grp%d' % grp]['require'] = \
+                    ['grp%d' % (grp - 1)]
+                services['svc0']['require'] = ['grp%d.svc99' % (grp - 1)]
+
+        start = time.time()
+        builder = GraphBuilder(ServiceGroup('MAIN', root=True))
+        built = builder.build(config)
+        logging.getLogger('milkcheck').info("%d services built in %.2fs",
+                                            builder.count,
+                                            time.time() - start)
+        self.assertEqual(builder.count, 5050)
+        svc = built._subservices['grp49']._subservices['svc0']
+        self.assertTrue(svc.parents['svc99'].target is
+                        built._subservices['grp48']._subservices['svc99'])
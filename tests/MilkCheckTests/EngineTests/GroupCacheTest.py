@@ -0,0 +1,119 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the GroupCache
+"""
+
+import os
+import json
+import time
+import tempfile
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+from ClusterShell.NodeUtils import GroupResolver, GroupSource
+from ClusterShell.NodeUtils import GroupResolverSourceError
+
+from MilkCheck.Engine.GroupCache import GroupCache
+
+
+class CountingResolver(GroupResolver):
+    """Group resolver counting the groups it resolves."""
+
+    def __init__(self, groups):
+        GroupResolver.__init__(self, GroupSource('test', groups))
+        self.add_source(GroupSource('other', {'grp': 'bar[1-2]'}))
+        self.resolved = []
+
+    def group_nodes(self, group, namespace=None):
+        self.resolved.append((group, namespace))
+        return GroupResolver.group_nodes(self, group, namespace)
+
+
+class GroupCacheTest(TestCase):
+    """Define the unit tests for the GroupCache."""
+
+    def setUp(self):
+        self.resolver = CountingResolver({'grp': 'foo[1-3]',
+                                          'io': 'io[1-2]'})
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'groups.json')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def test_config_groups(self):
+        """Test groups of targets and variables are collected"""
+        config = {
+            'variables': {'IO': '@io', 'NUM': 3},
+            'services': {
+                'svc': {
+                    'target': '@grp,@other:grp!foo1',
+                    'actions': {'start': {'cmd': 'mail root@localhost',
+                                          'target': '%IO'}},
+                },
+            },
+        }
+        self.assertEqual(GroupCache.config_groups(config),
+                         set([('io', None), ('grp', None),
+                              ('grp', 'other')]))
+
+    def test_text_groups(self):
+        """Test groups of strings are collected, unicode ones included"""
+        self.assertEqual(GroupCache.text_groups(['@grp,foo1', u'@io', 3,
+                                                 None, 'foo[1-2]']),
+                         set([('grp', None), ('io', None)]))
+
+    def test_group_nodes(self):
+        """Test a group is resolved once"""
+        cache = GroupCache(self.resolver)
+        self.assertEqual(NodeSet('@grp', resolver=cache), NodeSet('foo[1-3]'))
+        self.assertEqual(NodeSet('@grp', resolver=cache), NodeSet('foo[1-3]'))
+        self.assertEqual(NodeSet('@other:grp', resolver=cache),
+                         NodeSet('bar[1-2]'))
+        self.assertEqual(self.resolver.resolved,
+                         [('grp', None), ('grp', 'other')])
+
+    def test_prefetch(self):
+        """Test prefetched groups are not resolved again"""
+        cache = GroupCache(self.resolver)
+        cache.prefetch([('grp', None), ('io', None), ('grp', 'other'),
+                        ('grp', 'unknown')])
+        self.assertEqual(len(self.resolver.resolved), 4)
+        self.assertEqual(NodeSet('@io', resolver=cache), NodeSet('io[1-2]'))
+        self.assertEqual(len(self.resolver.resolved), 4)
+        # Failures are reported on demand
+        self.assertRaises(GroupResolverSourceError, cache.group_nodes,
+                          'grp', 'unknown')
+
+    def test_save_load(self):
+        """Test resolved groups are shared through the cache file"""
+        cache = GroupCache(self.resolver)
+        cache.load(self.path, 60)
+        cache.prefetch([('grp', None)])
+        cache.save()
+        other = GroupCache(CountingResolver({}))
+        other.load(self.path, 60)
+        self.assertEqual(NodeSet('@grp', resolver=other), NodeSet('foo[1-3]'))
+        self.assertEqual(other.resolver.resolved, [])
+
+    def test_load_expired(self):
+        """Test expired groups are resolved again"""
+        with open(self.path, 'w') as cachefile:
+            json.dump({':grp': {'time': time.time() - 120,
+                                'nodes': ['old1']}}, cachefile)
+        cache = GroupCache(self.resolver)
+        cache.load(self.path, 60)
+        self.assertEqual(NodeSet('@grp', resolver=cache), NodeSet('foo[1-3]'))
+        self.assertEqual(self.resolver.resolved, [('grp', None)])
+
+    def test_no_file(self):
+        """Test nothing is written without cache file"""
+        cache = GroupCache(self.resolver)
+        cache.prefetch([('grp', None)])
+        cache.save()
+        self.assertFalse(os.path.exists(self.path))
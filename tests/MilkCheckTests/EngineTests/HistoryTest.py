@@ -0,0 +1,93 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the DurationHistory
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.History import DurationHistory
+
+
+class DurationHistoryTest(TestCase):
+    """Define the unit tests for the DurationHistory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'durations.db')
+        self.service = Service('svc')
+        self.action = Action('start', target='node[1-2]', command='/bin/true')
+        self.service.add_action(self.action)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def _record(self, history, duration, nodes=None):
+        """Record the test action as if it ran during duration seconds"""
+        self.action.start_time = 100
+        self.action.stop_time = 100 + duration
+        self.action.node_durations = nodes or {}
+        history.record(self.action)
+
+    def test_no_history(self):
+        """Test an unknown action has no expected duration nor timeout"""
+        history = DurationHistory(self.path, 2)
+        self.assertEqual(history.expected_duration(self.action), None)
+        self.assertEqual(history.timeout(self.action), None)
+
+    def test_save_load(self):
+        """Test durations are written by save() and read back"""
+        history = DurationHistory(self.path)
+        for duration in (1, 2, 10):
+            self._record(history, duration, {'node1': duration / 2.0})
+        self.assertFalse(os.path.exists(self.path))
+        history.save()
+        history = DurationHistory(self.path)
+        self.assertEqual(history.expected_duration(self.action), 2)
+        self.assertEqual(sorted(history.durations(self.action)[1]),
+                         [0.5, 1, 5])
+
+    def test_samples(self):
+        """Test only the last durations are used"""
+        history = DurationHistory(self.path, samples=2)
+        for duration in (1, 5, 5):
+            self._record(history, duration)
+        history.save()
+        history = DurationHistory(self.path, samples=2)
+        self.assertEqual(history.durations(self.action)[0], [5, 5])
+
+    def test_timeout(self):
+        """Test timeout is a factor of the 99th percentile of nodes"""
+        history = DurationHistory(self.path, 2)
+        for duration in range(1, 11):
+            self._record(history, duration * 2,
+                         {'node1': duration, 'node2': duration / 2.0})
+        history.save()
+        history = DurationHistory(self.path, 2)
+        self.assertEqual(history.timeout(self.action), 20)
+        # Disabled without factor
+        history = DurationHistory(self.path)
+        self.assertEqual(history.timeout(self.action), None)
+
+    def test_timeout_few_samples(self):
+        """Test no timeout is computed with too few durations"""
+        history = DurationHistory(self.path, 2)
+        self._record(history, 1, {'node1': 1})
+        history.save()
+        history = DurationHistory(self.path, 2)
+        self.assertEqual(history.timeout(self.action), None)
+
+    def test_save_error(self):
+        """Test an unwritable database does not raise"""
+        history = DurationHistory(os.path.join(self.tmpdir, 'none', 'x.db'))
+        self._record(history, 1)
+        history.save()
+        self.assertEqual(history.expected_duration(self.action), None)
@@ -0,0 +1,125 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the ResultCache
+"""
+
+import os
+import json
+import time
+import tempfile
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.ResultCache import ResultCache, StoredWorker
+
+
+class ResultCacheTest(TestCase):
+    """Define the unit tests for the ResultCache."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'results.json')
+        self.service = Service('svc')
+        self.action = Action('status', target='node[1-2]', command='/bin/true')
+        self.action.cacheable = True
+        self.service.add_action(self.action)
+        self.worker = StoredWorker('/bin/true',
+                                   [(b'ok', 'node[1-2]')],
+                                   [(0, 'node[1-2]')])
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def _store(self, cache):
+        """Store the test action result as if it really ran"""
+        cache._entries[cache.key(self.action)] = {
+            'service': 'svc', 'time': time.time(),
+            'result': self.worker.todict()}
+        cache._dirty = True
+
+    def test_save_load(self):
+        """Test results are saved and read back"""
+        cache = ResultCache(self.path, 10)
+        self._store(cache)
+        cache.save()
+        worker = ResultCache(self.path, 10).lookup(self.action)
+        self.assertTrue(isinstance(worker, StoredWorker))
+        self.assertEqual(worker.command, '/bin/true')
+        self.assertEqual([(bytes(buf), nodes) for buf, nodes
+                          in worker.iter_buffers()],
+                         [(b'ok', NodeSet('node[1-2]'))])
+        self.assertEqual(list(worker.iter_retcodes()),
+                         [(0, NodeSet('node[1-2]'))])
+        self.assertEqual(list(worker.iter_keys_timeout()), [])
+        self.assertEqual(worker.current_node, 'node2')
+
+    def test_ttl(self):
+        """Test expired results are ignored"""
+        cache = ResultCache(self.path, 10)
+        self._store(cache)
+        cache.save()
+        with open(self.path) as cachefile:
+            entries = json.load(cachefile)
+        for entry in entries.values():
+            entry['time'] -= 11
+        with open(self.path, 'w') as cachefile:
+            json.dump(entries, cachefile)
+        self.assertEqual(ResultCache(self.path, 10).lookup(self.action), None)
+
+    def test_key(self):
+        """Test results depend on command and target"""
+        cache = ResultCache(self.path, 10)
+        self._store(cache)
+        self.assertNotEqual(cache.lookup(self.action), None)
+        self.action.target = 'node[1-3]'
+        self.assertEqual(cache.lookup(self.action), None)
+        self.action.target = 'node[1-2]'
+        self.action.command = '/bin/false'
+        self.assertEqual(cache.lookup(self.action), None)
+
+    def test_not_usable(self):
+        """Test only cacheable actions with a target are cached"""
+        cache = ResultCache(self.path, 10)
+        self._store(cache)
+        self.action.cacheable = False
+        self.assertEqual(cache.lookup(self.action), None)
+        self.action.cacheable = True
+        self.action.mode = 'delegate'
+        self.assertEqual(cache.lookup(self.action), None)
+
+    def test_invalidate(self):
+        """Test results of a service could be forgotten"""
+        cache = ResultCache(self.path, 10)
+        self._store(cache)
+        cache.invalidate(self.service)
+        self.assertEqual(cache.lookup(self.action), None)
+
+    def test_bad_file(self):
+        """Test an unreadable cache file is ignored"""
+        with open(self.path, 'w') as cachefile:
+            cachefile.write('not json')
+        self.assertEqual(ResultCache(self.path, 10).lookup(self.action), None)
+
+    def test_restrict(self):
+        """Test results could be restricted to some nodes"""
+        worker = StoredWorker('/bin/true',
+                              [(b'ok', 'node[1-2]'), (b'ko', 'node3')],
+                              [(0, 'node[1-2]'), (1, 'node3')], 'node4')
+        worker = worker.restrict(NodeSet('node[2-4]'))
+        self.assertEqual([(bytes(buf), nodes) for buf, nodes
+                          in worker.iter_buffers()],
+                         [(b'ok', NodeSet('node2')), (b'ko', NodeSet('node3'))])
+        self.assertEqual(list(worker.iter_retcodes()),
+                         [(0, NodeSet('node2')), (1, NodeSet('node3'))])
+        self.assertEqual(list(worker.iter_keys_timeout()), ['node4'])
+        worker = worker.restrict(NodeSet('node2'))
+        self.assertEqual(list(worker.iter_retcodes()), [(0, NodeSet('node2'))])
+        self.assertEqual(list(worker.iter_keys_timeout()), [])
@@ -10,7 +10,7 @@ import socket
 from unittest import TestCase
 
 # Classes
-from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Action import Action, ActionManager
 from MilkCheck.Engine.ServiceGroup import ServiceGroup, ServiceNotFoundError
 from MilkCheck.Engine.Service import Service
 from ClusterShell.NodeSet import NodeSet
@@ -240,6 +240,44 @@ class ServiceGroupTest(TestCase):
         self.assertTrue(s3.has_parent_dep('sink'))
         self.assertFalse(s3.has_child_dep('source'))
 
+    def test_add_services(self):
+        '''Test adding several services links them like add_inter_dep'''
+        def _edges(group):
+            edges = set()
+            for svc in [group._source, group._sink] + \
+                       list(group.iter_subservices()):
+                for name, dep in svc.parents.items():
+                    edges.add((svc.name, name, dep.dep_type))
+            return edges
+
+        expected = ServiceGroup('GROUP')
+        services = [Service('svc%d' % idx) for idx in range(4)]
+        expected.add_inter_dep(target=services[0])
+        expected.add_inter_dep(target=services[1])
+        expected.add_inter_dep(target=services[2], base=services[0])
+        expected.add_inter_dep(target=services[2], base=services[1],
+                               sgth=REQUIRE_WEAK)
+        expected.add_inter_dep(target=services[3], base=services[2])
+
+        group = ServiceGroup('GROUP')
+        services = [Service('svc%d' % idx) for idx in range(4)]
+        group.add_services(services[:2],
+                           deps=[(services[2], services[0]),
+                                 (services[2], services[1], REQUIRE_WEAK),
+                                 (services[3], services[2])])
+        self.assertEqual(_edges(group), _edges(expected))
+        self.assertTrue(services[3].has_child_dep('svc2'))
+        self.assertTrue(services[3].has_parent_dep('sink'))
+        self.assertFalse(services[2].has_parent_dep('sink'))
+        self.assertEqual(services[3].parent, group)
+
+    def test_add_services_unknown_base(self):
+        '''Test adding a dependency on an unknown base raises an error'''
+        group = ServiceGroup('GROUP')
+        svc = Service('svc')
+        self.assertRaises(ServiceNotFoundError, group.add_services, [],
+                          deps=[(svc, Service('other'))])
+
     def test_remove_inter_dep(self):
         '''Test ability to remove a dependency in a subgraph'''
         group = ServiceGroup('GROUP')
@@ -291,6 +329,62 @@ class ServiceGroupTest(TestCase):
         grp.skip()
         self.assertTrue(grp.to_skip('start'))
 
+    def test_skip_index_updated(self):
+        """Test action availability follows changes in the group"""
+        grp = ServiceGroup('group')
+        self.assertFalse(grp.has_action('start'))
+        self.assertTrue(grp.to_skip('start'))
+        srv1 = Service('srv1')
+        srv1.add_action(Action('start', target=NodeSet('foo'),
+                               command='/bin/true'))
+        grp.add_inter_dep(target=srv1)
+        self.assertTrue(grp.has_action('start'))
+        self.assertFalse(grp.has_action('stop'))
+        self.assertFalse(grp.to_skip('start'))
+        srv1.add_action(Action('stop', target=NodeSet('foo'),
+                               command='/bin/true'))
+        self.assertTrue(grp.has_action('stop'))
+        srv2 = Service('srv2')
+        grp.add_inter_dep(target=srv2)
+        self.assertFalse(grp.to_skip('status'))
+        srv1.skip()
+        self.assertFalse(grp.to_skip('start'))
+        srv1.remove_action('start')
+        self.assertFalse(grp.has_action('start'))
+        grp.remove_inter_dep('srv1')
+        self.assertFalse(grp.has_action('stop'))
+
+    def test_skip_index_target(self):
+        """Test target changes of actions update to_skip()"""
+        grp = ServiceGroup('group')
+        srv = Service('srv')
+        srv.add_action(Action('start', target=NodeSet('foo'),
+                              command='/bin/true'))
+        grp.add_inter_dep(target=srv)
+        self.assertFalse(grp.to_skip('start'))
+        srv.update_target(NodeSet('foo'), 'DIF')
+        self.assertTrue(grp.to_skip('start'))
+        srv.update_target(NodeSet('bar'))
+        self.assertFalse(grp.to_skip('start'))
+
+    def test_skip_index_nested(self):
+        """Test the skip index of nested groups"""
+        grp = ServiceGroup('group')
+        sub = ServiceGroup('sub')
+        grp.add_inter_dep(target=sub)
+        self.assertTrue(grp.to_skip('start'))
+        srv = Service('srv')
+        srv.add_action(Action('start', target=NodeSet('foo'),
+                              command='/bin/true'))
+        sub.add_inter_dep(target=srv)
+        self.assertTrue(grp.has_action('start'))
+        self.assertFalse(grp.to_skip('start'))
+        grp.add_inter_dep(target=ServiceGroup('empty'))
+        self.assertFalse(grp.to_skip('start'))
+        srv.skip()
+        self.assertTrue(sub.to_skip('start'))
+        self.assertTrue(grp.to_skip('start'))
+
     def test_eval_deps_status_done(self):
         '''Test the method eval_deps_status NO_STATUS'''
         group = ServiceGroup('group')
@@ -331,16 +425,29 @@ class ServiceGroupTest(TestCase):
         self.assertEqual(group.eval_deps_status(), WAITING_STATUS)
 
     def test_set_algo_reversed(self):
-        '''Test updates dependencies in changing the reversed flag'''
+        '''Test the reversed flag selects dependencies without changing them'''
         group = ServiceGroup('group')
-        self.assertTrue(group._source.has_child_dep('group'))
-        self.assertFalse(group._sink.has_parent_dep('group'))
+        svc = Service('svc')
+        group.add_inter_dep(target=svc)
+        source, sink = group._source, group._sink
+        edges = [dict(ent.parents) for ent in (group, source, sink, svc)]
+        self.assertTrue(source.has_child_dep('group'))
+        self.assertFalse(sink.has_parent_dep('group'))
+        self.assertEqual(list(source.consumers()), ['group'])
+        self.assertEqual(list(source.deps()), ['svc'])
+        self.assertEqual(list(sink.deps()), [])
         group.algo_reversed = True
-        self.assertFalse(group._source.has_child_dep('group'))
-        self.assertTrue(group._sink.has_parent_dep('group'))
+        self.assertEqual(list(sink.consumers()), ['group'])
+        self.assertEqual(list(sink.deps()), ['svc'])
+        self.assertEqual(list(source.deps()), [])
+        self.assertEqual(list(svc.deps()), ['source'])
+        self.assertEqual([dict(ent.parents) for ent in
+                          (group, source, sink, svc)], edges)
+        self.assertTrue(source.has_child_dep('group'))
+        self.assertFalse(sink.has_parent_dep('group'))
         group.algo_reversed = False
-        self.assertTrue(group._source.has_child_dep('group'))
-        self.assertFalse(group._sink.has_parent_dep('group'))
+        self.assertEqual(list(source.consumers()), ['group'])
+        self.assertEqual(list(svc.deps()), ['sink'])
 
     def test_prepare_empty_group(self):
         '''Test method prepare with a single empty ServiceGroup.'''
@@ -561,6 +668,23 @@ class ServiceGroupTest(TestCase):
         self.assertEqual(i1.status, DONE)
         self.assertEqual(group.status, DONE)
 
+    def test_filter_nodes_scope(self):
+        """Failed nodes of a group are inherited by its subservices"""
+        grp = ServiceGroup('grp')
+        sub = ServiceGroup('sub')
+        srv = Service('srv')
+        srv.add_action(Action('start', target=HOSTNAME, command='/bin/true'))
+        sub.add_inter_dep(target=srv)
+        grp.add_inter_dep(target=sub)
+        grp.filter_nodes(NodeSet('foo'))
+        sub.filter_nodes(NodeSet(HOSTNAME))
+        self.assertEqual(srv.failed_nodes, NodeSet())
+        self.assertEqual(srv.scope_failed_nodes(),
+                         NodeSet('foo,%s' % HOSTNAME))
+        grp.run('start')
+        self.assertEqual(srv.status, SKIPPED)
+        self.assertEqual(grp.status, SKIPPED)
+
     def test_skipped_group(self):
         """A group with only SKIPPED services should be SKIPPED"""
         grp = ServiceGroup('group')
@@ -683,6 +807,62 @@ class ServiceGroupTest(TestCase):
         self.assertEqual(svc3.status, ERROR)
         self.assertEqual(stop.status, DEP_ERROR)
 
+    def test_budget_services(self):
+        """Group services budget limits subservices running together"""
+        grp = ServiceGroup('group')
+        grp.max_services = 2
+        actions = []
+        for name in ('svc1', 'svc2', 'svc3', 'svc4'):
+            svc = Service(name)
+            action = Action('start', command='sleep 0.2')
+            svc.add_action(action)
+            grp.add_inter_dep(svc)
+            actions.append(action)
+        grp.run('start')
+
+        self.assertEqual(grp.status, DONE)
+        # Two batches of two actions
+        last = max(action.stop_time for action in actions)
+        first = min(action.start_time for action in actions)
+        self.assertTrue(0.4 <= last - first < 0.6,
+                        "%.3f is not between 0.4 and 0.6" % (last - first))
+
+    def test_budget_connections(self):
+        """Group connections budget limits and splits fanout"""
+        grp = ServiceGroup('group')
+        grp.max_services = 2
+        grp.max_connections = 10
+        subgrp = ServiceGroup('subgroup')
+        grp.add_inter_dep(subgrp)
+        svc = Service('svc')
+        action = Action('start', command='true', target='node[1-20]')
+        action.mode = 'exec'
+        svc.add_action(action)
+        subgrp.add_inter_dep(svc)
+        self.assertEqual(grp.connections_budget(), 10)
+        self.assertEqual(grp.connections_share(), 5)
+        self.assertEqual(subgrp.connections_budget(), 5)
+        self.assertEqual(subgrp.connections_share(), 5)
+        subgrp.max_services = 2
+        self.assertEqual(subgrp.connections_share(), 2)
+        subgrp.max_connections = 1
+        self.assertEqual(subgrp.connections_budget(), 1)
+
+        fanouts = []
+        add_task = ActionManager.add_task
+        def _add_task(manager, task):
+            add_task(manager, task)
+            fanouts.append(manager.fanout)
+        ActionManager.add_task = _add_task
+        try:
+            grp.run('start')
+        finally:
+            ActionManager.add_task = add_task
+        self.assertEqual(grp.status, DONE)
+        self.assertEqual(fanouts, [1])
+        # The share is not kept as the action fanout
+        self.assertEqual(action.fanout, None)
+
     def test_graph_entity(self):
         """Test the DOT graph output"""
         grp = ServiceGroup('Group')
@@ -1039,6 +1219,17 @@ class ServiceGroupFromDictTest(TestCase):
         self.assertEqual(
             subgroup._subservices['svcC'].target, NodeSet('127.0.0.1'))
 
+    def test_budget(self):
+        '''Test budget is read from dict'''
+        grp = ServiceGroup('group')
+        grp.fromdict({'budget': {'services': 3, 'connections': 500},
+                      'services': {'svc': {'actions':
+                                               {'start': {'cmd': 'true'}}}}})
+        self.assertEqual(grp.max_services, 3)
+        self.assertEqual(grp.max_connections, 500)
+        grp.resolve_all()
+        self.assertEqual(grp.connections_share(), 166)
+
     def test_servicegroup_with_nodeset_like_actions_with_one_decl(self):
         '''Test a service group with several group with nodeset-like names'''
         sergrp = ServiceGroup('group1')
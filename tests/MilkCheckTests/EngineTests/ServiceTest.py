@@ -8,7 +8,7 @@ This modules defines the tests cases targeting the Action and Service objects.
 from unittest import TestCase
 
 # Classes
-from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
 from MilkCheck.Engine.Service import Service
 from ClusterShell.NodeSet import NodeSet
 
@@ -18,13 +18,14 @@ from MilkCheck.Engine.Service import ActionNotFoundError
 
 # Symbols
 from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, TIMEOUT, DEP_ERROR
-from MilkCheck.Engine.BaseEntity import ERROR, SKIPPED
+from MilkCheck.Engine.BaseEntity import ERROR, SKIPPED, CANCELLED
 from MilkCheck.Engine.BaseEntity import LOCKED, MISSING, CHECK, REQUIRE_WEAK, \
                                         FILTER, REQUIRE
 
 from MilkCheckTests import setup_sshconfig, cleanup_sshconfig
 
 import socket
+import time
 HOSTNAME = socket.gethostname().split('.')[0]
 
 class ServiceTest(TestCase):
@@ -869,6 +870,106 @@ class ServiceTest(TestCase):
         srv.skip()
         self.assertTrue(srv._actions['start'].to_skip())
 
+    def test_fail_fast(self):
+        """Test fail-fast only cancels actions feeding doomed services"""
+        def new_service(name, command):
+            svc = Service(name)
+            svc.add_action(Action('start', command=command))
+            return svc
+        svc_a = new_service('A', '/bin/false')
+        svc_b = new_service('B', '/bin/sleep 3')
+        svc_c = new_service('C', '/bin/true')
+        svc_d = new_service('D', '/bin/sleep 0.3')
+        root = new_service('root', '/bin/true')
+        # C is doomed as soon as A fails: B is useless.
+        svc_c.add_dep(svc_a)
+        svc_c.add_dep(svc_b)
+        # root is not doomed by C (weak), D still matters
+        root.add_dep(svc_c, sgth=REQUIRE_WEAK)
+        root.add_dep(svc_d)
+
+        ActionManager._instance = None
+        action_manager_self().failfast = True
+        try:
+            root.run('start')
+        finally:
+            ActionManager._instance = None
+
+        self.assertEqual(svc_a.status, ERROR)
+        self.assertEqual(svc_b.status, CANCELLED)
+        self.assertEqual(svc_c.status, DEP_ERROR)
+        self.assertEqual(svc_d.status, DONE)
+        self.assertEqual(root.status, DONE)
+        self.assertTrue(svc_b._actions['start'].duration < 1)
+
+    def _pipeline(self, cmd1, cmd2, sgth=REQUIRE):
+        """Run svc2 pipelined after svc1, on node[1-2]"""
+        svc1 = Service('svc1')
+        svc1.add_action(Action('start', target='node[1-2]', command=cmd1))
+        svc2 = Service('svc2')
+        svc2.add_action(Action('start', target='node[1-2]', command=cmd2))
+        svc2.pipeline = True
+        svc2.add_dep(svc1, sgth=sgth)
+        for action in (svc1._actions['start'], svc2._actions['start']):
+            action.mode = 'exec'
+        ActionManager._instance = None
+        try:
+            elapsed = time.time()
+            svc2.run('start')
+            elapsed = time.time() - elapsed
+        finally:
+            ActionManager._instance = None
+        return svc1, svc2, elapsed
+
+    def test_pipeline(self):
+        """Test pipelined nodes do not wait for the slowest upstream node"""
+        svc1, svc2, elapsed = self._pipeline('test %h = node1 || sleep 0.5',
+                                             'test %h = node2 || sleep 0.5')
+        self.assertEqual(svc1.status, DONE)
+        self.assertEqual(svc2.status, DONE)
+        self.assertEqual(svc2._actions['start'].done_nodes, NodeSet('node[1-2]'))
+        self.assertTrue(elapsed < 0.9, 'Time elapsed too high (%f)' % elapsed)
+
+    def test_pipeline_filter(self):
+        """Test pipelined nodes which failed upstream are filtered"""
+        svc1, svc2, _ = self._pipeline('test %h = node1 || (sleep 0.2; false)',
+                                       'true', FILTER)
+        self.assertEqual(svc1.status, ERROR)
+        self.assertEqual(svc2.status, DONE)
+        self.assertEqual(svc2._actions['start'].target, NodeSet('node1'))
+        self.assertEqual(svc2._actions['start'].done_nodes, NodeSet('node1'))
+
+    def test_pipeline_require(self):
+        """Test pipelined action ends in DEP_ERROR if upstream fails"""
+        svc1, svc2, _ = self._pipeline('test %h = node1 || (sleep 0.2; false)',
+                                       'true')
+        self.assertEqual(svc1.status, ERROR)
+        self.assertEqual(svc2.status, DEP_ERROR)
+        self.assertEqual(svc2._actions['start'].done_nodes, NodeSet('node1'))
+
+    def test_pipeline_other_deps(self):
+        """Test dependencies which cannot be pipelined are still barriers"""
+        svc0 = Service('svc0')
+        svc0.add_action(Action('start', command='sleep 0.3'))
+        svc1 = Service('svc1')
+        svc1.add_action(Action('start', target='node[1-2]', command='true'))
+        svc2 = Service('svc2')
+        svc2.add_action(Action('start', target='node[1-2]', command='true'))
+        svc2.pipeline = True
+        svc2.add_dep(svc1)
+        svc2.add_dep(svc0)
+        for action in (svc1._actions['start'], svc2._actions['start']):
+            action.mode = 'exec'
+        ActionManager._instance = None
+        try:
+            svc2.run('start')
+        finally:
+            ActionManager._instance = None
+        self.assertEqual(svc2.status, DONE)
+        self.assertTrue(svc2._actions['start'].start_time >=
+                        svc0._actions['start'].stop_time)
+
+
 
 class ServiceFromDictTest(TestCase):
     '''This class tests Service.fromdict()'''
@@ -1019,6 +1120,14 @@ class ServiceFromDictTest(TestCase):
         self.assertEqual(svc._actions['wait'].maxretry, 1)
         self.assertEqual(svc._actions['wait'].tries, 0)
 
+    def test_pipeline_fromdict(self):
+        """test if the pipeline flag is read from the service dict"""
+        svc = Service('foo')
+        self.assertFalse(svc.pipeline)
+        svc.fromdict({'pipeline': True,
+                      'actions': {'start': {'cmd': 'service foo start'}}})
+        self.assertTrue(svc.pipeline)
+
     def test_resolve_target_from_parent(self):
         """resolve action target using variable declared in parent service"""
         # 'target' property is resolved very early and not in resolve_all()
@@ -0,0 +1,157 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the SimulatedTask
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
+from MilkCheck.Engine.BaseEntity import DONE, TIMEOUT, ERROR
+from MilkCheck.Engine.Service import Service
+from MilkCheck.Engine.History import DurationHistory
+from MilkCheck.Engine.Simulator import SimulatedTask, recommend_fanout
+from MilkCheck.ServiceManager import ServiceManager
+
+
+class SimulatedTaskTest(TestCase):
+    """Define the unit tests for the SimulatedTask."""
+
+    def setUp(self):
+        ActionManager._instance = None
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'durations.db')
+
+    def tearDown(self):
+        ActionManager._instance = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def _service(self, name, duration, target=None, command='/bin/false'):
+        """Service whose start action usually takes duration per node"""
+        service = Service(name)
+        action = Action('start', target=target, command=command)
+        service.add_action(action)
+        history = DurationHistory(self.path)
+        action.start_time = 100
+        action.stop_time = 100 + duration
+        if target:
+            action.node_durations = dict((node, duration)
+                                         for node in action.target)
+        history.record(action)
+        history.save()
+        action.reset()
+        return service
+
+    def _simulate(self, manager, fanout=64):
+        """Run manager services start against a SimulatedTask"""
+        task = SimulatedTask(DurationHistory(self.path))
+        action_manager_self().simulate(task)
+        action_manager_self().default_fanout = fanout
+        manager.call_services([], 'start')
+        return task
+
+    def test_nothing_runs(self):
+        """Test commands are not executed"""
+        manager = ServiceManager()
+        svc = self._service('S1', 2, 'node[1-2]')
+        manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(svc.status, DONE)
+        self.assertEqual(task.clock, 2)
+
+    def test_fanout(self):
+        """Test nodes share the task fanout"""
+        manager = ServiceManager()
+        manager.add_service(self._service('S1', 2, 'node[1-4]'))
+        task = self._simulate(manager, 2)
+        self.assertEqual(task.clock, 4)
+        self.assertEqual(task.utilization, 1)
+        task = self._simulate(manager, 8)
+        self.assertEqual(task.clock, 2)
+        self.assertEqual(task.utilization, 0.5)
+
+    def test_critical_path(self):
+        """Test critical path follows the actions which ended last"""
+        manager = ServiceManager()
+        svc1 = self._service('S1', 2, 'node1')
+        svc2 = self._service('S2', 1)
+        svc3 = self._service('S3', 0.5)
+        svc2.add_dep(svc1)
+        for svc in (svc1, svc2, svc3):
+            manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(task.clock, 3)
+        self.assertEqual([(act.parent.name, start, stop) for act, start, stop
+                          in task.critical_path()],
+                         [('S1', 0, 2), ('S2', 2, 3)])
+
+    def test_delay(self):
+        """Test delayed actions wait on the virtual clock"""
+        manager = ServiceManager()
+        svc = self._service('S1', 2, 'node1')
+        svc._actions['start'].delay = 5
+        manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(task.clock, 7)
+        self.assertEqual(task.critical_path()[0][1:], (5, 7))
+
+    def test_timeout(self):
+        """Test nodes lasting more than the timeout time out"""
+        manager = ServiceManager()
+        svc = self._service('S1', 2, 'node[1-2]')
+        svc._actions['start'].timeout = 1
+        manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(task.clock, 1)
+        self.assertEqual(svc._actions['start'].status, TIMEOUT)
+
+    def test_unknown(self):
+        """Test actions without history are reported"""
+        manager = ServiceManager()
+        svc = Service('S1')
+        svc.add_action(Action('start', target='node1', command='/bin/true'))
+        manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(task.clock, SimulatedTask.DEFAULT_DURATION)
+        self.assertEqual(task.unknown, set([svc._actions['start']]))
+
+    def test_unknown_timeout(self):
+        """Test actions without history are assumed to last their timeout"""
+        manager = ServiceManager()
+        svc = Service('S1')
+        svc.add_action(Action('start', target='node1', command='/bin/true',
+                              timeout=3))
+        manager.add_service(svc)
+        task = self._simulate(manager)
+        self.assertEqual(task.clock, 3)
+        self.assertEqual(svc._actions['start'].status, DONE)
+
+    def test_end_simulation(self):
+        """Test commands run again once the simulation is over"""
+        manager = ServiceManager()
+        svc = Service('S1')
+        svc.add_action(Action('start', command='/bin/false'))
+        manager.add_service(svc)
+        task = SimulatedTask()
+        state = action_manager_self().simulate(task)
+        action_manager_self().default_fanout = 2
+        manager.call_services([], 'start')
+        action_manager_self().end_simulation(state)
+        self.assertEqual(svc.status, DONE)
+        self.assertFalse(action_manager_self().dryrun)
+        self.assertEqual(action_manager_self().simulation, None)
+        self.assertNotEqual(action_manager_self().default_fanout, 2)
+        manager.call_services([], 'start')
+        self.assertEqual(svc.status, ERROR)
+
+    def test_recommend_fanout(self):
+        """Test the smallest fanout close to the best duration is chosen"""
+        self.assertEqual(recommend_fanout([(8, 10), (16, 5.5), (32, 4.9),
+                                           (64, 4.8)]), 32)
+        self.assertEqual(recommend_fanout([(8, 1)]), 8)
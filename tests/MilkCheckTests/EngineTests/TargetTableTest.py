@@ -0,0 +1,41 @@
+#
+# Copyright CEA (2011-2017)
+#
+
+"""
+This modules defines the tests cases targeting the TargetTable
+"""
+
+from unittest import TestCase
+
+from ClusterShell.NodeSet import NodeSet
+
+from MilkCheck.Engine.TargetTable import TargetTable
+
+
+class TargetTableTest(TestCase):
+    """Define the unit tests for TargetTable."""
+
+    def test_parsed_once(self):
+        """Test a target string is parsed once"""
+        table = TargetTable()
+        nodes = table.nodeset('foo[1-5]')
+        self.assertEqual(nodes, NodeSet('foo[1-5]'))
+        self.assertTrue(table.nodeset('foo[1-5]') is nodes)
+        self.assertFalse(table.nodeset('foo[1-4]') is nodes)
+
+    def test_shared(self):
+        """Test only nodesets of the table are shared"""
+        table = TargetTable()
+        nodes = table.nodeset('foo[1-5]')
+        self.assertTrue(table.is_shared(nodes))
+        self.assertTrue(table.nodeset(nodes) is nodes)
+        self.assertFalse(table.is_shared(NodeSet('foo[1-5]')))
+
+    def test_clear(self):
+        """Test targets are parsed again once the table is cleared"""
+        table = TargetTable()
+        nodes = table.nodeset('foo[1-5]')
+        table.clear()
+        self.assertFalse(table.is_shared(nodes))
+        self.assertFalse(table.nodeset('foo[1-5]') is nodes)
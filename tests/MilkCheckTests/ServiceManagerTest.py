@@ -7,6 +7,7 @@ Test cases for MilkCheck.ServiceManager
 """
 
 import os
+import json
 import tempfile
 import textwrap
 import time
@@ -15,9 +16,10 @@ import unittest
 from ClusterShell.NodeSet import NodeSet
 
 from MilkCheck.Engine.BaseEntity import VariableAlreadyExistError
-from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, REQUIRE_WEAK
-from MilkCheck.Engine.BaseEntity import DEP_ERROR, ERROR, WARNING
-from MilkCheck.Engine.Action import Action
+from MilkCheck.Engine.BaseEntity import NO_STATUS, DONE, REQUIRE_WEAK, FILTER
+from MilkCheck.Engine.BaseEntity import DEP_ERROR, ERROR, WARNING, CANCELLED
+from MilkCheck.Engine.BaseEntity import SKIPPED
+from MilkCheck.Engine.Action import Action, ActionManager, action_manager_self
 from MilkCheck.Engine.Service import Service
 from MilkCheck.Engine.ServiceGroup import ServiceGroup
 from MilkCheck.ServiceManager import ServiceManager, ServiceNotFoundError
@@ -266,6 +268,75 @@ node [style=filled];
 compound=true;
 node [style=filled];
 }
+""")
+
+    def _graph_manager(self):
+        """Return a manager with a group G(A -> B) required by S."""
+        manager = ServiceManager()
+        group = ServiceGroup('G')
+        srva = Service('A')
+        srvb = Service('B')
+        group.add_inter_dep(target=srva)
+        group.add_inter_dep(target=srvb, base=srva, sgth=REQUIRE_WEAK)
+        srvs = Service('S')
+        srvs.add_dep(group)
+        manager.add_service(group)
+        manager.add_service(srvs)
+        return manager
+
+    def test_graph_edges(self):
+        """Test the edge list graph output"""
+        manager = self._graph_manager()
+        self.assertEqual(manager.output_graph(fmt='edges'),
+                         "G\nG.A\nG.A\tG.B\tREQUIRE_WEAK\nG.B\n"
+                         "S\nS\tG\tREQUIRE\n")
+        self.assertEqual(manager.output_graph(fmt='edges', collapse=True),
+                         "G\nS\nS\tG\tREQUIRE\n")
+        self.assertEqual(manager.output_graph(fmt='edges', excluded=['G.B']),
+                         "G\nS\nS\tG\tREQUIRE\n")
+
+    def test_graph_json(self):
+        """Test the JSON graph output"""
+        manager = self._graph_manager()
+        graph = json.loads(manager.output_graph(fmt='json'))
+        self.assertEqual(graph['services'],
+                         [{'name': 'G', 'group': None},
+                          {'name': 'G.A', 'group': 'G'},
+                          {'name': 'G.B', 'group': 'G'},
+                          {'name': 'S', 'group': None}])
+        self.assertEqual(graph['dependencies'],
+                         [{'source': 'G.A', 'target': 'G.B',
+                           'type': 'REQUIRE_WEAK'},
+                          {'source': 'S', 'target': 'G', 'type': 'REQUIRE'}])
+
+    def test_graph_collapse(self):
+        """Test the DOT graph output with collapsed groups"""
+        manager = self._graph_manager()
+        self.assertEqual(manager.output_graph(collapse=True),
+"""digraph dependency {
+compound=true;
+node [style=filled];
+"G";
+"S" -> "G";
+}
+""")
+
+    def test_graph_loop_excluded(self):
+        """Test services on a dependency loop are excluded"""
+        manager = ServiceManager()
+        srva = Service('A')
+        srvb = Service('B')
+        srvc = Service('C')
+        srva.add_dep(srvb)
+        srvb.add_dep(srva)
+        srvc.add_dep(srvb)
+        for svc in (srva, srvb, srvc):
+            manager.add_service(svc)
+        self.assertEqual(manager.output_graph(excluded=['D']),
+"""digraph dependency {
+compound=true;
+node [style=filled];
+}
 """)
 
     def test_call_services_reversed(self):
@@ -319,6 +390,342 @@ node [style=filled];
         self.assertEqual(s1.status, DONE)
         self.assertEqual(s2.status, DONE)
 
+    def test_call_services_fail_fast(self):
+        '''Test fail-fast cancels everything once the result is known'''
+        manager = ServiceManager()
+        s1 = Service('S1')
+        s2 = Service('S2')
+        s3 = Service('S3')
+        s1.add_action(Action('start', command='/bin/false'))
+        s2.add_action(Action('start', command='/bin/sleep 3'))
+        s3.add_action(Action('start', command='/bin/sleep 0.2'))
+        s2.add_dep(s3)
+        manager.add_service(s1)
+        manager.add_service(s2)
+        manager.add_service(s3)
+
+        ActionManager._instance = None
+        action_manager_self().failfast = True
+        try:
+            elapsed = time.time()
+            manager.call_services([], 'start')
+            elapsed = time.time() - elapsed
+        finally:
+            ActionManager._instance = None
+        self.assertTrue(elapsed < 0.5, 'Time elapsed too high (%f)' % elapsed)
+        self.assertEqual(manager.status, DEP_ERROR)
+        self.assertEqual(s1.status, ERROR)
+        self.assertEqual(s3.status, CANCELLED)
+        self.assertEqual(s2.status, DEP_ERROR)
+
+    def test_probe_targets(self):
+        """probe_targets() gathers remote targets of the required graph"""
+        manager = ServiceManager()
+        svc1 = Service('S1')
+        svc1.add_action(Action('start', target='foo[1-2]', command=':'))
+        svc1.add_action(Action('stop', target='foo3', command=':'))
+        svc2 = Service('S2')
+        svc2.add_action(Action('start', target='bar1', command=':'))
+        svc3 = Service('S3')
+        svc3.add_action(Action('start', target='baz1', command=':'))
+        svc3._actions['start'].mode = 'exec'
+        group = ServiceGroup('G1')
+        group.add_inter_dep(target=svc2)
+        group.add_inter_dep(target=svc3)
+        svc1.add_dep(group)
+        manager.add_service(svc1)
+        manager.add_service(group)
+        self.assertEqual(manager.probe_targets('start'), NodeSet('foo[1-2],bar1'))
+        self.assertEqual(manager.probe_targets('stop'), NodeSet('foo3'))
+
+    def test_probe(self):
+        """ActionManager.probe() returns nodes which did not answer"""
+        ActionManager._instance = None
+        try:
+            nodes = action_manager_self().probe(NodeSet('BADNODE[1-2]'), 1)
+        finally:
+            ActionManager._instance = None
+        self.assertEqual(nodes, NodeSet('BADNODE[1-2]'))
+
+    def test_call_services_probe(self):
+        """call_services() with probe removes unreachable nodes"""
+        manager = ServiceManager()
+        svc = Service('S1')
+        svc.add_action(Action('start', target='BADNODE1', command=':'))
+        manager.add_service(svc)
+        ActionManager._instance = None
+        try:
+            manager.call_services([], 'start',
+                                  conf={'probe': 1, 'reverse_actions': []})
+        finally:
+            ActionManager._instance = None
+        self.assertEqual(svc._actions['start'].target, NodeSet())
+        self.assertEqual(manager.status, SKIPPED)
+
+    def _restartable(self, name, logfile, stop='true'):
+        """Return a service logging its stop and start actions"""
+        svc = Service(name)
+        svc.add_action(Action('stop', command='%s && echo %s-stop >> %s' %
+                                              (stop, name, logfile)))
+        svc.add_action(Action('start', command='echo %s-start >> %s' %
+                                               (name, logfile)))
+        return svc
+
+    def test_call_services_compound(self):
+        """A compound action starts services without a global barrier"""
+        logfile = tempfile.NamedTemporaryFile(mode='r')
+        manager = ServiceManager()
+        s1 = self._restartable('S1', logfile.name)
+        s2 = self._restartable('S2', logfile.name)
+        s3 = self._restartable('S3', logfile.name, stop='sleep 0.3')
+        s1.add_dep(s2)
+        manager.add_service(s1)
+        manager.add_service(s2)
+        manager.add_service(s3)
+        conf = {'reverse_actions': ['stop'],
+                'compound_actions': {'restart': ['stop', 'start']}}
+        manager.call_services([], 'restart', conf=conf)
+        self.assertEqual(manager.status, DONE)
+        self.assertEqual(logfile.read().split(),
+                         ['S1-stop', 'S2-stop', 'S2-start', 'S1-start',
+                          'S3-stop', 'S3-start'])
+        # Links between both phases are removed
+        self.assertEqual(list(s1.parents), ['S2'])
+        self.assertEqual(list(s2.children), ['S1'])
+
+    def test_call_services_compound_error(self):
+        """A service is not started when it failed to stop"""
+        logfile = tempfile.NamedTemporaryFile(mode='r')
+        manager = ServiceManager()
+        group = ServiceGroup('G1')
+        s1 = self._restartable('S1', logfile.name)
+        s2 = self._restartable('S2', logfile.name, stop='false')
+        s3 = self._restartable('S3', logfile.name)
+        group.add_inter_dep(s1)
+        group.add_inter_dep(s2)
+        s3.add_dep(group)
+        manager.add_service(group)
+        manager.add_service(s3)
+        conf = {'reverse_actions': ['stop'],
+                'compound_actions': {'restart': ['stop', 'start']}}
+        manager.call_services([], 'restart', conf=conf)
+        self.assertEqual(manager.status, DEP_ERROR)
+        self.assertEqual(s1.status, DONE)
+        self.assertEqual(s2.status, DEP_ERROR)
+        self.assertEqual(s3.status, DEP_ERROR)
+        self.assertEqual(logfile.read().split(),
+                         ['S3-stop', 'S1-stop', 'S1-start'])
+
+    def test_call_services_compound_selected(self):
+        """Dependencies of a selected service are only started"""
+        logfile = tempfile.NamedTemporaryFile(mode='r')
+        manager = ServiceManager()
+        s1 = self._restartable('S1', logfile.name)
+        s2 = self._restartable('S2', logfile.name)
+        s1.add_dep(s2)
+        manager.add_service(s1)
+        manager.add_service(s2)
+        conf = {'reverse_actions': ['stop'],
+                'compound_actions': {'restart': ['stop', 'start']}}
+        manager.call_services(['S1'], 'restart', conf=conf)
+        self.assertEqual(manager.status, DONE)
+        self.assertEqual(sorted(logfile.read().split()),
+                         ['S1-start', 'S1-stop', 'S2-start'])
+
+    def test_call_services_compound_own(self):
+        """A service defining the compound action runs its own one"""
+        logfile = tempfile.NamedTemporaryFile(mode='r')
+        manager = ServiceManager()
+        s1 = self._restartable('S1', logfile.name)
+        s1.add_action(Action('restart', command='echo S1-restart >> %s' %
+                                                logfile.name))
+        s2 = self._restartable('S2', logfile.name)
+        s1.add_dep(s2)
+        manager.add_service(s1)
+        manager.add_service(s2)
+        conf = {'reverse_actions': ['stop'],
+                'compound_actions': {'restart': ['stop', 'start']}}
+        manager.call_services([], 'restart', conf=conf)
+        self.assertEqual(manager.status, DONE)
+        self.assertEqual(s1._actions['restart'].status, DONE)
+        self.assertEqual(s1._actions['start'].status, NO_STATUS)
+        self.assertEqual(logfile.read().split(),
+                         ['S2-stop', 'S2-start', 'S1-restart'])
+
+    def test_call_services_compound_failfast(self):
+        """Previous phases are not cancelled in fail-fast mode"""
+        logfile = tempfile.NamedTemporaryFile(mode='r')
+        manager = ServiceManager()
+        svc = self._restartable('S1', logfile.name)
+        manager.add_service(svc)
+        conf = {'reverse_actions': ['stop'],
+                'compound_actions': {'restart': ['stop', 'start']}}
+        ActionManager._instance = None
+        action_manager_self().failfast = True
+        try:
+            manager.call_services([], 'restart', conf=conf)
+        finally:
+            ActionManager._instance = None
+        self.assertEqual(manager.status, DONE)
+        self.assertEqual(svc.status, DONE)
+        self.assertEqual(svc._actions['start'].status, DONE)
+        self.assertEqual(logfile.read().split(), ['S1-stop', 'S1-start'])
+
+    def _chain(self):
+        """Return a manager with S3 requiring S2 requiring S1, and S4"""
+        manager = ServiceManager()
+        services = []
+        for name in ('S1', 'S2', 'S3', 'S4'):
+            svc = Service(name)
+            svc.add_action(Action('start', command='/bin/true'))
+            svc.add_action(Action('stop', command='/bin/true'))
+            services.append(svc)
+        services[1].add_dep(services[0])
+        services[2].add_dep(services[1])
+        for svc in services:
+            manager.add_service(svc)
+        return manager, services
+
+    def _edges(self, manager):
+        """Return the dependencies of the manager graph"""
+        edges = set()
+        for svc in [manager, manager._source, manager._sink] + \
+                   list(manager.iter_subservices()):
+            for name, dep in svc.parents.items():
+                edges.add(('parent', svc.name, name, dep.target))
+            for name, dep in svc.children.items():
+                edges.add(('child', svc.name, name, dep.target))
+        return edges
+
+    def test_call_services_selected_view(self):
+        """Selected services run without changing the graph"""
+        manager, services = self._chain()
+        edges = self._edges(manager)
+        source = manager._source
+        manager.call_services(['S2'], 'start')
+        self.assertEqual([svc.status for svc in services],
+                         [DONE, DONE, NO_STATUS, NO_STATUS])
+        self.assertTrue(manager._source is source)
+        self.assertEqual(self._edges(manager), edges)
+        # The whole graph could run again
+        manager.call_services([], 'start')
+        self.assertEqual([svc.status for svc in services], [DONE] * 4)
+
+    def test_call_services_lazy_reset(self):
+        """A new run does not reset the whole graph before starting"""
+        manager, services = self._chain()
+        manager.call_services([], 'start')
+        self.assertEqual([svc.status for svc in services], [DONE] * 4)
+        resets = []
+        reset = Service.reset
+        def _reset(svc):
+            resets.append(svc.name)
+            return reset(svc)
+        Service.reset = _reset
+        try:
+            manager.call_services(['S2'], 'start')
+        finally:
+            Service.reset = reset
+        self.assertEqual(resets, [])
+        # Previous run state was forgotten
+        self.assertEqual([svc.status for svc in services],
+                         [DONE, DONE, NO_STATUS, NO_STATUS])
+        self.assertEqual(services[1]._actions['start'].tries, 1)
+        self.assertEqual(services[3]._actions['start'].tries, 0)
+
+    def test_call_services_selected_reversed(self):
+        """Selected services run their consumers in reverse mode"""
+        manager, services = self._chain()
+        edges = self._edges(manager)
+        manager.call_services(['S2'], 'stop',
+                              conf={'reverse_actions': ['stop']})
+        self.assertEqual([svc.status for svc in services],
+                         [NO_STATUS, DONE, DONE, NO_STATUS])
+        # Reverse mode is kept until the next run
+        manager.algo_reversed = False
+        self.assertEqual(self._edges(manager), edges)
+
+    def test_call_services_alternate_reversed(self):
+        """Reverse and normal runs alternate without changing the graph"""
+        manager, services = self._chain()
+        group = ServiceGroup('G')
+        group.add_inter_dep(target=Service('GS'))
+        group._subservices['GS'].add_action(Action('stop',
+                                                   command='/bin/true'))
+        group.add_dep(services[2])
+        manager.add_service(group)
+        edges = self._edges(manager)
+        conf = {'reverse_actions': ['stop']}
+        for action in ('stop', 'start', 'stop'):
+            manager.call_services(['S2'], action, conf=conf)
+            self.assertEqual(self._edges(manager), edges)
+        self.assertEqual([svc.status for svc in services] + [group.status],
+                         [NO_STATUS, DONE, DONE, NO_STATUS, DONE])
+
+    def test_call_services_nodeps_view(self):
+        """Dependencies are disabled only during the run"""
+        manager, services = self._chain()
+        edges = self._edges(manager)
+        manager.call_services(['S3'], 'start',
+                              conf={'nodeps': True, 'reverse_actions': []})
+        self.assertEqual([svc.status for svc in services],
+                         [NO_STATUS, NO_STATUS, DONE, NO_STATUS])
+        self.assertEqual(self._edges(manager), edges)
+        manager.call_services(['S3'], 'start', conf={'reverse_actions': []})
+        self.assertEqual([svc.status for svc in services],
+                         [DONE, DONE, DONE, NO_STATUS])
+
+    def _status_chain(self, count, command):
+        """Return a manager with a chain of services filtering each other"""
+        manager = ServiceManager()
+        services = []
+        for idx in range(count):
+            svc = Service('S%d' % idx)
+            action = Action('status', target='node[1-3]',
+                            command=command % idx)
+            action.mode = 'exec'
+            svc.add_action(action)
+            if services:
+                svc.add_dep(services[-1], sgth=FILTER)
+            services.append(svc)
+            manager.add_service(svc)
+        return manager, services
+
+    def test_call_services_readonly(self):
+        """Read-only actions do not wait for their dependencies to run"""
+        manager, services = self._status_chain(3, 'sleep 0.3; echo S%d')
+        for svc in services:
+            svc._actions['status'].readonly = True
+        elapsed = time.time()
+        manager.call_services([], 'status', conf={'reverse_actions': []})
+        elapsed = time.time() - elapsed
+        self.assertTrue(elapsed < 0.7, 'Time elapsed too high (%f)' % elapsed)
+        self.assertEqual(manager.status, DONE)
+        for idx, svc in enumerate(services):
+            action = svc._actions['status']
+            self.assertEqual(action.status, DONE)
+            self.assertEqual([(bytes(buf), nodes) for buf, nodes
+                              in action.worker.iter_buffers()],
+                             [(('S%d' % idx).encode(), NodeSet('node[1-3]'))])
+
+    def test_call_services_readonly_filter(self):
+        """Read-only actions give the same results as a regular run"""
+        command = 'test %%%%h != node2 -o S%d != S1'
+        results = []
+        for readonly in ([], ['status']):
+            manager, services = self._status_chain(3, command)
+            manager.call_services([], 'status',
+                                  conf={'reverse_actions': [],
+                                        'readonly_actions': readonly})
+            results.append([(svc.status, svc._actions['status'].target,
+                             svc._actions['status'].nodes_error())
+                            for svc in services])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1], (ERROR, NodeSet('node[1-3]'),
+                                         NodeSet('node2')))
+        self.assertEqual(results[1][2], (DONE, NodeSet('node[1,3]'),
+                                         NodeSet()))
+
     def test_call_services_conf(self):
         """test call_services() with an explicit conf object with variables"""
         try:
@@ -29,9 +29,12 @@ from MilkCheck.ServiceManager import ServiceManager
 from MilkCheck.Engine.Service import Service
 from MilkCheck.Engine.Action import Action, ActionManager
 from MilkCheck.Engine.ServiceGroup import ServiceGroup
+from MilkCheck.Engine.GroupCache import GroupCache
 from MilkCheck.Callback import CallbackHandler
 from MilkCheck.config import ConfigParser
-from ClusterShell.NodeSet import NodeSet
+from ClusterShell.NodeSet import NodeSet, std_group_resolver, \
+                                  set_std_group_resolver
+from ClusterShell.NodeUtils import GroupResolver, GroupSource
 
 # Symbols
 from MilkCheck.UI.Cli import RC_OK, RC_ERROR, RC_EXCEPTION, \
@@ -313,11 +316,19 @@ S3 - I am the service S3                                          [DEP_ERROR]
 """,
 """[00:00:00] DEBUG    - Configuration
 assumeyes: False
+auto_timeout: 0
+cache_file: /var/cache/milkcheck/results.json
+cache_ttl: 0
+compound_actions: {{}}
 config_dir: 
 confirm_actions: []
 dryrun: False
 fanout: 64
+group_cache_file: /var/cache/milkcheck/groups.json
+group_cache_ttl: 0
+history_file: 
 nodeps: False
+readonly_actions: []
 report: no
 reverse_actions: ['stop']
 summary: False
@@ -364,12 +375,20 @@ S3 - I am the service S3                                          [  ERROR  ]
 """,
 """[00:00:00] DEBUG    - Configuration
 assumeyes: False
+auto_timeout: 0
+cache_file: /var/cache/milkcheck/results.json
+cache_ttl: 0
+compound_actions: {{}}
 config_dir: 
 confirm_actions: []
 dryrun: False
 fanout: 64
+group_cache_file: /var/cache/milkcheck/groups.json
+group_cache_ttl: 0
+history_file: 
 nodeps: False
 only_nodes: HOSTNAME
+readonly_actions: []
 report: no
 reverse_actions: ['stop']
 summary: False
@@ -448,12 +467,20 @@ S3 - I am the service S3                                          [  ERROR  ]
 """,
 """[00:00:00] DEBUG    - Configuration
 assumeyes: False
+auto_timeout: 0
+cache_file: /var/cache/milkcheck/results.json
+cache_ttl: 0
+compound_actions: {{}}
 config_dir: 
 confirm_actions: []
 dryrun: False
 excluded_nodes: BADNODE
 fanout: 64
+group_cache_file: /var/cache/milkcheck/groups.json
+group_cache_ttl: 0
+history_file: 
 nodeps: False
+readonly_actions: []
 report: no
 reverse_actions: ['stop']
 summary: False
@@ -479,12 +506,20 @@ S3 - I am the service S3                                          [  ERROR  ]
 """,
 """[00:00:00] DEBUG    - Configuration
 assumeyes: False
+auto_timeout: 0
+cache_file: /var/cache/milkcheck/results.json
+cache_ttl: 0
+compound_actions: {{}}
 config_dir: 
 confirm_actions: []
 dryrun: False
 excluded_nodes: BADNODE
 fanout: 64
+group_cache_file: /var/cache/milkcheck/groups.json
+group_cache_ttl: 0
+history_file: 
 nodeps: False
+readonly_actions: []
 report: no
 reverse_actions: ['stop']
 summary: False
@@ -603,6 +638,10 @@ Options:
   -v, --verbose         Increase or decrease verbosity
   -d, --debug           Set debug mode and maximum verbosity
   -g, --graph           Output dependencies graph
+  --graph-format=GRAPH_FORMAT
+                        Format of the dependencies graph: dot (default), json
+                        or edges
+  --collapse-groups     Show groups as single nodes in the graph
   -s, --summary         --summary is an alias for --report=default
   -r REPORT, --report=REPORT
                         Display a report of executed actions
@@ -624,6 +663,19 @@ Options:
     -D DEFINES, --define=DEFINES, --var=DEFINES
                         Define custom variables
     --nodeps            Do not run dependencies
+    --deadline=DEADLINE
+                        Abort everything still running after DEADLINE seconds
+    --fail-fast         Cancel actions as soon as their result cannot change
+                        the final status
+    --fair-share        Share fanout fairly between running actions
+    --skip-unreachable  Skip nodes found unreachable earlier in the run
+    --dedup             Run identical commands only once per node
+    --probe=TIMEOUT     Remove nodes not reachable within TIMEOUT seconds
+                        before running
+    --simulate-run      Predict the run from durations history, without
+                        running anything
+    --simulate-fanout=FANOUTS
+                        Compare predicted runs with these fanouts
     -t TAGS, --tags=TAGS
                         Run services matching these tags
 """.format(prog=PROGNAME))
@@ -699,6 +751,70 @@ ServiceGroup.service - I am the service                           [  ERROR  ]
 ServiceGroup                                                      [DEP_ERROR]
 """)
 
+    def test_command_output_simulate_run(self):
+        """Test command line output of a simulated run"""
+        self._output_check(['ServiceGroup', 'stop', '--simulate-run'], RC_OK,
+"""ServiceGroup.service - I am the service                           [    OK   ]
+ServiceGroup                                                      [    OK   ]
+
+Simulated run
+ Predicted duration: 0.00 s
+ Fanout usage: 2%
+ Critical path:
+  > ServiceGroup.service.stop 0.00 s -> 0.00 s
+ No history for 1 action(s), assumed to take their timeout or 0.00 s
+""")
+        # Next runs of the process really execute commands
+        sys.stdout = MyOutput()
+        CallbackHandler._instance = None
+        self._output_check(['ServiceGroup', 'stop'], RC_ERROR,
+"""stop ServiceGroup.service ran in 0.00 s
+ > localhost exited with 1
+ServiceGroup.service - I am the service                           [  ERROR  ]
+ServiceGroup                                                      [DEP_ERROR]
+""")
+
+    def test_command_output_fair_share(self):
+        """Test command line output sharing fanout within a group budget"""
+        group = ServiceGroup('budget')
+        group.max_connections = 2
+        svc = Service('shared')
+        action = Action('start', command='true', target='node[1-4]')
+        action.mode = 'exec'
+        action.fanout = 8
+        svc.add_action(action)
+        group.add_inter_dep(target=svc)
+        self.manager.add_service(group)
+        self._output_check(['budget', 'start', '--fair-share'], RC_OK,
+"""budget.shared                                                     [    OK   ]
+budget                                                            [    OK   ]
+""")
+        self.assertTrue(ActionManager._instance.fairshare)
+        # Configured fanout is kept for the next runs
+        self.assertEqual(action.fanout, 8)
+
+    def test_command_line_groups_prefetched(self):
+        """Test groups of the command line nodesets are prefetched"""
+        prefetched = []
+        prefetch = GroupCache.prefetch
+        def _prefetch(cache, groups):
+            prefetched.append(set(groups))
+            return prefetch(cache, groups)
+        resolver = std_group_resolver()
+        set_std_group_resolver(GroupResolver(
+                    GroupSource('test', {'grp': 'localhost', 'io': 'foo'})))
+        GroupCache.prefetch = _prefetch
+        try:
+            cli = CommandLine()
+            cli.manager = self.manager
+            rc = cli.execute(['ServiceGroup', 'start', '-n', '@grp',
+                              '--exclude-nodes=@io'])
+        finally:
+            GroupCache.prefetch = prefetch
+            set_std_group_resolver(resolver)
+        self.assertEqual(rc, RC_OK)
+        self.assertEqual(prefetched, [set([('grp', None), ('io', None)])])
+
     def test_command_output_summary_error(self):
         '''Test command line output with summary and all actions FAILED'''
         self._output_check(['ServiceGroup', 'stop', '-s'], RC_ERROR,
@@ -1296,6 +1412,10 @@ Options:
   -v, --verbose         Increase or decrease verbosity
   -d, --debug           Set debug mode and maximum verbosity
   -g, --graph           Output dependencies graph
+  --graph-format=GRAPH_FORMAT
+                        Format of the dependencies graph: dot (default), json
+                        or edges
+  --collapse-groups     Show groups as single nodes in the graph
   -s, --summary         --summary is an alias for --report=default
   -r REPORT, --report=REPORT
                         Display a report of executed actions
@@ -1317,6 +1437,19 @@ Options:
     -D DEFINES, --define=DEFINES, --var=DEFINES
                         Define custom variables
     --nodeps            Do not run dependencies
+    --deadline=DEADLINE
+                        Abort everything still running after DEADLINE seconds
+    --fail-fast         Cancel actions as soon as their result cannot change
+                        the final status
+    --fair-share        Share fanout fairly between running actions
+    --skip-unreachable  Skip nodes found unreachable earlier in the run
+    --dedup             Run identical commands only once per node
+    --probe=TIMEOUT     Remove nodes not reachable within TIMEOUT seconds
+                        before running
+    --simulate-run      Predict the run from durations history, without
+                        running anything
+    --simulate-fanout=FANOUTS
+                        Compare predicted runs with these fanouts
     -t TAGS, --tags=TAGS
                         Run services matching these tags
 '''.format(prog=PROGNAME),
@@ -1360,11 +1493,19 @@ ZeroDivisionError
 ''',
 '''[00:00:00] DEBUG    - Configuration
 assumeyes: False
+auto_timeout: 0
+cache_file: /var/cache/milkcheck/results.json
+cache_ttl: 0
+compound_actions: {{}}
 config_dir: 
 confirm_actions: []
 dryrun: False
 fanout: 64
+group_cache_file: /var/cache/milkcheck/groups.json
+group_cache_ttl: 0
+history_file: 
 nodeps: False
+readonly_actions: []
 report: no
 reverse_actions: ['stop']
 summary: False
@@ -52,6 +52,14 @@ class McOptionParserTest(unittest.TestCase):
         self.assertTrue('foo2' in options.only_nodes)
         self.assertTrue('service' in args and 'start' in args)
 
+    def test_nodeset_values(self):
+        """Test nodesets are found in the command line before parsing"""
+        args = ['-yn', '@grp', '--exclude-nodes=foo1', 'svc', '-x@io',
+                '--only-n', 'bar1', '-D', 'A=@nope', 'start', '--', '-n',
+                '@last']
+        self.assertEqual(self.mop.nodeset_values(args),
+                         ['@grp', 'foo1', '@io', 'bar1'])
+
     def test_option_configdir(self):
         """Test usage of the configdir option"""
         tmpdir = tempfile.mkdtemp()
@@ -103,6 +111,49 @@ class McOptionParserTest(unittest.TestCase):
         options, _ = self.mop.parse_args(['-t', 'tag1,tag2', '-t', 'tag3'])
         self.assertEqual(options.tags, set(['tag1', 'tag2', 'tag3']))
 
+    def test_option_deadline(self):
+        """Test --deadline option"""
+        options, _ = self.mop.parse_args(['--deadline', '90'])
+        self.assertEqual(options.deadline, 90.0)
+        self.assertRaises(InvalidOptionError, self.mop.parse_args,
+                          ['--deadline', 'soon'])
+
+    def test_option_fail_fast(self):
+        """Test --fail-fast option"""
+        options, _ = self.mop.parse_args(['--fail-fast'])
+        self.assertTrue(options.failfast)
+
+    def test_option_fair_share(self):
+        """Test --fair-share option"""
+        options, _ = self.mop.parse_args(['--fair-share'])
+        self.assertTrue(options.fairshare)
+
+    def test_option_skip_unreachable(self):
+        """Test --skip-unreachable option"""
+        options, _ = self.mop.parse_args(['--skip-unreachable'])
+        self.assertTrue(options.skip_unreachable)
+
+    def test_option_dedup(self):
+        """Test --dedup option"""
+        options, _ = self.mop.parse_args(['--dedup'])
+        self.assertTrue(options.dedup)
+
+    def test_option_probe(self):
+        """Test --probe option"""
+        options, _ = self.mop.parse_args(['--probe=1.5'])
+        self.assertEqual(options.probe, 1.5)
+
+    def test_option_simulate_run(self):
+        """Test --simulate-run and --simulate-fanout options"""
+        options, _ = self.mop.parse_args(['--simulate-run'])
+        self.assertTrue(options.simulate_run)
+        options, _ = self.mop.parse_args(['--simulate-fanout=64,8,16'])
+        self.assertEqual(options.simulate_fanout, [8, 16, 64])
+        self.assertRaises(InvalidOptionError, self.mop.parse_args,
+                          ['--simulate-fanout=8,foo'])
+        self.assertRaises(InvalidOptionError, self.mop.parse_args,
+                          ['--simulate-fanout=0'])
+
     def test_option_assume_yes(self):
         """Test --assumeyes option"""
         options, _ = self.mop.parse_args(['-y'])